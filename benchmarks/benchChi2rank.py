@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from generators import syntheticInputs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from chi2rankEngine import moduleMembership, scorePermutations
+from moduleIndex import ModuleIndex
+from randomPermutation import permutation_indices
+
+"""
+Permutations/second of the vectorized chi2rank engine on synthetic scores and modules.
+
+With --checkPascalX (PascalX installed, e.g. in the pascalx container), the first --checkPermutations permutations are
+also scored with PascalX chi2rank(fuse=False) as runPascal.py does, and the largest relative difference of the module
+p-values is reported.
+
+Usage:
+python3 benchmarks/benchChi2rank.py [--numGenes 20000] [--numModules 2000] [--numPermutations 1000] [--checkPascalX]
+"""
+
+def checkPascalX(genes, pvals, moduleLines, permutations, modulePvals) -> float:
+    from runPascal import loadModules, scoreOneFile
+    from pascalResultIO import readPascalResult
+    worst = 0.0
+    with tempfile.TemporaryDirectory() as tmpDir:
+        modulePath = os.path.join(tmpDir, "Module_bench_x_net.tsv")
+        with open(modulePath, "w") as f:
+            f.write("".join("\t".join([columns[0]] + columns[2:]) + "\n" for columns in moduleLines))
+        modules = loadModules(modulePath)
+        for k, permutation in enumerate(permutations):
+            scorePath = os.path.join(tmpDir, f"GS_bench_{k + 1}-x_net.tsv")
+            with open(scorePath, "w") as f:
+                f.write("".join(f"{genes[g]}\t{p}\n" for g, p in zip(permutation.tolist(), pvals.tolist())))
+            result = readPascalResult(scoreOneFile(scorePath, modules, tmpDir, "npz"))
+            expected = dict(zip(result.moduleIndex.tolist(), result.modulePval.tolist()))
+            for j, columns in enumerate(moduleLines):
+                reference = expected.get(int(columns[0]), np.nan)
+                if np.isfinite(reference) and reference > 0:
+                    worst = max(worst, abs(modulePvals[k, j] - reference) / reference)
+    return worst
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized chi2rank engine.")
+    parser.add_argument("--numGenes", type=int, default=20000)
+    parser.add_argument("--numModules", type=int, default=2000)
+    parser.add_argument("--maxModuleSize", type=int, default=300)
+    parser.add_argument("--numPermutations", type=int, default=1000)
+    parser.add_argument("--blockSize", type=int, default=32)
+    parser.add_argument("--checkPascalX", action="store_true", help="compare with PascalX chi2rank on a few permutations")
+    parser.add_argument("--checkPermutations", type=int, default=3)
+    args = parser.parse_args()
+
+    genes, pvals, moduleLines = syntheticInputs(args.numGenes, args.numModules, args.maxModuleSize)
+    membership = moduleMembership(ModuleIndex.fromModuleLines(moduleLines), genes)
+    permutations = np.stack([permutation_indices(args.numGenes, seed) for seed in range(1, args.numPermutations + 1)])
+    print(f"{args.numGenes} genes, {args.numModules} modules, {membership.nnz} memberships, {args.numPermutations} permutations")
+
+    start = time.perf_counter()
+    modulePvals = scorePermutations(pvals, permutations, membership, args.blockSize)
+    elapsed = time.perf_counter() - start
+    print(f"vectorized chi2rank: {elapsed:.2f} s, {args.numPermutations / elapsed:.1f} permutations/s")
+
+    if args.checkPascalX:
+        checked = min(args.checkPermutations, args.numPermutations)
+        worst = checkPascalX(genes, pvals, moduleLines, permutations[:checked], modulePvals[:checked])
+        print(f"PascalX parity on {checked} permutations: max relative difference {worst:.3g}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from generators import syntheticPascalRows
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from pascalResultIO import readPascalResult, writePascalResult, writeLegacyPascalResult
+
+"""
+Compare parse time of the legacy str(tuple) Pascal output and the structured .npz output on a synthetic result.
+
+Usage:
+python3 benchmarks/benchPascalParse.py [--numModules 10000] [--maxModuleSize 300]
+"""
+
+def timeRead(DIRPATH:str, repeat:int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = readPascalResult(DIRPATH)
+        # materialize gene lists as processPascalOutput does
+        for i in range(len(result)):
+            result.moduleGenes(i)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark legacy vs structured Pascal output parsing.")
+    parser.add_argument("--numModules", type=int, default=10000)
+    parser.add_argument("--maxModuleSize", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = syntheticPascalRows(args.numModules, args.maxModuleSize)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        legacyPath = os.path.join(tmpDir, "cma_1-trait_network.txt")
+        structuredPath = os.path.join(tmpDir, "cma_1-trait_network.npz")
+        writeLegacyPascalResult(legacyPath, rows)
+        writePascalResult(structuredPath, rows)
+        legacySeconds = timeRead(legacyPath, args.repeat)
+        structuredSeconds = timeRead(structuredPath, args.repeat)
+        print(f"modules: {args.numModules}")
+        print(f"legacy text: {os.path.getsize(legacyPath) / 1e6:.1f} MB, {legacySeconds:.3f} s")
+        print(f"structured npz: {os.path.getsize(structuredPath) / 1e6:.1f} MB, {structuredSeconds:.3f} s")
+        print(f"speedup: {legacySeconds / structuredSeconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+"""
+Synthetic inputs for the benchmarks, in the formats the pipeline reads:
+
+    score file      CSV with markname and meta_p (plus an unnamed index column, as written by pandas), one row per gene
+    module files    one <network>.txt per network: module index <tab> 1.0 <tab> genes..., some genes without a score
+    Pascal outputs  legacy str(row) text ([module, genes, array(gene pvals), module pval]) or structured .npz
+    ORA summaries   ORA_cmd.R summary CSV of a significant module: representative GO terms, or write.csv(NULL) without any
+
+Every generator takes a seed, so a scenario always produces the same files.
+"""
+
+def geneNames(numGenes:int) -> List[str]:
+    return [f"GENE{g}" for g in range(numGenes)]
+
+def syntheticScores(numGenes:int, seed:int = 0) -> pd.DataFrame:
+    """
+    Gene score table with a realistic p-value distribution: mostly uniform, a few percent strongly associated genes.
+    """
+    rng = np.random.default_rng(seed)
+    pvals = rng.uniform(size=numGenes)
+    associated = rng.random(numGenes) < 0.02
+    pvals[associated] = 10 ** -rng.uniform(3, 12, int(associated.sum()))
+    return pd.DataFrame({"markname": geneNames(numGenes), "meta_p": pvals})
+
+def writeScoreFile(OUTPUTPATH:str, numGenes:int, seed:int = 0) -> pd.DataFrame:
+    df = syntheticScores(numGenes, seed)
+    df.to_csv(OUTPUTPATH)
+    return df
+
+def syntheticModuleLines(genes:List[str], numModules:int, minModuleSize:int, maxModuleSize:int,
+                         unscoredFraction:float = 0.05, seed:int = 0) -> List[List[str]]:
+    """
+    Module file lines as columns: module index, "1.0", genes. About unscoredFraction of the genes have no score.
+    """
+    rng = np.random.default_rng(seed)
+    lines = []
+    for moduleIndex in range(1, numModules + 1):
+        size = int(rng.integers(minModuleSize, maxModuleSize + 1))
+        members = [genes[g] for g in rng.choice(len(genes), size, replace=False)]
+        members = [f"UNSCORED{rng.integers(1 << 30)}" if rng.random() < unscoredFraction else gene for gene in members]
+        lines.append([str(moduleIndex), "1.0"] + members)
+    return lines
+
+def writeModuleFiles(DIRPATH:str, genes:List[str], numNetworks:int, numModules:int, minModuleSize:int,
+                     maxModuleSize:int, seed:int = 0) -> List[str]:
+    os.makedirs(DIRPATH, exist_ok=True)
+    paths = []
+    for n in range(numNetworks):
+        path = os.path.join(DIRPATH, f"net{n}.txt")
+        with open(path, "w") as f:
+            for columns in syntheticModuleLines(genes, numModules, minModuleSize, maxModuleSize, seed=seed + n):
+                f.write("\t".join(columns) + "\n")
+        paths.append(path)
+    return paths
+
+def syntheticPascalRows(numModules:int, maxModuleSize:int, numGenes:int = 20000, seed:int = 0):
+    # same layout as PascalX chi2rank rows: [module, genes, array(gene pvals), module pval]
+    rng = np.random.default_rng(seed)
+    rows = []
+    for moduleIndex in range(1, numModules + 1):
+        size = int(rng.integers(1, maxModuleSize))
+        genes = [f"GENE{g}" for g in rng.choice(numGenes, size, replace=False)]
+        rows.append([str(moduleIndex), genes, rng.uniform(size=size), float(rng.uniform())])
+    return rows
+
+def pascalRowsOfModuleFile(MODULEPATH:str, GSPATH:str, seed:int = 0):
+    """
+    Pascal rows of a processed Module_ file scored against its GS_ file, as runPascal.py would produce them:
+    genes of the module with their score, a module p-value (nan for modules without genes, a few very small ones).
+    """
+    rng = np.random.default_rng(seed)
+    gs = pd.read_table(GSPATH, header=None)
+    geneToPval = dict(zip(gs[0].astype(str).tolist(), gs[1].tolist()))
+    rows = []
+    with open(MODULEPATH, "r") as f:
+        for line in f:
+            columns = line.split()
+            genes = columns[1:]
+            modulePval = 10 ** -rng.uniform(4, 12) if rng.random() < 0.01 else float(rng.uniform())
+            rows.append([columns[0], genes, np.array([geneToPval[gene] for gene in genes]), modulePval if genes else np.nan])
+    return rows
+
+def syntheticInputs(numGenes:int, numModules:int, maxModuleSize:int, seed:int = 0):
+    # gene names, gene p-values and module lines of the chi2rank benchmarks
+    rng = np.random.default_rng(seed)
+    genes = geneNames(numGenes)
+    pvals = rng.uniform(size=numGenes) ** 2
+    moduleLines = [[str(moduleIndex), "1.0"] + [genes[g] for g in rng.choice(numGenes, int(rng.integers(2, maxModuleSize)), replace=False)]
+                   for moduleIndex in range(1, numModules + 1)]
+    return genes, pvals, moduleLines
+
+ORA_COLUMNS = ["geneSet", "description", "size", "overlap", "expect", "enrichmentRatio", "pValue", "FDR", "overlapId",
+               "userId", "database"]
+
+def writeOraSummary(OUTPUTPATH:str, genes:List[str], numTerms:int, seed:int = 0) -> None:
+    # numTerms representative terms of a module with the given genes; 0 writes the file of write.csv(NULL)
+    if numTerms == 0:
+        with open(OUTPUTPATH, "w") as f:
+            f.write('""\n')
+        return
+    rng = np.random.default_rng(seed)
+    size = rng.integers(10, 500, numTerms)
+    overlap = np.minimum(rng.integers(1, max(2, len(genes) + 1), numTerms), size)
+    expect = overlap / rng.uniform(1.5, 20, numTerms)
+    pValue = 10 ** -rng.uniform(2, 15, numTerms)
+    overlapIds = [";".join(rng.choice(genes, int(k), replace=False)) if len(genes) >= k else ";".join(genes) for k in overlap]
+    pd.DataFrame({"geneSet": [f"GO:{t:07d}" for t in rng.choice(10 ** 6, numTerms, replace=False)],
+                  "description": [f"term {t}" for t in range(numTerms)], "size": size, "overlap": overlap, "expect": expect,
+                  "enrichmentRatio": overlap / expect, "pValue": pValue, "FDR": np.minimum(pValue * numTerms * 50, 0.049),
+                  "overlapId": overlapIds, "userId": overlapIds, "database": "geneontology_Biological_Process"}) \
+        .to_csv(OUTPUTPATH, index=False)
@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from generators import pascalRowsOfModuleFile, writeModuleFiles, writeOraSummary, writeScoreFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from pascalResultIO import writeLegacyPascalResult, writePascalResult
+
+"""
+End-to-end benchmark of the pipeline stages on synthetic inputs (see generators.py), offline and without PascalX or R.
+
+Every stage runs the script under scripts/ in its own process, exactly as a Nextflow task would, so the wall time
+includes interpreter start-up and imports, and the peak RSS is the ru_maxrss of that process (os.wait4). The Pascal
+outputs are generated from the processed Module_/GS_ files instead of being scored by PascalX; chi2rankEngine.py is the
+scoring stage. The ORA summaries (ORA_cmd.R, R) are generated as well, for every significant module of the chunk.
+
+    randomPermutation       permutation matrix of numRP seeds                   items: permutations
+    moduleIndex             module index of every network                       items: networks
+    preProcessForPascal     GS_/GO_/Module_ files of numRP x networks           items: (permutation, network) pairs
+    preProcessIndexed       same with --moduleIndexDir                          items: (permutation, network) pairs
+    chi2rankEngine          module p-values of numRP permutations, 1 network    items: permutations
+    processPascalText       one legacy text Pascal output                       items: modules
+    processPascalNpz        one structured .npz Pascal output                   items: modules
+    processPascalBatch      every .npz output into one chunk summary            items: Pascal outputs
+    mergeORAandSummary      chunk summary + ORA summaries                       items: summary rows
+    empiricalPvalue         empirical p-values over the chunk summary           items: summary rows
+
+Results are written as JSON; --compare prints the ratios against an earlier result (the baseline) and flags stages that
+got slower or bigger than --tolerance. benchChi2rank.py and benchPascalParse.py are the in-process micro-benchmarks of
+the chi2rank engine and of the Pascal output parser, on the same generators.
+
+Usage:
+python3 benchmarks/runBenchmarks.py --scenario default --output results.json [--compare baseline.json]
+python3 benchmarks/runBenchmarks.py --scenario full --numRP 50 --stages preProcessForPascal processPascalBatch
+"""
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+SCENARIOS = {
+    "smoke":   {"numGenes": 2000,   "numNetworks": 2, "numModules": 200,  "minModuleSize": 5,  "maxModuleSize": 100, "numRP": 4},
+    "default": {"numGenes": 20000,  "numNetworks": 3, "numModules": 1000, "minModuleSize": 10, "maxModuleSize": 300, "numRP": 10},
+    # genome-wide CMA scores: ~180k genes (all categories)
+    "full":    {"numGenes": 180000, "numNetworks": 3, "numModules": 2000, "minModuleSize": 10, "maxModuleSize": 500, "numRP": 20},
+}
+STAGES = ["randomPermutation", "moduleIndex", "preProcessForPascal", "preProcessIndexed", "chi2rankEngine",
+          "processPascalText", "processPascalNpz", "processPascalBatch", "mergeORAandSummary", "empiricalPvalue"]
+PIPELINE = "cma"
+TRAIT = "scores"
+
+def runScript(argv:List[str], workDir:str, logPath:str) -> Dict[str, float]:
+    """
+    Run one script in its own process.
+
+    Returns:
+        Dict[str, float]: wall seconds and peak RSS (MB) of the process
+    """
+    with open(logPath, "a") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable] + argv, cwd=workDir, stdout=log, stderr=log)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(argv[0])} failed with exit code {proc.returncode}, see {logPath}")
+    # ru_maxrss is in KB on Linux
+    return {"seconds": seconds, "peakRssMB": rusage.ru_maxrss / 1024}
+
+class Suite:
+    """
+    Generated inputs of one scenario and the stages run on them, in pipeline order (later stages read the outputs of
+    earlier ones).
+
+    Args:
+        workDir (str): directory of the inputs and outputs
+        params (dict): scenario parameters
+        repeat (int): runs per stage; the fastest run and the largest peak RSS are kept
+    """
+    def __init__(self, workDir:str, params:dict, repeat:int):
+        self.workDir = workDir
+        self.params = params
+        self.repeat = repeat
+        self.log = os.path.join(workDir, "benchmark.log")
+        self.results = {}
+
+    def path(self, *parts) -> str:
+        return os.path.join(self.workDir, *parts)
+
+    def generate(self) -> None:
+        p = self.params
+        df = writeScoreFile(self.path(f"{TRAIT}.csv"), p["numGenes"])
+        writeModuleFiles(self.path("modules"), df["markname"].tolist(), p["numNetworks"], p["numModules"],
+                         p["minModuleSize"], p["maxModuleSize"])
+
+    def measure(self, stage:str, argv:List[str], items:int, prepare=None) -> None:
+        best = {"seconds": float("inf"), "peakRssMB": 0.0}
+        for _ in range(self.repeat):
+            if prepare is not None:
+                prepare()
+            run = runScript(argv, self.workDir, self.log)
+            best = {"seconds": min(best["seconds"], run["seconds"]), "peakRssMB": max(best["peakRssMB"], run["peakRssMB"])}
+        self.results[stage] = {**best, "items": items, "itemsPerSecond": items / best["seconds"]}
+        print(f"{stage:<22}{best['seconds']:>9.2f} s{items / best['seconds']:>12.1f} items/s{best['peakRssMB']:>9.0f} MB")
+
+    def fresh(self, *parts):
+        # outputs of the previous repetition are removed so that every run does the same work
+        def prepare():
+            for part in parts:
+                shutil.rmtree(self.path(part), ignore_errors=True)
+        return prepare
+
+    def writePascalOutputs(self) -> List[str]:
+        # stand-in for runPascal.py: one text and one .npz output per GS_ file of preProcessForPascal
+        os.makedirs(self.path("pascalOutput", "text"), exist_ok=True)
+        os.makedirs(self.path("pascalOutput", "npz"), exist_ok=True)
+        names = sorted(file[3:-4] for file in os.listdir(self.path("pascalInput")) if file.startswith("GS_"))
+        for seed, name in enumerate(names):
+            rows = pascalRowsOfModuleFile(self.path("pascalInput", f"Module_{name}.tsv"), self.path("pascalInput", f"GS_{name}.tsv"), seed)
+            writeLegacyPascalResult(self.path("pascalOutput", "text", f"{name}.txt"), rows)
+            writePascalResult(self.path("pascalOutput", "npz", f"{name}.npz"), rows)
+        return names
+
+    def writeOraSummaries(self, names:List[str]) -> None:
+        # stand-in for ORA_cmd.R: one summary per significant module, without significant terms for some of them
+        rng = np.random.default_rng(0)
+        for name in names:
+            _, trait, network = name.split("_")
+            summaryRoot = self.path("GO_summaries", f"GO_summaries_{trait}_{network}")
+            os.makedirs(summaryRoot, exist_ok=True)
+            for file in sorted(os.listdir(self.path("significantModules", name))):
+                with open(self.path("significantModules", name, file)) as f:
+                    genes = f.read().split()
+                numTerms = int(rng.integers(0, 6)) if file.startswith("sig_") else 0
+                writeOraSummary(os.path.join(summaryRoot, file.replace(".txt", ".csv")), genes, numTerms, int(rng.integers(2 ** 31)))
+
+    def run(self, stages:List[str]) -> Dict[str, dict]:
+        p = self.params
+        S = SCRIPTS
+        numRP, numNetworks = p["numRP"], p["numNetworks"]
+        rpIndices = ",".join(str(rp) for rp in range(1, numRP + 1))
+        permutationFile = self.path("rp", f"{TRAIT}_permutations.npy")
+        preProcessArgs = [f"{TRAIT}.csv", "modules", "pascalInput", PIPELINE, TRAIT, "markname", "meta_p",
+                          "--permutationFile", permutationFile, "--rpIndices", rpIndices]
+
+        # the outputs of every stage are inputs of the next ones, so stages that are not measured still run once
+        def stage(name, argv, items, prepare=None):
+            if name in stages:
+                self.measure(name, argv, items, prepare)
+            else:
+                if prepare is not None:
+                    prepare()
+                runScript(argv, self.workDir, self.log)
+
+        stage("randomPermutation", [f"{S}/randomPermutation.py", f"{TRAIT}.csv", "rp", "markname", str(numRP), "--batch"], numRP)
+        stage("moduleIndex", [f"{S}/moduleIndex.py", f"{TRAIT}.csv", "modules", "moduleIndex", "markname"], numNetworks,
+              self.fresh("moduleIndex"))
+        if "preProcessForPascal" in stages:
+            self.measure("preProcessForPascal", [f"{S}/preProcessForPascal.py"] + preProcessArgs, numRP * numNetworks,
+                         self.fresh("pascalInput"))
+        stage("preProcessIndexed", [f"{S}/preProcessForPascal.py"] + preProcessArgs + ["--moduleIndexDir", "moduleIndex"],
+              numRP * numNetworks, self.fresh("pascalInput"))
+
+        if "chi2rankEngine" in stages:
+            self.measure("chi2rankEngine", [f"{S}/chi2rankEngine.py", f"{TRAIT}.csv", "modules/net0.txt", permutationFile,
+                                            "chi2rank", PIPELINE, TRAIT, "markname", "meta_p"], numRP)
+
+        names = self.writePascalOutputs()
+        first = names[0]
+        numModules = sum(1 for _ in open(self.path("pascalInput", f"Module_{first}.tsv")))
+        # relative paths, as in a Nextflow task: the single mode takes study/trait/network from the path
+        for stageName, outputPath in [("processPascalText", f"pascalOutput/text/{first}.txt"),
+                                      ("processPascalNpz", f"pascalOutput/npz/{first}.npz")]:
+            if stageName in stages:
+                self.measure(stageName, [f"{S}/processPascalOutput.py", outputPath, "0.05", f"single/{stageName}",
+                                         f"pascalInput/GS_{first}.tsv", f"single/{stageName}/sig",
+                                         str(p["numGenes"])], numModules, self.fresh("single"))
+
+        with open(self.path("pascalOutputs.txt"), "w") as f:
+            f.write("".join(self.path("pascalOutput", "npz", f"{name}.npz") + "\n" for name in names))
+        stage("processPascalBatch", [f"{S}/processPascalOutput.py", "pascalOutputs.txt", "0.05", "masterSummaryPiece",
+                                     "pascalInput", "significantModules", str(p["numGenes"]), "--batch", "--chunkName", "1"],
+              len(names), self.fresh("masterSummaryPiece", "significantModules"))
+
+        shutil.rmtree(self.path("GO_summaries"), ignore_errors=True)
+        self.writeOraSummaries(names)
+
+        summaryPath = self.path("masterSummaryPiece", "master_summary_chunk_1.csv")
+        with open(summaryPath) as f:
+            numRows = sum(1 for _ in f) - 1
+        stage("mergeORAandSummary", [f"{S}/mergeORAandSummary.py", summaryPath, "GO_summaries", "mergedSummary", "-",
+                                     "--batch", "--chunkName", "1"], numRows, self.fresh("mergedSummary"))
+        with open(self.path("summaries.txt"), "w") as f:
+            f.write(summaryPath + "\n")
+        stage("empiricalPvalue", [f"{S}/empiricalPvalue.py", "summaries.txt", "--outputName", "empirical_pvalues.csv"], numRows)
+        return self.results
+
+def environment() -> dict:
+    return {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count(),
+            "host": platform.node(), "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+def compareResults(current:dict, baseline:dict, tolerance:float) -> List[str]:
+    """
+    Print time and memory ratios of current vs baseline for every stage both ran.
+
+    Returns:
+        List[str]: stages slower or bigger than 1 + tolerance
+    """
+    if current["params"] != baseline["params"]:
+        print(f"warning: scenario parameters differ from the baseline {baseline['params']}")
+    regressions = []
+    print(f"{'stage':<22}{'baseline s':>11}{'now s':>9}{'time':>8}{'baseline MB':>13}{'now MB':>8}{'memory':>8}")
+    for stage, now in current["stages"].items():
+        before = baseline["stages"].get(stage)
+        if before is None:
+            continue
+        timeRatio = now["seconds"] / before["seconds"]
+        memoryRatio = now["peakRssMB"] / before["peakRssMB"]
+        flag = ""
+        if timeRatio > 1 + tolerance or memoryRatio > 1 + tolerance:
+            regressions.append(stage)
+            flag = "  REGRESSION"
+        print(f"{stage:<22}{before['seconds']:>11.2f}{now['seconds']:>9.2f}{timeRatio:>7.2f}x"
+              f"{before['peakRssMB']:>13.0f}{now['peakRssMB']:>8.0f}{memoryRatio:>7.2f}x{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic inputs.")
+    parser.add_argument("--scenario", choices=list(SCENARIOS), default="default")
+    for name, value in SCENARIOS["default"].items():
+        parser.add_argument(f"--{name}", type=int, help=f"override the scenario (default scenario: {value})")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="stages to measure")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage, the fastest is kept")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run (baseline) to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown or memory growth vs the baseline")
+    parser.add_argument("--workDir", help="keep the generated inputs and outputs here instead of a temporary directory")
+    args = parser.parse_args()
+
+    params = dict(SCENARIOS[args.scenario])
+    params.update({name: getattr(args, name) for name in params if getattr(args, name) is not None})
+    print(f"scenario {args.scenario}: {params}")
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        workDir = args.workDir or tmpDir
+        os.makedirs(workDir, exist_ok=True)
+        suite = Suite(workDir, params, args.repeat)
+        start = time.perf_counter()
+        suite.generate()
+        print(f"generated inputs in {time.perf_counter() - start:.1f} s")
+        stages = suite.run(args.stages)
+
+    result = {"scenario": args.scenario, "params": params, "environment": environment(), "stages": stages}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compareResults(result, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+nextflow.enable.dsl=2
+// Many traits in one run: every row of the sample sheet (CSV with header pipeline,trait,scoreFile,numTests) runs the
+// chunked mode of mea_slurm.nf. Module files are parsed and indexed once for all traits (one BuildModuleIndex task),
+// every other task works on one chunk of permutations of one trait, and every trait gets its own master summary.
+params.sampleSheet = ""
+params.geneColName = 'markname'
+params.pvalColName = 'meta_p'
+params.moduleFileDir = "/app/data/modules/cherryPickModules/"
+params.numRP = 10000
+// permutations per task. One summary file per chunk; the intermediate files of a chunk stay per permutation and
+// network (see params.chunkSize in mea_slurm.nf)
+params.chunkSize = 100
+// the module index (see scripts/moduleIndex.py) is built once per run by BuildModuleIndex and shared by every chunk.
+// moduleIndexDir: optional persistent copy kept between runs (a writable directory), empty string for none
+params.moduleIndexDir = ""
+// GO BP GMT file read by ORA_cmd.R with oraLocalDatabase
+params.goGmtFile = "/app/data/GO/geneontology_Biological_Process.gmt"
+params.oraWorkers = 4
+params.oraBatchSize = 0
+params.oraLocalDatabase = false
+params.masterSummaryFormat = "csv"
+params.summaryFormat = "csv"
+params.masterSummarySort = false
+params.empiricalPvalues = false
+params.cacheDir = ""
+params.cacheMaxSize = ""
+
+def oraDatabaseArgs(option) {
+    return params.oraLocalDatabase ? "${option} ${params.goGmtFile}" : ""
+}
+
+def cacheArgs() {
+    if (!params.cacheDir) return ""
+    return "--cacheDir ${params.cacheDir}" + (params.cacheMaxSize ? " --cacheMaxSize ${params.cacheMaxSize}" : "")
+}
+
+process BuildModuleIndex {
+    container 'mea_latest.sif'
+    label "process_low"
+
+    input:
+    val(scoreFiles)
+
+    output:
+    path("moduleIndex/")
+
+    script:
+    """
+    python3 /app/scripts/moduleIndex.py ${scoreFiles.join(' ')} ${params.moduleFileDir} moduleIndex/ ${params.geneColName} \
+        ${params.moduleIndexDir ? "--persistentDir ${params.moduleIndexDir}" : ""}
+    """
+}
+
+process RandomPermutationBatch {
+    container 'mea_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(pipeline), val(trait), val(scoreFile), val(numTests)
+
+    output:
+    tuple val(pipeline), val(trait), val(scoreFile), val(numTests), path("RPscores/${trait}/*_permutations.npy")
+
+    script:
+    """
+    python3 /app/scripts/randomPermutation.py ${scoreFile} "RPscores/${trait}/" ${params.geneColName} ${params.numRP} --batch ${cacheArgs()}
+    """
+}
+
+process PreProcessForPascalChunk{
+    container 'mea_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(pipeline), val(trait), val(scoreFile), val(numTests), path(permutationFile), val(chunkName), val(rpIndices)
+    path(moduleIndexDir)
+
+    output:
+    tuple val(pipeline), val(trait), val(numTests), val(chunkName), path("pascalInput/")
+
+    script:
+    """
+    python3 /app/scripts/preProcessForPascal.py \
+        ${scoreFile} \
+        ${params.moduleFileDir} \
+        "pascalInput/" \
+        ${pipeline} \
+        ${trait} \
+        ${params.geneColName} \
+        ${params.pvalColName} \
+        --permutationFile ${permutationFile} \
+        --rpIndices ${rpIndices} \
+        --moduleIndexDir ${moduleIndexDir} \
+        ${cacheArgs()}
+    """
+}
+
+process RunPascalChunk{
+    container 'pascalx_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(pipeline), val(trait), val(numTests), val(chunkName), path(pascalInput)
+
+    output:
+    tuple val(pipeline), val(trait), val(numTests), val(chunkName), path("pascalOutput/"), path(pascalInput)
+
+    script:
+    // Module_ files with identical content (one network, many permutations) are loaded once
+    """
+    for gs in ${pascalInput}/GS_*.tsv; do
+        name=\$(basename \$gs .tsv)
+        printf '%s\\t%s\\n' \$gs ${pascalInput}/Module_\${name#GS_}.tsv
+    done > manifest.tsv
+    python3 /app/scripts/runPascal.py \
+        manifest.tsv \
+        \$(ls ${pascalInput}/Module_* | head -n 1) \
+        "pascalOutput/" \
+        ${pipeline} \
+        ${trait} \
+        --batch \
+        --workers ${task.cpus} \
+        ${cacheArgs()}
+    """
+}
+
+process ProcessPascalOutputChunk{
+    container 'mea_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(pipeline), val(trait), val(numTests), val(chunkName), path(pascalOutput), path(pascalInput)
+
+    output:
+    tuple val(pipeline), val(trait), val(chunkName), path("masterSummaryPiece/master_summary_chunk_*"), path("significantModules/"), path(pascalInput)
+
+    script:
+    """
+    ls ${pascalOutput}/* > pascalOutputs.txt
+    python3 /app/scripts/processPascalOutput.py \
+        pascalOutputs.txt \
+        0.05 \
+        "masterSummaryPiece/" \
+        ${pascalInput} \
+        "significantModules/" \
+        ${numTests} \
+        --batch \
+        --chunkName ${chunkName} \
+        --summaryFormat ${params.summaryFormat} \
+        ${cacheArgs()}
+    """
+}
+
+process GoAnalysisChunk{
+    container 'webgestalt_latest.sif'
+    publishDir ".", pattern: "GO_summaries/${pipeline}/${trait}/*", mode: 'copy' // copy ORA results to current location.
+    label "process_low"
+    cpus params.oraWorkers
+
+    input:
+    tuple val(pipeline), val(trait), val(chunkName), path(masterSummaryChunk), path(sigModuleDir), path(pascalInput)
+
+    output:
+    tuple val(pipeline), val(trait), val(chunkName), path(masterSummaryChunk), path("GO_summaries/${pipeline}/${trait}/")
+
+    script:
+    // webgestalt_latest.sif is built from Dockerfile.webgestalt, which provides python3 for the (standard library only) driver
+    """
+    mkdir -p "GO_summaries/${pipeline}/${trait}/"
+    for dir in ${sigModuleDir}/*/; do
+        name=\$(basename \$dir)
+        printf '%s\\t%s\\t%s\\n' \$dir ${pascalInput}/GO_\${name}.txt \
+            "GO_summaries/${pipeline}/${trait}/GO_summaries_\$(echo \$name | cut -d_ -f2)_\$(echo \$name | cut -d_ -f3)/"
+    done > ora.tsv
+    python3 /app/scripts/parallelORA.py --manifest ora.tsv --workers ${params.oraWorkers} --batchSize ${params.oraBatchSize} \
+        --oraScript /app/scripts/ORA_cmd.R ${oraDatabaseArgs("--goGmtFile")}
+    """
+}
+
+process MergeORAsummaryAndMasterSummaryChunk{
+    container 'mea_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(pipeline), val(trait), val(chunkName), path(masterSummaryChunk), path(oraSummaryRoot)
+
+    output:
+    tuple val(pipeline), val(trait), path("summary/*")
+
+    """
+    python3 /app/scripts/mergeORAandSummary.py \
+        ${masterSummaryChunk} \
+        ${oraSummaryRoot} \
+        "summary/" \
+        none \
+        --batch \
+        --chunkName ${chunkName}
+    """
+}
+
+process VerticalMergeMasterSummaryPieces {
+    container 'mea_latest.sif'
+    publishDir "./masterSummaries/${pipeline}/", mode: 'copy'
+    label "process_medium"
+
+    input:
+    tuple val(pipeline), val(trait), path(mergedSummaryFiles)
+
+    output:
+    path("master_summary_*")
+
+    script:
+    """
+    printf '%s\\n' ${mergedSummaryFiles.join(' ')} > pieces.txt
+    python3 /app/scripts/verticalMerge.py pieces.txt \
+        --format ${params.masterSummaryFormat} \
+        --outputName master_summary_${trait}${params.masterSummaryFormat == "csv" ? ".csv" : ""} \
+        ${params.masterSummarySort ? "--sort" : ""}
+    """
+}
+
+process EmpiricalPvalues {
+    container 'mea_latest.sif'
+    publishDir "./empiricalPvalues/${pipeline}/", mode: 'copy'
+    label "process_medium"
+
+    input:
+    tuple val(pipeline), val(trait), path(masterSummarySlices, stageAs: "slices/?/*")
+
+    output:
+    path("empirical_pvalues_*")
+
+    script:
+    """
+    find slices/ -name 'master_summary_*' > slices.txt
+    python3 /app/scripts/empiricalPvalue.py slices.txt --outputName empirical_pvalues_${trait}.csv --numRP ${params.numRP}
+    """
+}
+
+workflow {
+    if (!params.sampleSheet) {
+        error "--sampleSheet is required (CSV with header pipeline,trait,scoreFile,numTests)"
+    }
+    samples = Channel.fromPath(params.sampleSheet)
+        .splitCsv(header: true)
+        .map { row -> [row.pipeline, row.trait, row.scoreFile, row.numTests] }
+
+    // one task parses every module file once and restricts it to the gene universe of every trait
+    moduleIndexDir = BuildModuleIndex(samples.map { sample -> sample[2] }.collect()).first()
+
+    // every (trait, chunk of permutations) pair is one task of every step
+    chunks = RandomPermutationBatch(samples)
+        .combine(Channel.of(1..params.numRP).collate(params.chunkSize).map { rps -> [rps[0], rps.join(',')] })
+    processedChunks = ProcessPascalOutputChunk(RunPascalChunk(PreProcessForPascalChunk(chunks, moduleIndexDir)))
+    if (params.empiricalPvalues) {
+        EmpiricalPvalues(processedChunks.map { chunk -> [chunk[0], chunk[1], chunk[3]] }.groupTuple(by: [0, 1])
+            .map { pipeline, trait, slices -> [pipeline, trait, slices.flatten()] })
+    }
+    mergedChunks = MergeORAsummaryAndMasterSummaryChunk(GoAnalysisChunk(processedChunks))
+    VerticalMergeMasterSummaryPieces(mergedChunks.groupTuple(by: [0, 1]).map { pipeline, trait, pieces -> [pipeline, trait, pieces.flatten()] })
+}
@@ -3,14 +3,64 @@ params.geneColName = 'markname'
 params.pvalColName = 'meta_p'
 params.moduleFileDir = "/app/data/modules/cherryPickModules/"
 params.numRP = 10000
+// true: write one permutation index matrix instead of numRP permuted CSV files
+params.rpBatch = false
+// module index cache shared by all permutations (see scripts/moduleIndex.py), opt-in: a writable directory, e.g. on
+// /scratch. Empty string (default) to rebuild the Module_ and GO_ files per permutation.
+params.moduleIndexDir = ""
+// >0: score this many permutations of the same network in one RunPascalBatch task, loading the modules once
+params.pascalBatchSize = 0
+// GO BP GMT file read by ORA_cmd.R with oraLocalDatabase
+params.goGmtFile = "/app/data/GO/geneontology_Biological_Process.gmt"
+// modules analysed in parallel per GoAnalysis task (scripts/parallelORA.py), modules per ORA_cmd.R process (0: one
+// process per network), and true to read goGmtFile instead of fetching the database from the WebGestalt server
+params.oraWorkers = 4
+params.oraBatchSize = 0
+params.oraLocalDatabase = false
+// master summary: "csv" (master_summary_<trait>.csv) or "parquet" (dataset master_summary_<trait>/ partitioned by
+// study/trait/network); optionally sorted by moduleIndex (parquet only)
+params.masterSummaryFormat = "csv"
+// format of the summary slices and ORA-merged pieces: "csv" or "parquet" (typed columns, see scripts/summaryIO.py)
+params.summaryFormat = "csv"
+params.masterSummarySort = false
+// empirical module p-values over all RP runs (scripts/empiricalPvalue.py), opt-in. observedSummary: summary CSV of the
+// unpermuted run (e.g. mea_noRP.nf); empty string to report the null statistics and per-network thresholds only
+params.empiricalPvalues = false
+params.observedSummary = ""
+// >0: chunked mode. Every task handles chunkSize permutations (all networks) from one permutation index matrix, so
+// there is one task (and work directory) per chunk and step instead of one per permutation and network. Only the
+// summaries are consolidated into one file per chunk (master_summary_chunk_<chunk>, then its ORA-merged piece): inside
+// a chunk's work directories, the GS_/GO_/Module_ files, Pascal outputs, significant modules and ORA summaries are still
+// one file per permutation and network (or module), as PascalX and ORA_cmd.R read them
+params.chunkSize = 0
+// content-addressed result cache shared between runs (see scripts/resultCache.py). Outputs of the permutation,
+// preprocessing, Pascal and summary steps found in it are restored instead of recomputed. Empty string to disable;
+// cacheMaxSize (e.g. "500G") bounds it by removing the least recently used entries
+params.cacheDir = ""
+params.cacheMaxSize = ""
+// incremental mode (requires chunkSize > 0, see scripts/incrementalRun.py): only new or changed (network, permutation)
+// pairs are run. incrementalDir keeps manifest_<trait>.json and the master summary dataset master_summary_<trait>/,
+// whose changed partitions are replaced in place. Empirical p-values are not computed in this mode
+params.incremental = false
+params.incrementalDir = "/app/data/incremental/"
 
 // FIX BELOW PARAMS BEFORE RUNNING IT -> Now, sbatch script takes "trait" and "numTests" then pass it here. 
 // pvalFilenName is made in the sbatch script, so it is REQUIRED that the gene score file's basename matches trait
+// pvalFileName may also be a gene score store (<trait>.gss, see scripts/geneScoreStore.py), read with memory maps instead of parsing the CSV
 params.pipeline = "cma"
 //params.pvalFileName = "/app/data/pvals/cma/adjTC.csv"
 //params.trait = "adjTC"
 //params.numTests = 177916
 
+def oraDatabaseArgs(option) {
+    return params.oraLocalDatabase ? "${option} ${params.goGmtFile}" : ""
+}
+
+def cacheArgs() {
+    if (!params.cacheDir) return ""
+    return "--cacheDir ${params.cacheDir}" + (params.cacheMaxSize ? " --cacheMaxSize ${params.cacheMaxSize}" : "")
+}
+
 process RandomPermutation {
     container 'mea_latest.sif'
     publishDir ".", mode: 'copy'
@@ -21,7 +71,33 @@ process RandomPermutation {
 
     script:
     """
-    python3 /app/scripts/randomPermutation.py ${params.pvalFileName} "RPscores/${params.trait}/" ${params.geneColName} ${params.numRP}
+    python3 /app/scripts/randomPermutation.py ${params.pvalFileName} "RPscores/${params.trait}/" ${params.geneColName} ${params.numRP} ${cacheArgs()}
+    """
+}
+
+process RandomPermutationBatch {
+    container 'mea_latest.sif'
+    label "process_low"
+
+    output:
+    path("RPscores/${params.trait}/*_permutations.npy")
+
+    script:
+    """
+    python3 /app/scripts/randomPermutation.py ${params.pvalFileName} "RPscores/${params.trait}/" ${params.geneColName} ${params.numRP} --batch ${cacheArgs()}
+    """
+}
+
+process BuildModuleIndex {
+    container 'mea_latest.sif'
+    label "process_low"
+
+    output:
+    val(params.moduleIndexDir)
+
+    script:
+    """
+    python3 /app/scripts/moduleIndex.py ${params.pvalFileName} ${params.moduleFileDir} ${params.moduleIndexDir} ${params.geneColName}
     """
 }
 
@@ -31,6 +107,7 @@ process PreProcessForPascal{
 
     input:
     path(geneScoreFile)
+    val(moduleIndexDir)
 
     output:
     path("pascalInput/GS_*")
@@ -46,7 +123,40 @@ process PreProcessForPascal{
         ${params.pipeline} \
         ${params.trait} \
         ${params.geneColName} \
-        ${params.pvalColName}
+        ${params.pvalColName} \
+        ${moduleIndexDir ? "--moduleIndexDir ${moduleIndexDir}" : ""} \
+        ${cacheArgs()}
+    """
+
+}
+
+process PreProcessForPascalFromIndex{
+    container 'mea_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(rpIndex), path(permutationFile)
+    val(moduleIndexDir)
+
+    output:
+    path("pascalInput/GS_*")
+    path("pascalInput/Module_*")
+    path("pascalInput/GO_*")
+
+    script:
+    """
+    python3 /app/scripts/preProcessForPascal.py \
+        ${params.pvalFileName} \
+        ${params.moduleFileDir} \
+        "pascalInput/" \
+        ${params.pipeline} \
+        ${params.trait} \
+        ${params.geneColName} \
+        ${params.pvalColName} \
+        --permutationFile ${permutationFile} \
+        --rpIndex ${rpIndex} \
+        ${moduleIndexDir ? "--moduleIndexDir ${moduleIndexDir}" : ""} \
+        ${cacheArgs()}
     """
 
 }
@@ -72,8 +182,36 @@ process RunPascal{
         ${moduleFile} \
         "pascalOutput/" \
         ${params.pipeline} \
-        ${params.trait}
-        
+        ${params.trait} \
+        ${cacheArgs()}
+    """
+}
+
+process RunPascalBatch{
+    container 'pascalx_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(network), path(geneScoreFiles), path(moduleFiles), path(goFiles)
+
+    output:
+    path("pascalOutput/*")
+    path(geneScoreFiles)
+    path(goFiles)
+
+    script:
+    // Module_ files of one network are identical across permutations, so the first one is used for the whole batch
+    """
+    printf '%s\\n' ${geneScoreFiles.join(' ')} > manifest.txt
+    python3 /app/scripts/runPascal.py \
+        manifest.txt \
+        ${moduleFiles[0]} \
+        "pascalOutput/" \
+        ${params.pipeline} \
+        ${params.trait} \
+        --batch \
+        --workers ${task.cpus} \
+        ${cacheArgs()}
     """
 }
 
@@ -98,7 +236,9 @@ process ProcessPascalOutput{
         "masterSummaryPiece/" \
         ${geneScoreFilePascalInput} \
         "significantModules/" \
-	${params.numTests}
+	${params.numTests} \
+	--summaryFormat ${params.summaryFormat} \
+	${cacheArgs()}
     """
 }
 
@@ -106,6 +246,7 @@ process GoAnalysis{
     container 'webgestalt_latest.sif'
     publishDir ".", pattern: "GO_summaries/${params.trait}/*", mode: 'copy' // copy ORA results to current location.
     label "process_low"
+    cpus params.oraWorkers
 
     input:
     path(masterSummarySlice)
@@ -118,11 +259,13 @@ process GoAnalysis{
     path(goFile)
 
     script:
+    // batches of modules run as parallel ORA_cmd.R processes (scripts/parallelORA.py), as in GoAnalysisChunk
     def oraSummaryDir = "GO_summaries/${params.trait}/GO_summaries_${goFile.baseName.split('_')[2]}_${goFile.baseName.split('_')[3]}/"
     """
-    Rscript /app/scripts/ORA_cmd.R --sigModuleDir ${sigModuleDir} --backGroundGenesFile ${goFile} \
-        --summaryRoot "${oraSummaryDir}" --reportRoot "GO_reports/"
-
+    python3 /app/scripts/parallelORA.py --sigModuleDir ${sigModuleDir} --backGroundGenesFile ${goFile} \
+        --summaryRoot "${oraSummaryDir}" --reportRoot "GO_reports/" \
+        --workers ${params.oraWorkers} --batchSize ${params.oraBatchSize} \
+        --oraScript /app/scripts/ORA_cmd.R ${oraDatabaseArgs("--goGmtFile")}
     """
 }
 
@@ -147,6 +290,138 @@ process MergeORAsummaryAndMasterSummary{
 
 }
 
+process PreProcessForPascalChunk{
+    container 'mea_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(chunkName), val(rpIndices), val(moduleFileDir), path(permutationFile)
+    val(moduleIndexDir)
+
+    output:
+    tuple val(chunkName), path("pascalInput/")
+
+    script:
+    """
+    python3 /app/scripts/preProcessForPascal.py \
+        ${params.pvalFileName} \
+        ${moduleFileDir} \
+        "pascalInput/" \
+        ${params.pipeline} \
+        ${params.trait} \
+        ${params.geneColName} \
+        ${params.pvalColName} \
+        --permutationFile ${permutationFile} \
+        --rpIndices ${rpIndices} \
+        ${moduleIndexDir ? "--moduleIndexDir ${moduleIndexDir}" : ""} \
+        ${cacheArgs()}
+    """
+}
+
+process RunPascalChunk{
+    container 'pascalx_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(chunkName), path(pascalInput)
+
+    output:
+    tuple val(chunkName), path("pascalOutput/"), path(pascalInput)
+
+    script:
+    // Module_ files with identical content (one network, many permutations) are loaded once
+    """
+    for gs in ${pascalInput}/GS_*.tsv; do
+        name=\$(basename \$gs .tsv)
+        printf '%s\\t%s\\n' \$gs ${pascalInput}/Module_\${name#GS_}.tsv
+    done > manifest.tsv
+    python3 /app/scripts/runPascal.py \
+        manifest.tsv \
+        \$(ls ${pascalInput}/Module_* | head -n 1) \
+        "pascalOutput/" \
+        ${params.pipeline} \
+        ${params.trait} \
+        --batch \
+        --workers ${task.cpus} \
+        ${cacheArgs()}
+    """
+}
+
+process ProcessPascalOutputChunk{
+    container 'mea_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(chunkName), path(pascalOutput), path(pascalInput)
+
+    output:
+    tuple val(chunkName), path("masterSummaryPiece/master_summary_chunk_*"), path("significantModules/"), path(pascalInput)
+
+    script:
+    """
+    ls ${pascalOutput}/* > pascalOutputs.txt
+    python3 /app/scripts/processPascalOutput.py \
+        pascalOutputs.txt \
+        0.05 \
+        "masterSummaryPiece/" \
+        ${pascalInput} \
+        "significantModules/" \
+        ${params.numTests} \
+        --batch \
+        --chunkName ${chunkName} \
+        --summaryFormat ${params.summaryFormat} \
+        ${cacheArgs()}
+    """
+}
+
+process GoAnalysisChunk{
+    container 'webgestalt_latest.sif'
+    publishDir ".", pattern: "GO_summaries/${params.trait}/*", mode: 'copy' // copy ORA results to current location.
+    label "process_low"
+    cpus params.oraWorkers
+
+    input:
+    tuple val(chunkName), path(masterSummaryChunk), path(sigModuleDir), path(pascalInput)
+
+    output:
+    tuple val(chunkName), path(masterSummaryChunk), path("GO_summaries/${params.trait}/")
+
+    script:
+    // batches of modules of every permutation and network run as parallel ORA_cmd.R processes (scripts/parallelORA.py).
+    // webgestalt_latest.sif is built from Dockerfile.webgestalt, which provides python3 for the (standard library only) driver
+    """
+    mkdir -p "GO_summaries/${params.trait}/"
+    for dir in ${sigModuleDir}/*/; do
+        name=\$(basename \$dir)
+        printf '%s\\t%s\\t%s\\n' \$dir ${pascalInput}/GO_\${name}.txt \
+            "GO_summaries/${params.trait}/GO_summaries_\$(echo \$name | cut -d_ -f2)_\$(echo \$name | cut -d_ -f3)/"
+    done > ora.tsv
+    python3 /app/scripts/parallelORA.py --manifest ora.tsv --workers ${params.oraWorkers} --batchSize ${params.oraBatchSize} \
+        --oraScript /app/scripts/ORA_cmd.R ${oraDatabaseArgs("--goGmtFile")}
+    """
+}
+
+process MergeORAsummaryAndMasterSummaryChunk{
+    container 'mea_latest.sif'
+    label "process_low"
+
+    input:
+    tuple val(chunkName), path(masterSummaryChunk), path(oraSummaryRoot)
+
+    output:
+    path("summary/*")
+
+    """
+    python3 /app/scripts/mergeORAandSummary.py \
+        ${masterSummaryChunk} \
+        ${oraSummaryRoot} \
+        "summary/" \
+        none \
+        --batch \
+        --chunkName ${chunkName}
+    """
+}
+
 process VerticalMergeMasterSummaryPieces {
     container 'mea_latest.sif'
     publishDir "./masterSummaries/", mode: 'copy'
@@ -156,28 +431,160 @@ process VerticalMergeMasterSummaryPieces {
     path(mergedSummaryFiles)
 
     output:
-    path("master_summary_*.csv")
+    path("master_summary_*")
 
     script:
+    // streamed in bounded chunks; parquet output is partitioned by study/trait/network
     """
-    # Use the header from the first file
-    head -n 1 \$(echo ${mergedSummaryFiles[0]}) > master_summary_${params.trait}.csv
+    printf '%s\\n' ${mergedSummaryFiles.join(' ')} > pieces.txt
+    python3 /app/scripts/verticalMerge.py pieces.txt \
+        --format ${params.masterSummaryFormat} \
+        --outputName master_summary_${params.trait}${params.masterSummaryFormat == "csv" ? ".csv" : ""} \
+        ${params.masterSummarySort ? "--sort" : ""}
+    """
+}
 
-    # Append the contents of each file excluding the header
-    for file in ${mergedSummaryFiles.join(' ')}; do
-        awk 'NR > 1' \$file >> master_summary_${params.trait}.csv
-    done
+process PlanIncrementalRun {
+    container 'mea_latest.sif'
+    label "process_low"
+    // the plan depends on the manifest left by the previous run, never reuse it
+    cache false
+
+    output:
+    path("plan/")
+
+    script:
+    """
+    python3 /app/scripts/incrementalRun.py plan \
+        ${params.pvalFileName} \
+        ${params.moduleFileDir} \
+        ${params.incrementalDir}/manifest_${params.trait}.json \
+        ${params.numRP} \
+        ${params.pipeline} \
+        "plan/" \
+        --dataset ${params.incrementalDir}/master_summary_${params.trait}
     """
 }
 
+process MergeMasterSummaryIncremental {
+    container 'mea_latest.sif'
+    label "process_medium"
 
+    input:
+    path(mergedSummaryFiles)
+    path(plan)
+
+    output:
+    path("pieces.txt")
+
+    script:
+    // replaced partitions are swapped in place, the other partitions get the new permutations appended. The part files
+    // stay hidden until the commit publishes them together with the manifest (an interrupted commit is finished by the
+    // next run, so the permutations are never appended twice)
+    """
+    printf '%s\\n' ${mergedSummaryFiles.join(' ')} > pieces.txt
+    python3 /app/scripts/verticalMerge.py pieces.txt \
+        --format parquet \
+        --outputName ${params.incrementalDir}/master_summary_${params.trait} \
+        --replaceNetworks ${plan}/replaceNetworks.txt \
+        --study ${params.pipeline} \
+        --trait ${params.trait} \
+        --stage stage.json \
+        ${params.masterSummarySort ? "--sort" : ""}
+    python3 /app/scripts/incrementalRun.py commit ${plan} ${params.incrementalDir}/manifest_${params.trait}.json --staged stage.json
+    """
+}
+
+process EmpiricalPvalues {
+    container 'mea_latest.sif'
+    publishDir "./empiricalPvalues/", mode: 'copy'
+    label "process_medium"
+
+    input:
+    // every slice is named master_summary_slice_<rpIndex>.csv (master_summary_chunk_<chunk>.csv in chunked mode, .parquet
+    // with --summaryFormat parquet),
+    // one directory per slice avoids name clashes
+    path(masterSummarySlices, stageAs: "slices/?/*")
+
+    output:
+    path("empirical_pvalues_*")
+
+    script:
+    """
+    find slices/ -name 'master_summary_*' > slices.txt
+    python3 /app/scripts/empiricalPvalue.py slices.txt \
+        --outputName empirical_pvalues_${params.trait}.csv \
+        --numRP ${params.numRP} \
+        ${params.observedSummary ? "--observed ${params.observedSummary}" : ""}
+    """
+}
 
 workflow {
     // For each module file in the module directory, preprocess the data for pascal.
-    preProcessedFiles = PreProcessForPascal(RandomPermutation()|flatten)
-    pascalOut = RunPascal(preProcessedFiles[0]|flatten, preProcessedFiles[1]|flatten, preProcessedFiles[2]|flatten)
-    processedPascalOutput = ProcessPascalOutput(pascalOut[0]|flatten, pascalOut[1]|flatten, pascalOut[2]|flatten)
-    goAnalysisOut = GoAnalysis(processedPascalOutput[0]|flatten, processedPascalOutput[1]|flatten, processedPascalOutput[2]|flatten)
-    horizontallyMergedOut = MergeORAsummaryAndMasterSummary(goAnalysisOut[0]|flatten, goAnalysisOut[1]|flatten, goAnalysisOut[2]|flatten)
-    VerticalMergeMasterSummaryPieces(horizontallyMergedOut.collect())
+    // Module_/GO_ files are built once per network and copied by every permutation
+    moduleIndexDir = params.moduleIndexDir ? BuildModuleIndex().first() : Channel.value("")
+    if (params.incremental) {
+        if (params.chunkSize <= 0) {
+            error "--incremental requires --chunkSize > 0"
+        }
+        // chunks of the planned (module directory, permutation range) groups only, named after their group
+        plan = PlanIncrementalRun()
+        chunks = plan.flatMap { dir -> dir.resolve("runs.tsv").readLines() }
+            .flatMap { line ->
+                def (moduleDir, first, last) = line.split('\t')
+                def group = new File(moduleDir).name - "Modules"
+                (first.toInteger()..last.toInteger()).collate(params.chunkSize)
+                    .collect { rps -> ["${group}${rps[0]}", rps.join(','), moduleDir] }
+            }
+            .combine(RandomPermutationBatch())
+        processedChunks = ProcessPascalOutputChunk(RunPascalChunk(PreProcessForPascalChunk(chunks, moduleIndexDir)))
+        MergeMasterSummaryIncremental(MergeORAsummaryAndMasterSummaryChunk(GoAnalysisChunk(processedChunks)).collect().ifEmpty([]), plan)
+    } else if (params.chunkSize > 0) {
+        // chunked mode: one task per chunk of permutations for every step, one summary file per chunk (the intermediate
+        // files of a chunk stay per permutation and network, see params.chunkSize)
+        chunks = Channel.of(1..params.numRP)
+            .collate(params.chunkSize)
+            .map { rps -> [rps[0], rps.join(','), params.moduleFileDir] }
+            .combine(RandomPermutationBatch())
+        processedChunks = ProcessPascalOutputChunk(RunPascalChunk(PreProcessForPascalChunk(chunks, moduleIndexDir)))
+        if (params.empiricalPvalues) {
+            EmpiricalPvalues(processedChunks.map { chunk -> chunk[1] }.collect())
+        }
+        VerticalMergeMasterSummaryPieces(MergeORAsummaryAndMasterSummaryChunk(GoAnalysisChunk(processedChunks)).collect())
+    } else {
+        if (params.rpBatch) {
+            preProcessedFiles = PreProcessForPascalFromIndex(Channel.of(1..params.numRP).combine(RandomPermutationBatch()), moduleIndexDir)
+        } else {
+            preProcessedFiles = PreProcessForPascal(RandomPermutation()|flatten, moduleIndexDir)
+        }
+        if (params.pascalBatchSize > 0) {
+            // key every file by "pipeline_trait_network" and group permutations of the same network into batches
+            gsFiles = preProcessedFiles[0].flatten().map { f -> [f.baseName - ~/^GS_/, f] }
+            moduleFiles = preProcessedFiles[1].flatten().map { f -> [f.baseName - ~/^Module_/, f] }
+            goFiles = preProcessedFiles[2].flatten().map { f -> [f.baseName - ~/^GO_/, f] }
+            batches = gsFiles.join(moduleFiles).join(goFiles)
+                .map { key, gs, module, go -> [key.split('_')[2], gs, module, go] }
+                .groupTuple(size: params.pascalBatchSize, remainder: true)
+            batchOut = RunPascalBatch(batches)
+            // re-align pascal outputs with their GS_/GO_ files, which a batch emits in a different order
+            aligned = batchOut[0].flatten().map { f -> [f.baseName, f] }
+                .join(batchOut[1].flatten().map { f -> [f.baseName - ~/^GS_/, f] })
+                .join(batchOut[2].flatten().map { f -> [f.baseName - ~/^GO_/, f] })
+                .multiMap { key, out, gs, go ->
+                    out: out
+                    gs: gs
+                    go: go
+                }
+            pascalOut = [aligned.out, aligned.gs, aligned.go]
+        } else {
+            pascalOut = RunPascal(preProcessedFiles[0]|flatten, preProcessedFiles[1]|flatten, preProcessedFiles[2]|flatten)
+        }
+        processedPascalOutput = ProcessPascalOutput(pascalOut[0]|flatten, pascalOut[1]|flatten, pascalOut[2]|flatten)
+        if (params.empiricalPvalues) {
+            EmpiricalPvalues(processedPascalOutput[0].flatten().collect())
+        }
+        goAnalysisOut = GoAnalysis(processedPascalOutput[0]|flatten, processedPascalOutput[1]|flatten, processedPascalOutput[2]|flatten)
+        horizontallyMergedOut = MergeORAsummaryAndMasterSummary(goAnalysisOut[0]|flatten, goAnalysisOut[1]|flatten, goAnalysisOut[2]|flatten)
+        VerticalMergeMasterSummaryPieces(horizontallyMergedOut.collect())
+    }
 }
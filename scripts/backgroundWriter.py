@@ -0,0 +1,156 @@
+import argparse
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+"""
+Background writer for the many small output files of preProcessForPascal.py and processPascalOutput.py.
+
+On the shared filesystem every open, write and close of a small file is a round trip to the file server, so writing
+the significant modules (one file per module) or the GS_/GO_/Module_ files inline stalls the parsing. A BackgroundWriter
+collects the files in batches of batchFiles files and writes every batch on a thread pool while the script goes on
+computing. At most maxPending batches are queued; a script that outruns the pool waits for a free slot, which bounds
+the memory held by queued contents.
+
+Every file is written to a hidden temporary file (.<name>.tmp-<uuid>) in its directory and renamed to its name when
+complete, so a partially written file is never seen under its final name (e.g. by GoAnalysis). flush() is the barrier
+at the end of a task: it waits for every queued file and raises the first write error. By default (workers=0, no
+fsync) files are written inline and left to the page cache, as the scripts always did; the thread pool (--writeWorkers)
+and the fsync of the written files and their directories at flush (--fsync) are opt-in.
+"""
+
+def atomicWrite(OUTPUTPATH:str, data) -> str:
+    """
+    Write data (str or bytes) to OUTPUTPATH through a temporary file in the same directory.
+
+    Returns:
+        str: OUTPUTPATH
+    """
+    directory, name = os.path.split(OUTPUTPATH)
+    tmpPath = os.path.join(directory, f".{name}.tmp-{uuid.uuid4().hex}")
+    try:
+        with open(tmpPath, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        os.replace(tmpPath, OUTPUTPATH)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+    return OUTPUTPATH
+
+def atomicCopy(SOURCEPATH:str, OUTPUTPATH:str) -> str:
+    directory, name = os.path.split(OUTPUTPATH)
+    tmpPath = os.path.join(directory, f".{name}.tmp-{uuid.uuid4().hex}")
+    try:
+        shutil.copyfile(SOURCEPATH, tmpPath)
+        os.replace(tmpPath, OUTPUTPATH)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+    return OUTPUTPATH
+
+def fsyncPath(PATH:str) -> None:
+    # files and directories alike; a directory is synced so that the renames into it are durable
+    fd = os.open(PATH, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class BackgroundWriter:
+    """
+    Args:
+        workers (int): writer threads, 0 to write inline
+        batchFiles (int): files written by one task of the pool
+        maxPending (int): batches queued before write calls wait
+        fsync (bool): make the written files durable at every flush
+    """
+    def __init__(self, workers:int = 0, batchFiles:int = 64, maxPending:int = 64, fsync:bool = False):
+        self.batchFiles = max(1, batchFiles)
+        self.fsync = fsync
+        self.pool = ThreadPoolExecutor(workers) if workers > 0 else None
+        self.slots = threading.BoundedSemaphore(maxPending)
+        self.batch = []
+        self.futures = []
+        self.written = []
+        self.unsynced = []
+
+    def writeText(self, OUTPUTPATH:str, data) -> None:
+        self._add(("write", OUTPUTPATH, data))
+
+    def copyFile(self, SOURCEPATH:str, OUTPUTPATH:str) -> None:
+        self._add(("copy", OUTPUTPATH, SOURCEPATH))
+
+    def addWritten(self, OUTPUTPATH:str) -> None:
+        # a file written by the script itself, synced with the others by the next flush
+        self.written.append(OUTPUTPATH)
+
+    def _add(self, job:Tuple[str, str, object]) -> None:
+        self.batch.append(job)
+        if len(self.batch) >= self.batchFiles:
+            self._submit()
+
+    def _submit(self) -> None:
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        if self.pool is None:
+            self.written.extend(self._writeBatch(batch))
+            return
+        self.slots.acquire()
+        future = self.pool.submit(self._writeBatch, batch)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    @staticmethod
+    def _writeBatch(batch:List[Tuple[str, str, object]]) -> List[str]:
+        return [atomicWrite(path, data) if kind == "write" else atomicCopy(data, path) for kind, path, data in batch]
+
+    def flush(self, fsync:bool = None) -> List[str]:
+        """
+        Wait for every queued file and, with fsync, make the written files durable.
+
+        Args:
+            fsync (bool): None for the fsync setting of the writer. False to only wait; the files are then synced by
+                the next flush with fsync
+
+        Returns:
+            List[str]: paths written since the last flush
+        """
+        fsync = self.fsync if fsync is None else fsync
+        self._submit()
+        futures, self.futures = self.futures, []
+        # every batch finishes before the first failure is raised
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+        written = self.written + [path for future in futures for path in future.result()]
+        self.written = []
+        if self.fsync:
+            self.unsynced.extend(written)
+        if fsync and self.unsynced:
+            directories = sorted(set(os.path.dirname(os.path.abspath(path)) for path in self.unsynced))
+            if self.pool is None:
+                for path in self.unsynced + directories:
+                    fsyncPath(path)
+            else:
+                list(self.pool.map(fsyncPath, self.unsynced))
+                list(self.pool.map(fsyncPath, directories))
+            self.unsynced = []
+        return written
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+
+def addWriterArguments(parser:argparse.ArgumentParser) -> None:
+    parser.add_argument("--writeWorkers", type=int, default=0, help="threads writing the output files in the background (see backgroundWriter.py), 0 (default) to write inline")
+    parser.add_argument("--fsync", action="store_true", help="fsync the output files and their directories at the end of the task")
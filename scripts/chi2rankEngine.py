@@ -0,0 +1,178 @@
+import argparse
+import os
+from typing import List, Tuple
+
+import numpy as np
+from scipy import sparse
+from scipy.stats import chi2, rankdata
+
+from geneScoreStore import readGeneScores
+from moduleIndex import ModuleIndex, loadOrBuildModuleIndex
+from pascalResultIO import PascalResult, STRUCTURED_SUFFIX
+from profiling import phase, profiled
+
+"""
+Vectorized chi2rank module scoring of many random permutations (RP) at once.
+
+PascalX chi2rank (fuse=False) scores a module by
+    1. ranking the p-values of all N scored genes, u = rank / (N + 1) (rank 1 = smallest p-value),
+    2. transforming every gene to x = chi2.isf(u, 1),
+    3. summing x over the genes of the module with a score, module p-value = chi2.sf(sum, number of genes).
+A permutation only shuffles the gene-name column of the score file, so the sorted x values are identical in every RP
+run and only their assignment to genes changes. With X the (permutations x genes) matrix of x values and
+M the sparse (genes x modules) membership matrix, every module statistic of every permutation is X @ M, computed here in
+blocks of permutations so that memory is bounded by blockSize x genes.
+
+Tied gene p-values share their average rank (scipy.stats.rankdata), as in PascalX, so u does not depend on the order
+of the score file. The per-gene p-values of the results written with --outputFormat npz are u, as in the chi2rank
+result. Unlike PascalX, which keeps one score per gene name, a score file with duplicated gene names ranks every row.
+
+Usage:
+python3 chi2rankEngine.py scoreFile moduleFile permutationFile outputPath pipelineName traitName geneNameCol pvalCol
+"""
+
+def rankChi2(pvals:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rank-based chi2 transform of a gene p-value vector.
+
+    Returns:
+        np.ndarray, np.ndarray: uniform p-values u and chi2 scores x (1 degree of freedom), aligned with pvals
+    """
+    uniform = rankdata(pvals, method="average") / (len(pvals) + 1)
+    return uniform, chi2.isf(uniform, 1)
+
+def moduleMembership(index:ModuleIndex, genes:List[str]) -> sparse.csc_matrix:
+    """
+    Sparse (genes x modules) membership of the module genes with a score. A gene is a row of the score file;
+    a gene name that appears more than once is taken from its last row.
+    """
+    geneToRow = {gene: row for row, gene in enumerate(genes)}
+    rowOfGene = np.array([geneToRow.get(gene, -1) for gene in index.geneNames.tolist()], dtype=np.int64)
+    rows = rowOfGene[index.indices]
+    cols = np.repeat(np.arange(len(index.moduleIds)), np.diff(index.indptr))
+    scored = rows >= 0
+    membership = sparse.csc_matrix((np.ones(int(scored.sum())), (rows[scored], cols[scored])),
+                                   shape=(len(genes), len(index.moduleIds)))
+    # a gene listed twice in a module counts once
+    membership.data[:] = 1.0
+    return membership
+
+def permutedScores(values:np.ndarray, permutations:np.ndarray) -> np.ndarray:
+    """
+    (permutations x genes) matrix of per-gene values for every permutation.
+
+    Permutation k gives row i of the score file the gene of row permutations[k, i] (see randomPermutation.py),
+    so the gene of row permutations[k, i] gets values[i].
+    """
+    matrix = np.empty(permutations.shape, dtype=values.dtype)
+    np.put_along_axis(matrix, permutations.astype(np.int64), np.broadcast_to(values, permutations.shape), axis=1)
+    return matrix
+
+def scoreModules(chi2Matrix:np.ndarray, membership:sparse.csc_matrix) -> np.ndarray:
+    """
+    chi2rank module p-values of every row of chi2Matrix.
+
+    Args:
+        chi2Matrix (np.ndarray): (permutations x genes) rank-transformed chi2 scores
+        membership (sparse.csc_matrix): (genes x modules) membership from moduleMembership
+
+    Returns:
+        np.ndarray: (permutations x modules) module p-values, nan for modules without any scored gene
+    """
+    sizes = np.diff(membership.indptr)
+    statistics = np.asarray((membership.T @ chi2Matrix.T).T)
+    with np.errstate(invalid="ignore"):
+        pvals = chi2.sf(statistics, sizes[None, :])
+    pvals[:, sizes == 0] = np.nan
+    return pvals
+
+def scorePermutations(pvals:np.ndarray, permutations:np.ndarray, membership:sparse.csc_matrix,
+                      blockSize:int = 32) -> np.ndarray:
+    """
+    Module p-values of every permutation, blockSize permutations per sparse product.
+
+    Args:
+        pvals (np.ndarray): gene p-values in score file order
+        permutations (np.ndarray): (numRP x genes) permutation matrix (may be a memmap)
+        membership (sparse.csc_matrix): (genes x modules) membership from moduleMembership
+        blockSize (int): number of permutations scored per product
+
+    Returns:
+        np.ndarray: (numRP x modules) module p-values
+    """
+    _, x = rankChi2(pvals)
+    result = np.empty((len(permutations), membership.shape[1]), dtype=np.float64)
+    for start in range(0, len(permutations), blockSize):
+        stop = min(start + blockSize, len(permutations))
+        result[start:stop] = scoreModules(permutedScores(x, np.asarray(permutations[start:stop])), membership)
+    return result
+
+def pascalResultOfPermutation(index:ModuleIndex, membership:sparse.csc_matrix, genes:np.ndarray, uniform:np.ndarray,
+                              modulePvals:np.ndarray) -> PascalResult:
+    # same fields as the runPascal.py result of one permutation; module genes are in score file order
+    moduleGenes, geneIds = np.unique(membership.indices, return_inverse=True)
+    return PascalResult(index.moduleIds.astype(np.int64), modulePvals, membership.indptr.astype(np.int64),
+                        geneIds.astype(np.int32), genes[moduleGenes], uniform[membership.indices])
+
+@profiled("main")
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Score the modules of one network for many permutations at once.")
+
+    # Add arguments to parser
+    parser.add_argument("scoreFile", help="Path to the (unpermuted) scoreFile (CSV or gene score store).")
+    parser.add_argument("moduleFile", help="Path to the module file of the network.")
+    parser.add_argument("permutationFile", help="Permutation matrix written by randomPermutation.py --batch.")
+    parser.add_argument("outputPath", help="Path to the output directory.")
+    parser.add_argument("pipelineName", help="Name of the pipeline.")
+    parser.add_argument("traitName", help="Name of the trait.")
+    parser.add_argument("geneNameCol", help="Name of the column for gene name in the score file.")
+    parser.add_argument("pvalCol", help="Name of the column for the p-value in the score file.")
+    parser.add_argument("--rpStart", type=int, default=1, help="first RP index (seed) to score")
+    parser.add_argument("--rpStop", type=int, help="last RP index (seed) to score. Default: all permutations")
+    parser.add_argument("--blockSize", type=int, default=32, help="permutations per sparse product")
+    parser.add_argument("--outputFormat", choices=["matrix", "npz"], default="matrix",
+                        help="matrix: one npz with the (RP x modules) p-values. npz: one runPascal.py result per RP.")
+    parser.add_argument("--moduleIndexDir", help="Module index cache (see moduleIndex.py).")
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if not os.path.exists(args.outputPath):
+        os.makedirs(args.outputPath)
+
+    with phase("read", file=args.scoreFile):
+        genes, pvals = readGeneScores(args.scoreFile, args.geneNameCol, args.pvalCol)
+    with phase("loadModules", file=args.moduleFile):
+        if args.moduleIndexDir:
+            index, _ = loadOrBuildModuleIndex(args.moduleFile, args.moduleIndexDir)
+        else:
+            with open(args.moduleFile, "r") as f:
+                index = ModuleIndex.fromModuleLines([line.split() for line in f])
+        membership = moduleMembership(index, genes.tolist())
+
+    permutations = np.load(args.permutationFile, mmap_mode="r")
+    rpStop = args.rpStop or len(permutations)
+    rpIndices = np.arange(args.rpStart, rpStop + 1)
+    with phase("score", file=args.moduleFile):
+        modulePvals = scorePermutations(pvals, permutations[args.rpStart - 1:rpStop], membership, args.blockSize)
+
+    network = os.path.splitext(os.path.basename(args.moduleFile))[0]
+    if args.outputFormat == "matrix":
+        with phase("write", file=args.moduleFile):
+            np.savez(os.path.join(args.outputPath, f"{args.pipelineName}_{args.traitName}_{network}_chi2rank{STRUCTURED_SUFFIX}"),
+                     moduleIndex=index.moduleIds.astype(np.int64), rpIndex=rpIndices, modulePval=modulePvals)
+        return
+    uniform, _ = rankChi2(pvals)
+    with phase("write", file=args.moduleFile):
+        for k, rpIndex in enumerate(rpIndices):
+            permutation = np.asarray(permutations[rpIndex - 1])
+            result = pascalResultOfPermutation(index, membership, genes, permutedScores(uniform, permutation[None, :])[0],
+                                               modulePvals[k])
+            np.savez(os.path.join(args.outputPath, f"{args.pipelineName}_{rpIndex}-{args.traitName}_{network}{STRUCTURED_SUFFIX}"),
+                     moduleIndex=result.moduleIndex, modulePval=result.modulePval, geneOffsets=result.geneOffsets,
+                     geneIds=result.geneIds, geneNames=result.geneNames, genePvals=result.genePvals)
+
+
+if __name__ == "__main__":
+    main()
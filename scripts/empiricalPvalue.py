@@ -0,0 +1,290 @@
+import argparse
+import heapq
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from profiling import phase, profiled
+from summaryIO import iterSummaryChunks
+from verticalMerge import splitTrait
+
+"""
+Empirical module p-values from the random permutation (RP) runs.
+
+Every master_summary_slice_* holds the Pascal p-value of every module of one network for one RP run (rpIndex is the
+prefix of the trait, "12-fhshdl"). The slices are streamed in chunks and folded into per-module accumulators, so
+memory is O(modules) whatever numRP is:
+
+    numPermutations       number of RP runs in which the module was scored
+    nullMinPval           smallest null p-value
+    nullMean/SdLog10Pval  mean and standard deviation of -log10(null p-value)
+    numNullAsSmall        number of RP runs with a null p-value <= the observed p-value
+
+The observed p-values (unpermuted run, rpIndex 0 or no RP index, e.g. the master summary of mea_noRP.nf) are read first
+with --observed. Rows of the observed run found among the slices are not part of the null and are skipped.
+
+    empiricalPval = (1 + numNullAsSmall) / (1 + numPermutations)
+    fwerPval      = (1 + #RP runs whose smallest module p-value of the network is <= the observed p) / (1 + #RP runs)
+
+The family of fwerPval is every module of one network (one slice). The rows of one (network, RP run) are contiguous
+in the pieces (a slice, or one pascal output of a chunk summary), so the smallest p-value of a run is known when the
+stream moves on to the next run; it is then counted against the sorted observed p-values of the network (one count per
+module) and dropped. The alpha quantile of these minima is written per network as the family-wise p-value threshold;
+with --numRP only the floor(alpha * (numRP - 1)) + 1 smallest minima of every network are kept for it.
+
+Usage:
+python3 empiricalPvalue.py paths_file --observed master_summary_0.csv --outputName empirical_pvalues_<trait>.csv [--numRP 1000]
+"""
+
+KEY_COLUMNS = ["study", "trait", "network", "moduleIndex"]
+FAMILY_COLUMNS = ["study", "trait", "network", "rpIndex"]
+
+def iterModulePvals(file_paths:List[str], chunkRows:int) -> Iterator[pd.DataFrame]:
+    """
+    Yield study, trait (without RP index), rpIndex, network, moduleIndex and modulePval of every piece in chunks of
+    at most chunkRows rows. Modules without a p-value are dropped.
+    """
+    for file_path in file_paths:
+        # only these columns are decoded from Parquet summaries
+        for chunk in iterSummaryChunks(file_path, chunkRows, KEY_COLUMNS + ["modulePval"],
+                                       dtype={"study":str, "trait":str, "network":str}):
+            chunk = chunk[chunk["modulePval"].notna()]
+            if len(chunk) == 0:
+                continue
+            split = {trait: splitTrait(trait) for trait in chunk["trait"].unique()}
+            chunk = chunk.assign(rpIndex=chunk["trait"].map(lambda trait: split[trait][0]),
+                                 trait=chunk["trait"].map(lambda trait: split[trait][1]))
+            yield chunk
+
+def isObservedRun(rpIndex:pd.Series) -> pd.Series:
+    return rpIndex.isna() | (rpIndex == 0)
+
+class NetworkMinima:
+    """
+    Smallest null p-values of the RP runs of one network, folded in run by run.
+
+    Args:
+        positions (np.ndarray): accumulator positions of the modules of the network with an observed p-value
+        observed (np.ndarray): their observed p-values
+        keep (int): number of smallest minima kept for the threshold, None to keep every minimum
+    """
+    def __init__(self, positions:np.ndarray, observed:np.ndarray, keep:int = None):
+        order = np.argsort(observed, kind="stable")
+        self.positions = positions[order]
+        self.sortedObserved = observed[order]
+        # numAsSmall[j] - numAsSmall[j-1]: runs whose minimum falls between sortedObserved[j-1] and sortedObserved[j]
+        self.numAsSmallSteps = np.zeros(len(observed) + 1, dtype=np.int64)
+        self.numRuns = 0
+        self.keep = keep
+        # negated max-heap of the keep smallest minima, or every minimum
+        self.minima = []
+        self.seenRuns = bytearray()
+
+    def add(self, rpIndex:int, minPval:float) -> None:
+        if rpIndex >= len(self.seenRuns):
+            self.seenRuns.extend(bytes(max(rpIndex + 1, 2 * len(self.seenRuns)) - len(self.seenRuns)))
+        if self.seenRuns[rpIndex]:
+            raise ValueError(f"rows of RP run {rpIndex} are not contiguous in the pieces")
+        self.seenRuns[rpIndex] = 1
+        self.numRuns += 1
+        # the run counts for every observed p-value >= its minimum
+        self.numAsSmallSteps[np.searchsorted(self.sortedObserved, minPval, side="left")] += 1
+        if self.keep is None:
+            self.minima.append(minPval)
+        elif len(self.minima) < self.keep:
+            heapq.heappush(self.minima, -minPval)
+        elif minPval < -self.minima[0]:
+            heapq.heapreplace(self.minima, -minPval)
+
+    def numAsSmall(self) -> np.ndarray:
+        # runs whose minimum is <= the observed p-value, for self.positions
+        return np.cumsum(self.numAsSmallSteps[:-1])
+
+    def threshold(self, alpha:float) -> float:
+        # np.quantile(minima, alpha, method="lower") from the kept smallest minima
+        index = int(np.floor(alpha * (self.numRuns - 1)))
+        minima = sorted(self.minima) if self.keep is None else sorted(-value for value in self.minima)
+        if index >= len(minima):
+            raise ValueError(f"{self.numRuns} RP runs, more than --numRP")
+        return minima[index]
+
+class EmpiricalAccumulator:
+    """
+    Online null statistics of every (study, trait, network, moduleIndex).
+
+    Args:
+        keepMinima (int): smallest RP run minima kept per network for the thresholds, None to keep all of them
+    """
+    def __init__(self, keepMinima:int = None):
+        self.positions = {}
+        self.keys = []
+        self.observed = np.empty(0)
+        self.numPermutations = np.empty(0, dtype=np.int64)
+        self.numNullAsSmall = np.empty(0, dtype=np.int64)
+        self.nullMinPval = np.empty(0)
+        self.sumLog10 = np.empty(0)
+        self.sumSqLog10 = np.empty(0)
+        self.keepMinima = keepMinima
+        # (study, trait, network) -> NetworkMinima, created when the first RP run of the network is complete
+        self.networks = {}
+        # smallest p-value of the (study, trait, network, rpIndex) runs whose rows may continue in the next chunk
+        self.openFamilies = {}
+        self.observedByNetwork = None
+
+    def _grow(self, size:int) -> None:
+        capacity = len(self.observed)
+        if size <= capacity:
+            return
+        extra = max(size, 2 * capacity) - capacity
+        self.observed = np.concatenate([self.observed, np.full(extra, np.nan)])
+        self.numPermutations = np.concatenate([self.numPermutations, np.zeros(extra, dtype=np.int64)])
+        self.numNullAsSmall = np.concatenate([self.numNullAsSmall, np.zeros(extra, dtype=np.int64)])
+        self.nullMinPval = np.concatenate([self.nullMinPval, np.full(extra, np.inf)])
+        self.sumLog10 = np.concatenate([self.sumLog10, np.zeros(extra)])
+        self.sumSqLog10 = np.concatenate([self.sumSqLog10, np.zeros(extra)])
+
+    def lookup(self, chunk:pd.DataFrame) -> np.ndarray:
+        positions = self.positions
+        keys = self.keys
+        result = np.empty(len(chunk), dtype=np.int64)
+        for i, key in enumerate(zip(chunk["study"], chunk["trait"], chunk["network"], chunk["moduleIndex"].tolist())):
+            position = positions.get(key)
+            if position is None:
+                position = positions[key] = len(keys)
+                keys.append(key)
+            result[i] = position
+        self._grow(len(keys))
+        return result
+
+    def addObserved(self, chunk:pd.DataFrame) -> None:
+        positions = self.lookup(chunk)
+        self.observed[positions] = chunk["modulePval"].to_numpy(dtype=np.float64)
+
+    def addNull(self, chunk:pd.DataFrame) -> None:
+        positions = self.lookup(chunk)
+        pvals = chunk["modulePval"].to_numpy(dtype=np.float64)
+        log10 = -np.log10(np.maximum(pvals, np.finfo(np.float64).tiny))
+        np.add.at(self.numPermutations, positions, 1)
+        np.add.at(self.numNullAsSmall, positions, pvals <= self.observed[positions])
+        np.minimum.at(self.nullMinPval, positions, pvals)
+        np.add.at(self.sumLog10, positions, log10)
+        np.add.at(self.sumSqLog10, positions, log10 * log10)
+        familyMinPvals = list(chunk.groupby(FAMILY_COLUMNS, sort=False)["modulePval"].min().items())
+        # a run of the previous chunk that does not continue here is complete; so is every run of this chunk but the last
+        previous, self.openFamilies = self.openFamilies, {}
+        for family, minPval in familyMinPvals:
+            self.openFamilies[family] = min(minPval, previous.pop(family, np.inf))
+        for family, minPval in previous.items():
+            self.foldFamily(family, minPval)
+        for family, _ in familyMinPvals[:-1]:
+            self.foldFamily(family, self.openFamilies.pop(family))
+
+    def foldFamily(self, family:Tuple[str, str, str, int], minPval:float) -> None:
+        study, trait, network, rpIndex = family
+        if self.observedByNetwork is None:
+            # the observed p-values are all read before the first null row
+            n = len(self.keys)
+            observed = self.observed[:n]
+            hasObserved = np.flatnonzero(~np.isnan(observed))
+            self.observedByNetwork = {}
+            for position in hasObserved.tolist():
+                self.observedByNetwork.setdefault(self.keys[position][:3], []).append(position)
+        if (study, trait, network) not in self.networks:
+            positions = np.array(self.observedByNetwork.get((study, trait, network), []), dtype=np.int64)
+            self.networks[(study, trait, network)] = NetworkMinima(positions, self.observed[positions], self.keepMinima)
+        self.networks[(study, trait, network)].add(int(rpIndex), minPval)
+
+    def finish(self) -> None:
+        for family, minPval in self.openFamilies.items():
+            self.foldFamily(family, minPval)
+        self.openFamilies = {}
+
+    def moduleSummary(self) -> pd.DataFrame:
+        n = len(self.keys)
+        numPermutations = self.numPermutations[:n]
+        observed = self.observed[:n]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = self.sumLog10[:n] / numPermutations
+            variance = (self.sumSqLog10[:n] - numPermutations * mean * mean) / (numPermutations - 1)
+        df = pd.DataFrame(self.keys, columns=KEY_COLUMNS)
+        df["observedPval"] = observed
+        df["numPermutations"] = numPermutations
+        df["numNullAsSmall"] = pd.array(self.numNullAsSmall[:n], dtype="Int64")
+        df.loc[np.isnan(observed), "numNullAsSmall"] = pd.NA
+        df["empiricalPval"] = np.where(np.isnan(observed) | (numPermutations == 0), np.nan,
+                                       (1 + self.numNullAsSmall[:n]) / (1 + numPermutations))
+        fwer = np.full(n, np.nan)
+        for minima in self.networks.values():
+            fwer[minima.positions] = (1 + minima.numAsSmall()) / (1 + minima.numRuns)
+        df["fwerPval"] = fwer
+        df["nullMinPval"] = np.where(numPermutations > 0, self.nullMinPval[:n], np.nan)
+        df["nullMeanLog10Pval"] = mean
+        df["nullSdLog10Pval"] = np.sqrt(np.maximum(variance, 0))
+        return df.sort_values(KEY_COLUMNS, kind="stable").reset_index(drop=True)
+
+    def networkThresholds(self, alpha:float) -> pd.DataFrame:
+        rows = [[*network, minima.numRuns, minima.threshold(alpha)] for network, minima in sorted(self.networks.items())]
+        return pd.DataFrame(rows, columns=["study", "trait", "network", "numPermutations", "fwerPvalThreshold"])
+
+def empiricalPvalues(file_paths:List[str], observed_paths:List[str], alpha:float = 0.05,
+                     chunkRows:int = 100000, numRP:int = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Stream the RP summary pieces once and compute empirical and family-wise p-values of every module.
+
+    Args:
+        file_paths (List[str]): master_summary_slice_* (or merged summary) CSVs of the RP runs
+        observed_paths (List[str]): summary CSVs of the unpermuted run, may be empty
+        alpha (float): family-wise error rate of the per-network p-value thresholds
+        chunkRows (int): maximum number of rows read at once
+        numRP (int): upper bound of the number of RP runs of a network, bounds the minima kept for the thresholds
+
+    Returns:
+        pd.DataFrame, pd.DataFrame: per-module statistics, per-network family-wise p-value thresholds
+    """
+    accumulator = EmpiricalAccumulator(None if numRP is None else int(np.floor(alpha * (numRP - 1))) + 1)
+    for chunk in iterModulePvals(observed_paths, chunkRows):
+        accumulator.addObserved(chunk)
+    skipped = 0
+    for chunk in iterModulePvals(file_paths, chunkRows):
+        observedRun = isObservedRun(chunk["rpIndex"])
+        skipped += int(observedRun.sum())
+        if observedRun.any():
+            chunk = chunk[~observedRun]
+        if len(chunk) > 0:
+            accumulator.addNull(chunk)
+    accumulator.finish()
+    if skipped:
+        print(f"skipped {skipped} rows of the unpermuted run")
+    return accumulator.moduleSummary(), accumulator.networkThresholds(alpha)
+
+@profiled("main")
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Empirical module p-values from the random permutation runs.")
+
+    # Add arguments to parser
+    parser.add_argument("paths_file", help="File containing paths to the master_summary_slice_* files of the RP runs")
+    parser.add_argument("--observed", nargs="*", default=[], help="summary file(s) of the unpermuted run")
+    parser.add_argument("--outputName", default="empirical_pvalues.csv", help="per-module output CSV")
+    parser.add_argument("--thresholdsName", help="per-network threshold CSV. Default: <outputName>_thresholds.csv")
+    parser.add_argument("--alpha", type=float, default=0.05, help="family-wise error rate of the per-network thresholds")
+    parser.add_argument("--chunkRows", type=int, default=100000, help="maximum number of rows read at once")
+    parser.add_argument("--numRP", type=int, help="number of RP runs; only the RP run minima needed for the thresholds are kept")
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    with open(args.paths_file, "r") as f:
+        file_paths = [line.strip() for line in f if line.strip()]
+    print(f"accumulating {len(file_paths)} pieces")
+
+    with phase("accumulate"):
+        modules, thresholds = empiricalPvalues(file_paths, args.observed, args.alpha, args.chunkRows, args.numRP)
+    with phase("write"):
+        modules.to_csv(args.outputName, index=False, na_rep="NA")
+        thresholds.to_csv(args.thresholdsName or args.outputName.replace(".csv", "") + "_thresholds.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
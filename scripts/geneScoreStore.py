@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+"""
+Compact binary gene score store, read with numpy memory maps instead of parsing the score CSV in every task.
+
+    <name>.gss/meta.json    gene and p-value column names of the source file, number of genes, source file name
+    <name>.gss/genes.npy    gene symbols (fixed-width unicode), in score file order
+    <name>.gss/pvals.npy    float64 p-values, aligned with genes.npy
+
+Permutations are the uint32 (numRP x genes) matrix written by randomPermutation.py --batch; row k-1 is the permutation of
+seed k, so the permuted gene column of RP k is a gather genes[permutation[k-1]], without any parsing.
+Readers that only need some genes (readGeneScores, readProcessedGeneScores) get the memory maps and gather the genes they
+select; toDataFrame materializes every gene name, for the scripts that work on the whole score table.
+The p-values are the ones pandas parses from the source CSV, so every output written from a store is identical to the
+output written from the CSV.
+
+Every script that reads a gene score file (randomPermutation.py, preProcessForPascal.py, moduleIndex.py,
+chi2rankEngine.py) and the processed GS_ files (runPascal.py, processPascalOutput.py) accepts either a CSV/TSV or a store.
+PascalX only loads text score files, so runPascal.py writes the GS_ text of a store to a temporary file for it.
+
+Usage:
+python3 geneScoreStore.py scores.csv scores.gss --geneNameCol markname --pvalCol meta_p
+python3 geneScoreStore.py GS_<study>_<trait>_<network>.tsv GS_<study>_<trait>_<network>.gss --processed
+"""
+
+STORE_SUFFIX = ".gss"
+META = "meta.json"
+
+def isGeneScoreStore(SCOREPATH:str) -> bool:
+    return os.path.isfile(os.path.join(SCOREPATH, META))
+
+class GeneScoreStore:
+    """
+    Memory-mapped gene score store.
+
+    Args:
+        STOREPATH (str): path to the <name>.gss directory
+    """
+    def __init__(self, STOREPATH:str):
+        with open(os.path.join(STOREPATH, META), "r") as f:
+            self.meta = json.load(f)
+        self.genes = np.load(os.path.join(STOREPATH, "genes.npy"), mmap_mode="r")
+        self.pvals = np.load(os.path.join(STOREPATH, "pvals.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.pvals)
+
+    def toDataFrame(self, geneNameCol:str = None, pvalCol:str = None) -> pd.DataFrame:
+        """
+        Gene score table with the columns of the source file (or the given names), as pd.read_csv of it would return it.
+        The gene names are copied into an object column; the p-values stay a view of the memory map.
+        """
+        return pd.DataFrame({geneNameCol or self.meta["geneNameCol"]: self.genes.astype(object),
+                             pvalCol or self.meta["pvalCol"]: np.asarray(self.pvals)})
+
+def writeGeneScoreStore(df:pd.DataFrame, STOREPATH:str, geneNameCol:str, pvalCol:str, source:str = None) -> None:
+    """
+    Write a store from a gene score table. The store is built in a temporary directory and renamed into place.
+    """
+    genes = np.array(df[geneNameCol].astype(str).tolist(), dtype=str)
+    pvals = df[pvalCol].to_numpy(dtype=np.float64)
+    parent = os.path.dirname(os.path.abspath(STOREPATH))
+    tmpDir = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+    try:
+        np.save(os.path.join(tmpDir, "genes.npy"), genes)
+        np.save(os.path.join(tmpDir, "pvals.npy"), pvals)
+        with open(os.path.join(tmpDir, META), "w") as f:
+            json.dump({"geneNameCol": geneNameCol, "pvalCol": pvalCol, "numGenes": len(genes), "source": source}, f)
+        os.chmod(tmpDir, 0o755)
+        if os.path.isdir(STOREPATH):
+            shutil.rmtree(STOREPATH)
+        os.rename(tmpDir, STOREPATH)
+    except BaseException:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        raise
+
+def convertScoreFile(SCOREPATH:str, STOREPATH:str, geneNameCol:str, pvalCol:str, sep:str = ",", processed:bool = False) -> None:
+    # processed: GS_ file of preProcessForPascal.py (gene <tab> pval, no header), parsed exactly so that its text is
+    # written back unchanged for PascalX
+    df = pd.read_table(SCOREPATH, header=None, names=[geneNameCol, pvalCol], float_precision="round_trip") \
+        if processed else pd.read_csv(SCOREPATH, sep=sep)
+    writeGeneScoreStore(df, STOREPATH, geneNameCol, pvalCol, os.path.basename(SCOREPATH))
+
+def readScoreTable(SCOREPATH:str, geneNameCol:str = None, pvalCol:str = None, sep:str = ",") -> pd.DataFrame:
+    """
+    Gene score table of a CSV/TSV file or of a store (gene and p-value columns only, named geneNameCol and pvalCol).
+    """
+    if isGeneScoreStore(SCOREPATH):
+        return GeneScoreStore(SCOREPATH).toDataFrame(geneNameCol, pvalCol)
+    return pd.read_csv(SCOREPATH, sep=sep)
+
+def readGeneScores(SCOREPATH:str, geneNameCol:str, pvalCol:str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns:
+        np.ndarray, np.ndarray: gene names (str) and float64 p-values in score file order; memory maps for a store
+    """
+    if isGeneScoreStore(SCOREPATH):
+        store = GeneScoreStore(SCOREPATH)
+        return store.genes, store.pvals
+    df_gs = pd.read_csv(SCOREPATH)
+    return np.array(df_gs[geneNameCol].astype(str).tolist(), dtype=str), df_gs[pvalCol].to_numpy(dtype=np.float64)
+
+def readProcessedGeneScores(GSPATH:str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns:
+        np.ndarray, np.ndarray: gene names and float64 p-values of a processed GS_ file (gene <tab> pval, no header);
+            memory maps for a store
+    """
+    if isGeneScoreStore(GSPATH):
+        store = GeneScoreStore(GSPATH)
+        return store.genes, store.pvals
+    df_gs = pd.read_table(GSPATH, header=None)
+    return df_gs[0].to_numpy(), df_gs[1].to_numpy(dtype=np.float64)
+
+def processedGeneScoreFile(DIRPATH:str, name:str) -> str:
+    # GS_<name>.gss store when there is one, GS_<name>.tsv otherwise
+    storePath = os.path.join(DIRPATH, f"GS_{name}{STORE_SUFFIX}")
+    return storePath if isGeneScoreStore(storePath) else os.path.join(DIRPATH, f"GS_{name}.tsv")
+
+def writeProcessedGeneScores(STOREPATH:str, OUTPUTPATH:str) -> None:
+    # GS_ text of a store, as preProcessForPascal.py writes it from the same scores
+    store = GeneScoreStore(STOREPATH)
+    with open(OUTPUTPATH, "w") as f:
+        f.write("".join(f"{gene}\t{pval}\n" for gene, pval in zip(store.genes.tolist(), store.pvals.tolist())))
+
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Convert a gene score CSV/TSV file into a memory-mapped gene score store.")
+
+    # Add arguments to parser
+    parser.add_argument("scoreFile", help="Path to the gene score CSV/TSV file.")
+    parser.add_argument("storePath", help=f"Path to the store directory to write, e.g. <trait>{STORE_SUFFIX}")
+    parser.add_argument("--geneNameCol", default="markname", help="Name of the column for gene name in the score file.")
+    parser.add_argument("--pvalCol", default="meta_p", help="Name of the column for p-value in the score file.")
+    parser.add_argument("--sep", default=",", help="Separator of the score file, e.g. '\\t'")
+    parser.add_argument("--processed", action="store_true", help="scoreFile is a processed GS_ file (gene <tab> pval, no header)")
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    convertScoreFile(args.scoreFile, args.storePath, args.geneNameCol, args.pvalCol, args.sep.encode().decode("unicode_escape"),
+                     args.processed)
+    store = GeneScoreStore(args.storePath)
+    print(f"{args.storePath}: {len(store)} genes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import shutil
+from typing import Dict, List
+
+from profiling import profiled
+from resultCache import fileDigest
+from verticalMerge import publishParts
+
+"""
+Incremental runs: only the (network, permutation) pairs that are new or whose inputs changed since the last run of a trait.
+
+The manifest of a trait (manifest_<trait>.json) records what its master summary dataset holds:
+
+    pipeline, scoreDigest   study and sha256 of the gene score file (CSV or gene score store)
+    numRP                   permutations 1..numRP done for every network
+    networks                network name (module file name without .txt) -> sha256 of the module file
+
+plan compares the current inputs with the manifest and writes a plan directory:
+
+    changedModules/         links to the new or changed module files: permutations 1..numRP
+    extendedModules/        links to the unchanged module files, when numRP grew: permutations oldNumRP+1..numRP
+    runs.tsv                moduleDir <tab> first RP <tab> last RP, one line per group with work to do
+    replaceNetworks.txt     networks whose partitions of the master summary are replaced (changed, removed)
+    manifest.json           manifest of the trait once the run is merged
+
+A changed score file (or pipeline, or fewer permutations) reruns every network. The merge (verticalMerge.py
+--replaceNetworks --stage) writes the part files that replace the partitions of replaceNetworks.txt and append the new
+permutations of the other networks, hidden from readers, so unchanged partitions are never rewritten.
+
+commit publishes the merge and the new manifest together: it first writes manifest_<trait>.json.pending (stage file of
+the merge + new manifest) in one rename, then publishes the part files, replaces the manifest and removes the pending
+file. A run interrupted before the pending file exists leaves the dataset and the manifest untouched (its hidden part
+files are removed by the next plan with --dataset); a pending file left by an interrupted commit is finished by the
+next commit or plan, so the new permutations are never appended twice.
+
+Usage:
+python3 incrementalRun.py plan scoreFile moduleFileDir manifest_<trait>.json numRP pipeline planDir [--dataset master_summary_<trait>]
+python3 incrementalRun.py commit planDir manifest_<trait>.json [--staged stage.json]
+"""
+
+def readManifest(MANIFESTPATH:str) -> dict:
+    if not os.path.exists(MANIFESTPATH):
+        return None
+    with open(MANIFESTPATH, "r") as f:
+        return json.load(f)
+
+def networkDigests(moduleFileDir:str) -> Dict[str, str]:
+    return {file[:-len(".txt")]: fileDigest(os.path.join(moduleFileDir, file))
+            for file in sorted(os.listdir(moduleFileDir)) if file.endswith(".txt")}
+
+def linkModuleFiles(moduleFileDir:str, networks:List[str], DIRPATH:str) -> None:
+    os.makedirs(DIRPATH)
+    for network in networks:
+        os.symlink(os.path.abspath(os.path.join(moduleFileDir, f"{network}.txt")), os.path.join(DIRPATH, f"{network}.txt"))
+
+def replaceFile(SOURCEPATH:str, OUTPUTPATH:str) -> None:
+    # copy then rename, so OUTPUTPATH is always either the old or the new file
+    if os.path.dirname(OUTPUTPATH):
+        os.makedirs(os.path.dirname(OUTPUTPATH), exist_ok=True)
+    tmpPath = f"{OUTPUTPATH}.tmp"
+    shutil.copyfile(SOURCEPATH, tmpPath)
+    os.replace(tmpPath, OUTPUTPATH)
+
+def finishPendingCommit(MANIFESTPATH:str) -> bool:
+    """
+    Publish the merge of manifest_<trait>.json.pending and install its manifest; safe to repeat after an interruption.
+
+    Returns:
+        bool: whether there was a pending commit
+    """
+    pendingPath = f"{MANIFESTPATH}.pending"
+    if not os.path.exists(pendingPath):
+        return False
+    with open(pendingPath, "r") as f:
+        pending = json.load(f)
+    if pending["stage"]["parts"] or pending["stage"]["replacePartitions"]:
+        publishParts(pending["stage"]["outputDir"], pending["stage"]["parts"], pending["stage"]["replacePartitions"])
+    with open(f"{MANIFESTPATH}.tmp", "w") as f:
+        json.dump(pending["manifest"], f, indent=1)
+    os.replace(f"{MANIFESTPATH}.tmp", MANIFESTPATH)
+    os.remove(pendingPath)
+    return True
+
+def removeHiddenParts(datasetDir:str) -> int:
+    # part files of merges that were never committed (readers skip hidden files, but they would use up space)
+    removed = 0
+    for root, _, files in os.walk(datasetDir):
+        for file in files:
+            if file.startswith(".part-") and file.endswith(".parquet"):
+                os.remove(os.path.join(root, file))
+                removed += 1
+    return removed
+
+def planRun(scoreFile:str, moduleFileDir:str, MANIFESTPATH:str, numRP:int, pipeline:str, planDir:str,
+            datasetDir:str = None) -> dict:
+    """
+    Compare the inputs with the manifest of the trait and write the plan directory. An interrupted commit is finished
+    first, so the plan starts from the dataset the manifest describes.
+
+    Args:
+        datasetDir (str): master summary dataset of the trait, to remove the hidden part files of uncommitted merges
+
+    Returns:
+        dict: counts of changed, extended and removed networks, and of (network, permutation) pairs to run
+    """
+    if finishPendingCommit(MANIFESTPATH):
+        print(f"finished the interrupted commit of {MANIFESTPATH}")
+    if datasetDir and os.path.isdir(datasetDir):
+        removeHiddenParts(datasetDir)
+    previous = readManifest(MANIFESTPATH)
+    current = {"pipeline": pipeline, "scoreDigest": fileDigest(scoreFile), "numRP": numRP,
+               "networks": networkDigests(moduleFileDir)}
+    full = (previous is None or previous["pipeline"] != pipeline or previous["scoreDigest"] != current["scoreDigest"]
+            or previous["numRP"] > numRP)
+    previousNetworks = {} if full else previous["networks"]
+    changed = [network for network, digest in current["networks"].items() if previousNetworks.get(network) != digest]
+    extended = [] if full or previous["numRP"] == numRP else \
+        [network for network in current["networks"] if network not in changed]
+    removed = sorted(set((previous or {}).get("networks", {})) - set(current["networks"]))
+
+    if os.path.exists(planDir):
+        shutil.rmtree(planDir)
+    os.makedirs(planDir)
+    runs = []
+    if changed:
+        linkModuleFiles(moduleFileDir, changed, os.path.join(planDir, "changedModules"))
+        runs.append([os.path.abspath(os.path.join(planDir, "changedModules")), 1, numRP])
+    if extended:
+        linkModuleFiles(moduleFileDir, extended, os.path.join(planDir, "extendedModules"))
+        runs.append([os.path.abspath(os.path.join(planDir, "extendedModules")), previous["numRP"] + 1, numRP])
+    with open(os.path.join(planDir, "runs.tsv"), "w") as f:
+        f.write("".join(f"{moduleDir}\t{first}\t{last}\n" for moduleDir, first, last in runs))
+    with open(os.path.join(planDir, "replaceNetworks.txt"), "w") as f:
+        f.write("".join(f"{network}\n" for network in changed + removed))
+    with open(os.path.join(planDir, "manifest.json"), "w") as f:
+        json.dump(current, f, indent=1)
+
+    return {"full": full, "changed": len(changed), "extended": len(extended), "removed": len(removed),
+            "pairs": sum(len(os.listdir(moduleDir)) * (last - first + 1) for moduleDir, first, last in runs)}
+
+def commitRun(planDir:str, MANIFESTPATH:str, STAGEPATH:str = None) -> None:
+    """
+    Publish the staged merge of the run and install its manifest, through manifest_<trait>.json.pending.
+
+    Args:
+        planDir (str): plan directory of the run
+        MANIFESTPATH (str): manifest of the trait
+        STAGEPATH (str): stage file of verticalMerge.py --stage, None to only install the manifest
+    """
+    if STAGEPATH is None:
+        replaceFile(os.path.join(planDir, "manifest.json"), MANIFESTPATH)
+        return
+    with open(STAGEPATH, "r") as f:
+        stage = json.load(f)
+    with open(os.path.join(planDir, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    if os.path.dirname(MANIFESTPATH):
+        os.makedirs(os.path.dirname(MANIFESTPATH), exist_ok=True)
+    # the commit point: once the pending file exists, the merge is published even if this process is interrupted
+    with open(f"{MANIFESTPATH}.pending.tmp", "w") as f:
+        json.dump({"stage": stage, "manifest": manifest}, f, indent=1)
+    os.replace(f"{MANIFESTPATH}.pending.tmp", f"{MANIFESTPATH}.pending")
+    finishPendingCommit(MANIFESTPATH)
+
+@profiled("main")
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Plan and commit incremental runs of one trait.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Add arguments to parser
+    planParser = subparsers.add_parser("plan", help="write the plan of the next run")
+    planParser.add_argument("scoreFile", help="Path to the (unpermuted) scoreFile (CSV or gene score store).")
+    planParser.add_argument("moduleFileDir", help="Path to the directory of module files.")
+    planParser.add_argument("manifest", help="Path to the manifest of the trait.")
+    planParser.add_argument("numRP", type=int, help="number of permutations")
+    planParser.add_argument("pipelineName", help="Name of the pipeline.")
+    planParser.add_argument("planDir", help="Directory to write the plan to.")
+    planParser.add_argument("--dataset", help="Master summary dataset of the trait; hidden part files of uncommitted merges are removed.")
+    commitParser = subparsers.add_parser("commit", help="publish the merge of a run and install its manifest")
+    commitParser.add_argument("planDir", help="Plan directory of the run.")
+    commitParser.add_argument("manifest", help="Path to the manifest of the trait.")
+    commitParser.add_argument("--staged", help="Stage file written by verticalMerge.py --stage.")
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        counts = planRun(args.scoreFile, args.moduleFileDir, args.manifest, args.numRP, args.pipelineName, args.planDir,
+                         args.dataset)
+        print(f"{'full' if counts['full'] else 'incremental'} run: {counts['changed']} new or changed networks, "
+              f"{counts['extended']} networks with new permutations, {counts['removed']} removed networks, "
+              f"{counts['pairs']} (network, permutation) pairs")
+    else:
+        commitRun(args.planDir, args.manifest, args.staged)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,132 @@
 import argparse
+import csv
 import os
-import re
-from typing import List
+from typing import List, Tuple
+import numpy as np
 import pandas as pd
 
-def countGOterms(DIRPATH:str)-> int:
-    df = pd.read_csv(DIRPATH)
-    moduleIndex = DIRPATH.split("/")[-1].split("_")[-1].replace(".csv","")
-    maxEnrichmentRatio = -1
-    enrichMentRatio = -1
-    if len(df) > 0:
-        minTermPval = df["FDR"].min()
-        maxEnrichmentRatio = df["enrichmentRatio"].max()
-        enrichMentRatio = df[df["FDR"] == df["FDR"].min()]["enrichmentRatio"].max()
-    else:
-        minTermPval = -1
-        maxEnrichmentRatio = -1
-        enrichMentRatio = -1
-    return int(moduleIndex), len(df), minTermPval, enrichMentRatio, maxEnrichmentRatio
-
-
-def outputMergableORA_df(module_ora_file:str, study:str, trait:str, network:str, moduleIndex:int):
-    # if "dummy" in module_ora_file:
-    #     return pd.DataFrame({'study':[study], 'trait':[trait], 'network':[network], 'moduleIndex':[moduleIndex],
-    #                          'geneontology_Biological_Process':["NA"], 'BPminCorrectedPval':["NA"],
-    #                           "BPminFDREnrichmentRatio":["NA"], 'BPmaxEnrichmentRatio':["NA"]})
-                             
-    dict_ora = {'study':[], 'trait':[], 'network':[], 'moduleIndex':[],
-                'geneontology_Biological_Process':[], 'BPminCorrectedPval':[],
-                'BPminFDREnrichmentRatio':[], 'BPmaxEnrichmentRatio':[]}
-    GOtype = 'geneontology_Biological_Process'
-    moduleIndex, GOcount, minPval, enrichmentRatio_minFDR, enrichmentRatio_max = countGOterms(module_ora_file)
-    dict_ora['study'].append(study)
-    dict_ora["trait"].append(trait)
-    dict_ora["network"].append(network)
-    dict_ora["moduleIndex"].append(moduleIndex)
-    dict_ora['BPminCorrectedPval'].append(minPval)
-    dict_ora["BPminFDREnrichmentRatio"].append(enrichmentRatio_minFDR)
-    dict_ora["BPmaxEnrichmentRatio"].append(enrichmentRatio_max)
-    dict_ora[GOtype].append(GOcount)
-
-    return pd.DataFrame(dict_ora)
+from profiling import phase, profiled
+from summaryIO import SummaryWriter, isParquet, readSummary, summaryFileName
+
+ORA_COLUMNS = ['geneontology_Biological_Process', 'BPminCorrectedPval', 'BPminFDREnrichmentRatio', 'BPmaxEnrichmentRatio']
+
+def readFDRandEnrichmentRatio(DIRPATH:str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Stream the FDR and enrichmentRatio fields of one ORA summary file without building a DataFrame.
+
+    Args:
+        DIRPATH (str): path to the ORA summary csv
+
+    Returns:
+        np.ndarray, np.ndarray: FDR and enrichmentRatio of every row, converted as pd.read_csv converts them
+            (pd.to_numeric uses the same float parser; NA fields are nan)
+    """
+    with open(DIRPATH, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        if "FDR" not in header or "enrichmentRatio" not in header:
+            return np.empty(0), np.empty(0)
+        fdrCol, ratioCol = header.index("FDR"), header.index("enrichmentRatio")
+        fdr, ratio = [], []
+        for row in reader:
+            if row:
+                fdr.append(row[fdrCol])
+                ratio.append(row[ratioCol])
+    return pd.to_numeric(fdr, errors="coerce"), pd.to_numeric(ratio, errors="coerce")
+
+def summarizeFDRandEnrichmentRatio(fdr:np.ndarray, ratio:np.ndarray) -> Tuple[float, float, float]:
+    """
+    Min FDR, max enrichmentRatio of the terms at the min FDR and max enrichmentRatio of one file, in one pass.
+    Missing values are skipped, as by the pandas min/max of the legacy countGOterms.
+    """
+    minFDR = ratioAtMinFDR = maxRatio = np.nan
+    for termFDR, termRatio in zip(fdr.tolist(), ratio.tolist()):
+        if termRatio == termRatio and not maxRatio >= termRatio:
+            maxRatio = termRatio
+        if termFDR != termFDR:
+            continue
+        if not minFDR <= termFDR:
+            minFDR, ratioAtMinFDR = termFDR, termRatio
+        elif termFDR == minFDR and termRatio == termRatio and not ratioAtMinFDR >= termRatio:
+            ratioAtMinFDR = termRatio
+    return minFDR, ratioAtMinFDR, maxRatio
+
+def summarizeORAfiles(ora_files:List[str]) -> dict:
+    """
+    ORA columns of many ORA summary files: number of GO terms, min FDR, max enrichmentRatio at min FDR and max
+    enrichmentRatio of every file, collected as columns.
+
+    Args:
+        ora_files (List[str]): paths to the ORA summary csv files
+
+    Returns:
+        dict: moduleIndex and ORA_COLUMNS, one list entry per file (-1 for files without any GO term)
+    """
+    summary = {'moduleIndex':[], 'geneontology_Biological_Process':[], 'BPminCorrectedPval':[],
+               'BPminFDREnrichmentRatio':[], 'BPmaxEnrichmentRatio':[]}
+    for file in ora_files:
+        summary['moduleIndex'].append(int(file.split("/")[-1].split("_")[-1].replace(".csv","")))
+        fdr, ratio = readFDRandEnrichmentRatio(file)
+        summary['geneontology_Biological_Process'].append(len(fdr))
+        minFDR, ratioAtMinFDR, maxRatio = summarizeFDRandEnrichmentRatio(fdr, ratio) if len(fdr) > 0 else (-1, -1, -1)
+        summary['BPminCorrectedPval'].append(minFDR)
+        summary['BPminFDREnrichmentRatio'].append(ratioAtMinFDR)
+        summary['BPmaxEnrichmentRatio'].append(maxRatio)
+    return summary
     
 
+def mergeORAintoSummaryPiece(df_summary_piece:pd.DataFrame, oraResultsDir:str, study:str, trait:str, network:str,
+                             fillNA:bool = True) -> pd.DataFrame:
+    """
+    Add the ORA summary columns of one (study, trait, network) to its master summary rows.
+
+    Args:
+        df_summary_piece (pd.DataFrame): master summary rows of the network
+        oraResultsDir (str): directory of the ORA summary csv files of the network
+        study, trait, network (str): keys of the network
+        fillNA (bool): fill missing ORA values with "NA" (CSV). Without it they stay missing (typed Parquet summaries).
+
+    Returns:
+        pd.DataFrame: df_summary_piece with ORA_COLUMNS, "NA" where a module has no ORA result
+    """
+    df_summary_piece = df_summary_piece.copy()
+    df_summary_piece[['study', 'trait', 'network']] = df_summary_piece[['study', 'trait', 'network']].astype(str)
+    df_summary_piece['moduleIndex'] = df_summary_piece['moduleIndex'].astype('int64')
+
+    ora_files = [os.path.join(oraResultsDir, file) for file in os.listdir(oraResultsDir)] if os.path.isdir(oraResultsDir) else []
+    if len(ora_files) == 0: # if there are no significant module from ORA result
+        df_ora_merged = pd.DataFrame({'study':[study], 'trait':[trait], 'network':[network], 'moduleIndex':[0],
+                                      'geneontology_Biological_Process':["NA"], 'BPminCorrectedPval':["NA"],
+                                      "BPminFDREnrichmentRatio":["NA"], 'BPmaxEnrichmentRatio':["NA"]})
+    else:
+        ora_summary = summarizeORAfiles(ora_files)
+        df_ora_merged = pd.DataFrame({'study':study, 'trait':trait, 'network':network,
+                                      'moduleIndex':ora_summary['moduleIndex'],
+                                      **{column: ora_summary[column] for column in ORA_COLUMNS}})
+            
+    # single join on typed integer module indices
+    df_ora_merged[['study', 'trait', 'network']] = df_ora_merged[['study', 'trait', 'network']].astype(str)
+    df_ora_merged['moduleIndex'] = df_ora_merged['moduleIndex'].astype('int64')
+    df_merge = pd.merge(df_summary_piece, df_ora_merged, how='left', on=['study','trait','network', 'moduleIndex'])
+    if not fillNA:
+        return df_merge
+    # object dtype first: newer pandas no longer upcasts float columns when filling with a string
+    return df_merge.astype(object).fillna("NA")
+
+@profiled("main")
 def main():
     # Create argument parser
     parser = argparse.ArgumentParser(description="merge horizontally summary + ora summary")
     # Add arguments to parser
     parser.add_argument("masterSummaryPiece", help="pathToSummaryResult")
-    parser.add_argument("oraResultsDir", help="path To Dir containing ORAResults")
+    parser.add_argument("oraResultsDir", help="path To Dir containing ORAResults. With --batch, directory containing "
+                                              "the GO_summaries_<trait>_<network> directories.")
     parser.add_argument("output_directory", help="path To save OutputMergedFile")
-    parser.add_argument("goFile", help="path to GO background file")
+    parser.add_argument("goFile", help="path to GO background file. Not used with --batch.")
+    parser.add_argument("--batch", action="store_true", help="masterSummaryPiece is a chunk summary of many (trait, network) "
+                                                             "pairs, merged into one master_summary_chunk_<chunkName>.csv "
+                                                             "(.parquet for a Parquet masterSummaryPiece)")
+    parser.add_argument("--chunkName", default="0", help="name of the merged chunk in --batch mode")
 
     # Parse the arguments
     args = parser.parse_args()
@@ -62,29 +138,30 @@ def main():
     if not os.path.exists(args.output_directory):
         os.makedirs(args.output_directory)
         
-    df_summary_piece = pd.read_csv(args.masterSummaryPiece)
-    df_summary_piece[['study', 'trait', 'network', 'moduleIndex']] = df_summary_piece[['study', 'trait', 'network', 'moduleIndex']].astype(str)
-    study, trait, network = os.path.basename(args.goFile).split(".")[0].split("_")[1:4]
+    # the merged summary has the format of the summary piece
+    summaryFormat = "parquet" if isParquet(args.masterSummaryPiece) else "csv"
+    with phase("read", file=args.masterSummaryPiece):
+        df_summary_piece = readSummary(args.masterSummaryPiece)
+    if args.batch:
+        out = SummaryWriter(os.path.join(args.output_directory, summaryFileName(f"master_summary_chunk_{args.chunkName}", summaryFormat)))
+        for (study, trait, network), df_network in df_summary_piece.groupby(['study', 'trait', 'network'], sort=False):
+            oraResultsDir = os.path.join(args.oraResultsDir, f"GO_summaries_{trait}_{network}")
+            with phase("merge", file=oraResultsDir):
+                df_merge = mergeORAintoSummaryPiece(df_network, oraResultsDir, str(study), str(trait), str(network),
+                                                    summaryFormat == "csv")
+            with phase("write", file=oraResultsDir):
+                out.write(df_merge)
+        out.close(list(df_summary_piece.columns) + ORA_COLUMNS)
+        return
 
-    
-    ora_dfs = []
-    if len(os.listdir(args.oraResultsDir)) == 0: # if there are no significant module from ORA result
-        ora_dfs.append(pd.DataFrame({'study':[study], 'trait':[trait], 'network':[network], 'moduleIndex':[0],
-                                    'geneontology_Biological_Process':["NA"], 'BPminCorrectedPval':["NA"],
-                                    "BPminFDREnrichmentRatio":["NA"], 'BPmaxEnrichmentRatio':["NA"]}))
-    else:
-        for file in os.listdir(args.oraResultsDir):
-            file = os.path.join(args.oraResultsDir, file)
-            moduleIndex = os.path.basename(file).split(".")[0].split("_")[4]
-            df_ora = outputMergableORA_df(file, study, trait, network, moduleIndex)
-            ora_dfs.append(df_ora)
-            
-    df_ora_merged = pd.concat(ora_dfs, ignore_index=True)
-    df_ora_merged[['study', 'trait', 'network', 'moduleIndex']] = df_ora_merged[['study', 'trait', 'network', 'moduleIndex']].astype(str)
-    df_merge = pd.merge(df_summary_piece, df_ora_merged, how='left', on=['study','trait','network', 'moduleIndex'])
-    df_merge.fillna("NA", inplace=True)
-    mergedFileName = f"{study}_{trait}_{network}.csv"
-    df_merge.to_csv(os.path.join(args.output_directory, mergedFileName), index=False)
+    study, trait, network = os.path.basename(args.goFile).split(".")[0].split("_")[1:4]
+    with phase("merge", file=args.oraResultsDir):
+        df_merge = mergeORAintoSummaryPiece(df_summary_piece, args.oraResultsDir, study, trait, network, summaryFormat == "csv")
+    mergedFileName = summaryFileName(f"{study}_{trait}_{network}", summaryFormat)
+    with phase("write", file=args.oraResultsDir):
+        out = SummaryWriter(os.path.join(args.output_directory, mergedFileName))
+        out.write(df_merge)
+        out.close()
     
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from geneScoreStore import readScoreTable
+from profiling import phase, profiled
+
+"""
+Module-universe index shared by every permutation of a network.
+
+A permutation only reorders the gene-name column of the score file, so the set of genes with a score is the
+same for every RP run. The parsed module file and its intersection with that gene set are built once and
+cached on disk:
+
+    moduleIndexDir/<module file sha256>/index.npz                 interned genes + CSR module->gene arrays
+    moduleIndexDir/<module file sha256>/<universe sha256>/Module.tsv   module file filtered to scored genes
+    moduleIndexDir/<module file sha256>/<universe sha256>/GO.txt       GO background (module genes with a score)
+    moduleIndexDir/<module file sha256>/<universe sha256>/background.npy  gene IDs of the GO background
+
+Module.tsv is byte-identical to the Module_*.tsv written by preProcessForPascal.py. GO.txt holds the same genes as
+GO_*.txt, in the order of the score file the cache entry was built from.
+
+Given the score files of many traits (mea_batch.nf), every module file is parsed once and restricted to the gene
+universe of each trait; traits with the same universe share one entry. With --persistentDir, entries are built in (or
+reused from) that cache shared between runs, and the entries of this run are copied into moduleIndexDir.
+
+Usage:
+python3 moduleIndex.py scoreFile [scoreFile ...] moduleFileDir moduleIndexDir geneNameCol [--persistentDir DIR]
+"""
+
+def fileDigest(FILEPATH:str) -> str:
+    sha = hashlib.sha256()
+    with open(FILEPATH, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def universeDigest(genes:Iterable[str]) -> str:
+    # order-independent hash of the set of genes with a score
+    sha = hashlib.sha256()
+    for gene in sorted(set(genes)):
+        sha.update(gene.encode())
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+def writeAtomically(OUTPUTPATH:str, write) -> None:
+    # concurrent tasks may build the same entry; only complete files are ever renamed into place
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(OUTPUTPATH), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        # mkstemp creates 0600 files; the cache is shared between users of the lab
+        os.chmod(tmpPath, 0o644)
+        os.replace(tmpPath, OUTPUTPATH)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+
+class ModuleIndex:
+    """
+    Module file parsed into interned gene IDs and CSR-style module->gene arrays.
+
+    Args:
+        moduleIds (np.ndarray): first column of every line of the module file
+        geneNames (np.ndarray): interned gene names, a gene ID is a position in this array
+        indptr (np.ndarray): genes of module i are indices[indptr[i]:indptr[i+1]]
+        indices (np.ndarray): gene IDs of every module, in module file order
+    """
+    def __init__(self, moduleIds:np.ndarray, geneNames:np.ndarray, indptr:np.ndarray, indices:np.ndarray):
+        self.moduleIds = moduleIds
+        self.geneNames = geneNames
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def fromModuleLines(cls, moduleLines:List[List[str]]) -> "ModuleIndex":
+        geneToId = {}
+        indptr = [0]
+        indices = []
+        for columns in moduleLines:
+            # Column[1] is always 1.0
+            for gene in columns[2:]:
+                indices.append(geneToId.setdefault(gene, len(geneToId)))
+            indptr.append(len(indices))
+        return cls(np.array([columns[0] for columns in moduleLines]),
+                   np.array(list(geneToId), dtype=str),
+                   np.array(indptr, dtype=np.int64),
+                   np.array(indices, dtype=np.int32))
+
+    @classmethod
+    def load(cls, INDEXPATH:str) -> "ModuleIndex":
+        with np.load(INDEXPATH) as npz:
+            return cls(npz["moduleIds"], npz["geneNames"], npz["indptr"], npz["indices"])
+
+    def save(self, INDEXPATH:str) -> None:
+        writeAtomically(INDEXPATH, lambda f: np.savez(f, moduleIds=self.moduleIds, geneNames=self.geneNames,
+                                                       indptr=self.indptr, indices=self.indices))
+
+    def scoredGeneMask(self, genesWithScore:set) -> np.ndarray:
+        return np.fromiter((gene in genesWithScore for gene in self.geneNames.tolist()), dtype=bool, count=len(self.geneNames))
+
+    def filteredModuleText(self, scoredMask:np.ndarray) -> str:
+        # same content as the Module_*.tsv of preProcessForPascal.py
+        geneNames = self.geneNames.tolist()
+        indices = self.indices
+        keep = scoredMask[indices]
+        lines = []
+        for i, moduleId in enumerate(self.moduleIds.tolist()):
+            start, stop = self.indptr[i], self.indptr[i + 1]
+            lines.append(moduleId + "".join("\t" + geneNames[g] for g in indices[start:stop][keep[start:stop]]) + "\n")
+        return "".join(lines)
+
+def loadOrBuildModuleIndex(MODULEPATH:str, moduleIndexDir:str, moduleLines:List[List[str]] = None) -> Tuple[ModuleIndex, str]:
+    """
+    Return the cached index of a module file, building it first if needed.
+
+    Args:
+        MODULEPATH (str): path to the module file
+        moduleIndexDir (str): root of the module index cache
+        moduleLines (List[List[str]]): module file split into columns, used instead of re-reading on a cache miss
+
+    Returns:
+        ModuleIndex, str: the index and the cache directory of this module file
+    """
+    entryDir = os.path.join(moduleIndexDir, fileDigest(MODULEPATH))
+    indexPath = os.path.join(entryDir, "index.npz")
+    if os.path.exists(indexPath):
+        return ModuleIndex.load(indexPath), entryDir
+    os.makedirs(entryDir, exist_ok=True)
+    if moduleLines is None:
+        with open(MODULEPATH, "r") as f:
+            moduleLines = [line.split() for line in f]
+    index = ModuleIndex.fromModuleLines(moduleLines)
+    index.save(indexPath)
+    return index, entryDir
+
+def cachedModuleFiles(MODULEPATH:str, moduleIndexDir:str, genes:pd.Series, genesWithScore:set = None,
+                      genesDigest:str = None, indexEntry:Tuple[ModuleIndex, str] = None) -> Tuple[str, str]:
+    """
+    Return the cached filtered module file and GO background file of a (module file, score gene universe) pair,
+    building them first if needed.
+
+    Args:
+        MODULEPATH (str): path to the module file
+        moduleIndexDir (str): root of the module index cache
+        genes (pd.Series): gene-name column of the score file
+        genesWithScore (set): set(genes), if already computed
+        genesDigest (str): universeDigest(genes), if already computed
+        indexEntry (Tuple[ModuleIndex, str]): loadOrBuildModuleIndex of the module file, if already loaded
+
+    Returns:
+        str, str: paths to the cached Module.tsv and GO.txt
+    """
+    if genesWithScore is None:
+        genesWithScore = set(genes)
+    if genesDigest is None:
+        genesDigest = universeDigest(genesWithScore)
+    index, entryDir = indexEntry or loadOrBuildModuleIndex(MODULEPATH, moduleIndexDir)
+    universeDir = os.path.join(entryDir, genesDigest)
+    modulePath = os.path.join(universeDir, "Module.tsv")
+    goPath = os.path.join(universeDir, "GO.txt")
+    if os.path.exists(modulePath) and os.path.exists(goPath):
+        return modulePath, goPath
+
+    os.makedirs(universeDir, exist_ok=True)
+    scoredMask = index.scoredGeneMask(genesWithScore)
+    background = np.flatnonzero(scoredMask).astype(np.int32)
+    backgroundGenes = set(index.geneNames[background].tolist())
+    writeAtomically(os.path.join(universeDir, "background.npy"), lambda f: np.save(f, background))
+    writeAtomically(modulePath, lambda f: f.write(index.filteredModuleText(scoredMask).encode()))
+    # GO background in score file order, as in GO_*.txt
+    writeAtomically(goPath, lambda f: f.write("".join(f"{gene}\n" for gene in genes[genes.isin(backgroundGenes)].tolist()).encode()))
+    return modulePath, goPath
+
+def copyEntry(sourceDir:str, universeEntry:str, moduleIndexDir:str) -> None:
+    # <module file sha256>/index.npz and <module file sha256>/<universe sha256>/ of one entry, same layout
+    entryDir = os.path.dirname(universeEntry)
+    os.makedirs(os.path.join(moduleIndexDir, entryDir), exist_ok=True)
+    shutil.copyfile(os.path.join(sourceDir, entryDir, "index.npz"), os.path.join(moduleIndexDir, entryDir, "index.npz"))
+    shutil.copytree(os.path.join(sourceDir, universeEntry), os.path.join(moduleIndexDir, universeEntry), dirs_exist_ok=True)
+
+@profiled("main")
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Build the module-universe index of every module file once per network.")
+
+    # Add arguments to parser
+    parser.add_argument("scoreFiles", nargs="+", help="Path to the (unpermuted) scoreFile (CSV or gene score store), "
+                                                       "or to the score files of several traits.")
+    parser.add_argument("moduleFileDir", help="Path to the directory of module files.")
+    parser.add_argument("moduleIndexDir", help="Path to the module index cache.")
+    parser.add_argument("geneNameCol", help="Name of the column for gene name in the score file.")
+    parser.add_argument("--persistentDir", help="module index cache kept between runs; the entries used here are copied from it into moduleIndexDir")
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if not os.path.exists(args.moduleIndexDir):
+        os.makedirs(args.moduleIndexDir)
+    buildDir = args.persistentDir or args.moduleIndexDir
+
+    universes = []
+    for scoreFile in args.scoreFiles:
+        with phase("read", file=scoreFile):
+            genes = readScoreTable(scoreFile, args.geneNameCol)[args.geneNameCol]
+        genesWithScore = set(genes)
+        universes.append((genes, genesWithScore, universeDigest(genesWithScore)))
+    for file in os.listdir(args.moduleFileDir):
+        if file.endswith(".txt"):
+            with phase("build", file=file):
+                # parsed once, then restricted to the gene universe of every score file
+                indexEntry = loadOrBuildModuleIndex(os.path.join(args.moduleFileDir, file), buildDir)
+                for genes, genesWithScore, genesDigest in universes:
+                    modulePath, goPath = cachedModuleFiles(os.path.join(args.moduleFileDir, file), buildDir,
+                                                           genes, genesWithScore, genesDigest, indexEntry)
+                    if args.persistentDir:
+                        with phase("copy", file=file):
+                            copyEntry(args.persistentDir, os.path.relpath(os.path.dirname(modulePath), args.persistentDir),
+                                      args.moduleIndexDir)
+                    print(f"{file} -> {os.path.dirname(modulePath)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from profiling import phase, profiled
+
+"""
+Parallel driver of ORA_cmd.R (WebGestaltR) for the GoAnalysis stages.
+
+The module files of every significantModules directory are split into batches of --batchSize modules. Batches run as
+concurrent ORA_cmd.R processes, each analysing its modules with forked R workers, so that at most --workers modules
+are analysed at a time. Every batch writes into its own temporary summary directory. The per-module CSVs are moved
+into the summaryRoot of their directory only when the batch succeeds, so a failed or killed batch never leaves partial
+summaries behind. With --goGmtFile, each ORA_cmd.R process reads the GO annotation once from that local file and
+never contacts the WebGestalt server.
+
+The driver runs next to Rscript in the WebGestaltR image (Dockerfile.webgestalt), so it and profiling.py must only use the
+Python standard library.
+
+Usage:
+python3 parallelORA.py --sigModuleDir DIR --backGroundGenesFile GO_*.txt --summaryRoot DIR --workers 8 [--goGmtFile GO_BP.gmt]
+python3 parallelORA.py --manifest runs.tsv --workers 8 [--batchSize 50] [--goGmtFile GO_BP.gmt]
+"""
+
+ORA_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ORA_cmd.R")
+
+def moduleFilesOf(sigModuleDir:str) -> List[str]:
+    # the files ORA_cmd.R writes a summary for, largest first so that long modules start early
+    files = [file for file in os.listdir(sigModuleDir)
+             if file.endswith(".txt") and (file.startswith("sig_") or file.startswith("dummy_"))]
+    return sorted(files, key=lambda file: (-os.path.getsize(os.path.join(sigModuleDir, file)), file))
+
+def planBatches(runs:List[List[str]], batchSize:int) -> List[Tuple[str, str, str, List[str]]]:
+    """
+    Args:
+        runs (List[List[str]]): [sigModuleDir, backGroundGenesFile, summaryRoot] of every directory
+        batchSize (int): modules per ORA_cmd.R process, 0 for one process per directory
+
+    Returns:
+        List[Tuple[str, str, str, List[str]]]: (sigModuleDir, backGroundGenesFile, summaryRoot, module files) per batch
+    """
+    batches = []
+    for sigModuleDir, backGroundGenesFile, summaryRoot in runs:
+        files = moduleFilesOf(sigModuleDir)
+        size = batchSize if batchSize > 0 else max(1, len(files))
+        for start in range(0, len(files), size):
+            batches.append((sigModuleDir, backGroundGenesFile, summaryRoot, files[start:start + size]))
+    return batches
+
+def runBatch(batch:Tuple[str, str, str, List[str]], rWorkers:int, reportRoot:str, goGmtFile:str = None,
+             rscript:str = "Rscript", oraScript:str = ORA_SCRIPT) -> List[str]:
+    """
+    Run ORA_cmd.R on one batch of module files and move its summaries into the summaryRoot of the directory.
+
+    Returns:
+        List[str]: paths to the gathered summary CSVs
+    """
+    sigModuleDir, backGroundGenesFile, summaryRoot, files = batch
+    os.makedirs(summaryRoot, exist_ok=True)
+    tmpDir = tempfile.mkdtemp(dir=summaryRoot, prefix=".tmp_")
+    try:
+        moduleList = os.path.join(tmpDir, "modules.txt")
+        with open(moduleList, "w") as f:
+            f.write("".join(f"{file}\n" for file in files))
+        command = [rscript, oraScript, "--sigModuleDir", sigModuleDir, "--backGroundGenesFile", backGroundGenesFile,
+                   "--summaryRoot", os.path.join(tmpDir, "summaries"), "--reportRoot", reportRoot,
+                   "--workers", str(rWorkers), "--moduleList", moduleList]
+        if goGmtFile:
+            command += ["--enrichDatabaseFile", goGmtFile]
+        with phase("ora", file=sigModuleDir):
+            subprocess.run(command, check=True)
+
+        summaries = []
+        for file in files:
+            name = f"{os.path.splitext(file)[0]}.csv"
+            summary = os.path.join(tmpDir, "summaries", name)
+            if not os.path.exists(summary):
+                raise RuntimeError(f"ORA_cmd.R wrote no summary for {os.path.join(sigModuleDir, file)}")
+            os.replace(summary, os.path.join(summaryRoot, name))
+            summaries.append(os.path.join(summaryRoot, name))
+        return summaries
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+def runBatches(batches:List[Tuple[str, str, str, List[str]]], workers:int, reportRoot:str, goGmtFile:str = None,
+               rscript:str = "Rscript", oraScript:str = ORA_SCRIPT) -> List[str]:
+    """
+    Run the batches with at most workers modules analysed at a time: min(workers, batches) concurrent ORA_cmd.R
+    processes sharing the workers between them.
+
+    Returns:
+        List[str]: paths to the gathered summary CSVs, in batch order
+    """
+    if not batches:
+        return []
+    processes = min(workers, len(batches))
+    rWorkers = max(1, workers // processes)
+    with ThreadPoolExecutor(processes) as pool:
+        futures = [pool.submit(runBatch, batch, rWorkers, reportRoot, goGmtFile, rscript, oraScript) for batch in batches]
+        # every batch finishes (and keeps its summaries) before the first failure is raised
+        errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [summary for future in futures for summary in future.result()]
+
+@profiled("main")
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Run ORA_cmd.R on the significant modules in parallel batches.")
+
+    # Add arguments to parser
+    parser.add_argument("--sigModuleDir", help="directory having significant modules")
+    parser.add_argument("--backGroundGenesFile", help="file having background genes")
+    parser.add_argument("--summaryRoot", help="directory to save summary")
+    parser.add_argument("--manifest", help="file with one 'sigModuleDir<TAB>backGroundGenesFile<TAB>summaryRoot' per line")
+    parser.add_argument("--reportRoot", default="GO_reports/", help="directory to save report")
+    parser.add_argument("--workers", type=int, default=1, help="modules analysed at a time")
+    parser.add_argument("--batchSize", type=int, default=0, help="modules per ORA_cmd.R process, 0 for one process per directory")
+    parser.add_argument("--goGmtFile", help="local GO Biological Process GMT file (gene symbols). Default: WebGestalt server")
+    parser.add_argument("--rscript", default="Rscript", help="Rscript executable")
+    parser.add_argument("--oraScript", default=ORA_SCRIPT, help="path to ORA_cmd.R")
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if args.manifest:
+        with open(args.manifest, "r") as f:
+            runs = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+    elif args.sigModuleDir and args.backGroundGenesFile and args.summaryRoot:
+        runs = [[args.sigModuleDir, args.backGroundGenesFile, args.summaryRoot]]
+    else:
+        parser.error("--sigModuleDir, --backGroundGenesFile and --summaryRoot are required without --manifest")
+
+    for _, _, summaryRoot in runs:
+        os.makedirs(summaryRoot, exist_ok=True)
+    summaries = runBatches(planBatches(runs, args.batchSize), args.workers, args.reportRoot, args.goGmtFile,
+                           args.rscript, args.oraScript)
+    print(f"{len(summaries)} module summaries from {len(runs)} directories")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import ast
+import os
+import re
+from array import array
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+"""
+Read and write Pascal module scoring results.
+
+runPascal.py used to write str(r) for every row of PascalX's chi2rank result ([module, genes, array(gene pvals), module pval]),
+which had to be parsed back with a regex and ast.literal_eval. The structured format is an .npz with one typed array per field:
+
+    moduleIndex  int64   (M,)    module index (first column of the module file)
+    modulePval   float64 (M,)    module p-value, nan if the module lost all of its genes
+    geneOffsets  int64   (M+1,)  genes of module i are geneIds[geneOffsets[i]:geneOffsets[i+1]]
+    geneIds      int32   (G,)    position of each gene in geneNames
+    geneNames    str     (U,)    interned gene names
+    genePvals    float64 (G,)    per-gene p-values, aligned with geneIds
+
+Files ending in .txt are read with the legacy text parser, which streams the file one module record at a time.
+"""
+
+STRUCTURED_SUFFIX = ".npz"
+# 0: module index, 1: module genes, 2: gene uniform pval, 3: module uncorrected pval
+LEGACY_RECORD = re.compile(r"\[(.+?),(.*?),array\((.*)\),(.*?)\]")
+
+class PascalResult:
+    """
+    Columnar Pascal result, see the module docstring for the meaning of each array.
+    """
+    def __init__(self, moduleIndex:np.ndarray, modulePval:np.ndarray, geneOffsets:np.ndarray, geneIds:np.ndarray,
+                 geneNames:np.ndarray, genePvals:np.ndarray = None):
+        self.moduleIndex = moduleIndex
+        self.modulePval = modulePval
+        self.geneOffsets = geneOffsets
+        self.geneIds = geneIds
+        self.geneNames = geneNames
+        self.genePvals = genePvals
+
+    def __len__(self):
+        return len(self.moduleIndex)
+
+    def moduleGenes(self, i:int) -> List[str]:
+        return self.geneNames[self.geneIds[self.geneOffsets[i]:self.geneOffsets[i + 1]]].tolist()
+
+    @classmethod
+    def fromRows(cls, rows) -> "PascalResult":
+        """
+        Build from PascalX chi2rank result rows: [module, genes, gene pvals, module pval].
+        """
+        geneToId = {}
+        geneOffsets = [0]
+        geneIds = []
+        genePvals = []
+        for r in rows:
+            geneIds.extend(geneToId.setdefault(gene, len(geneToId)) for gene in r[1])
+            genePvals.extend(np.ravel(r[2]).tolist())
+            geneOffsets.append(len(geneIds))
+        return cls(np.array([int(r[0]) for r in rows], dtype=np.int64),
+                   np.array([r[3] for r in rows], dtype=np.float64),
+                   np.array(geneOffsets, dtype=np.int64),
+                   np.array(geneIds, dtype=np.int32),
+                   np.array(list(geneToId), dtype=str),
+                   np.array(genePvals, dtype=np.float64))
+
+def writePascalResult(OUTPUTPATH:str, rows) -> None:
+    result = PascalResult.fromRows(rows)
+    np.savez(OUTPUTPATH, moduleIndex=result.moduleIndex, modulePval=result.modulePval, geneOffsets=result.geneOffsets,
+             geneIds=result.geneIds, geneNames=result.geneNames, genePvals=result.genePvals)
+
+def writeLegacyPascalResult(OUTPUTPATH:str, rows) -> None:
+    with open(OUTPUTPATH, "w") as f:
+        for r in rows:
+            f.write(str(r)+"\n")
+
+def readPascalResult(DIRPATH:str) -> PascalResult:
+    if DIRPATH.endswith(STRUCTURED_SUFFIX):
+        # arrays are stored uncompressed and typed, so loading is a plain read without any parsing
+        with np.load(DIRPATH) as npz:
+            return PascalResult(npz["moduleIndex"], npz["modulePval"], npz["geneOffsets"], npz["geneIds"],
+                                npz["geneNames"], npz["genePvals"])
+    return readLegacyPascalResult(DIRPATH)
+
+def _parseGeneList(text:str) -> List[str]:
+    # "['A','B']" -> ["A", "B"] without ast.literal_eval when no gene name needs escaping or contains a comma
+    if text == "[]":
+        return []
+    if "\\" not in text and '"' not in text:
+        genes = text[1:-1].split(",")
+        if all(len(gene) >= 2 and gene[0] == "'" and gene[-1] == "'" for gene in genes):
+            return [gene[1:-1] for gene in genes]
+    # string list to list conversion via ast.literal_eval
+    return ast.literal_eval(text)
+
+def _parseLegacyRecord(record:str) -> Iterator[Tuple[int, List[str], float]]:
+    # flatten pval parts
+    record = record.replace(",\n", ",").replace(" ", "")
+    for parsed in LEGACY_RECORD.findall(record):
+        # ex) "'5'" -> 5
+        yield int(parsed[0].replace("'", "")), _parseGeneList(parsed[1]), float(parsed[3])
+
+def iterLegacyPascalRecords(DIRPATH:str) -> Iterator[Tuple[int, List[str], float]]:
+    """
+    Stream the str(tuple) text output of older runPascal.py versions as (module index, genes, module p-value).
+
+    Every record starts on a line beginning with "["; numpy wraps the per-gene p-value array over continuation lines,
+    so only the lines of one record are held in memory.
+    """
+    with open(DIRPATH, "r") as f:
+        record = []
+        for line in f:
+            if line.startswith("[") and record:
+                yield from _parseLegacyRecord("".join(record))
+                record = []
+            record.append(line)
+        if record:
+            yield from _parseLegacyRecord("".join(record))
+
+def readLegacyPascalResult(DIRPATH:str) -> PascalResult:
+    """
+    Parse the str(tuple) text output of older runPascal.py versions. Per-gene p-values are not recovered.
+    Records are streamed into compact typed arrays with interned gene names, so memory is O(modules + memberships)
+    rather than a multiple of the file size.
+    """
+    geneToId = {}
+    moduleIndex = array("q")
+    modulePval = array("d")
+    geneOffsets = array("q", [0])
+    geneIds = array("i")
+    for index, genes, pval in iterLegacyPascalRecords(DIRPATH):
+        moduleIndex.append(index)
+        modulePval.append(pval)
+        geneIds.extend(geneToId.setdefault(gene, len(geneToId)) for gene in genes)
+        geneOffsets.append(len(geneIds))
+    return PascalResult(np.array(moduleIndex, dtype=np.int64),
+                        np.array(modulePval, dtype=np.float64),
+                        np.array(geneOffsets, dtype=np.int64),
+                        np.array(geneIds, dtype=np.int32),
+                        np.array(list(geneToId), dtype=str))
+
+def legacyOutputName(DIRPATH:str) -> str:
+    # study_trait_network.txt naming used downstream, whatever the output format
+    return os.path.splitext(DIRPATH)[0] + ".txt"
@@ -1,28 +1,134 @@
 import argparse
+import functools
 import pandas as pd
 import os
+from typing import List
 
-def extractGeneSetFromModuleFile(MODULEPATH:str):
+from backgroundWriter import BackgroundWriter, addWriterArguments
+from geneScoreStore import readScoreTable
+from randomPermutation import load_permuted_scores, permutation_digest
+from moduleIndex import cachedModuleFiles, universeDigest
+from profiling import phase, profiled
+from resultCache import addCacheArguments, cachedRun, openCache
+
+def readModuleFile(MODULEPATH:str) -> List[List[str]]:
+    """
+    Read a module file once and split every line into its columns.
+    It assumes the input file is tsv format: module index, 1.0, then the genes of the module.
+
+    Args:
+        MODULEPATH (str): path to the module file
+
+    Returns:
+        List[List[str]]: columns of each line in the module file
+    """
+    with open(MODULEPATH, "r") as f:
+        return [line.split() for line in f]
+
+def extractGeneSetFromModuleFile(MODULEPATH:str, moduleLines: List[List[str]] = None):
     """
     Read a module file and extract a set of genes in the file. 
     It assumes the input file is tsv format where the gene name starts to appear from the thrid column
 
     Args:
         DIRPATH (str): path to the module file
+        moduleLines (List[List[str]]): output of readModuleFile. If given, MODULEPATH is not read.
 
     Returns:
         _type_: set of genes appear in the module file
     """
+    if moduleLines is None:
+        moduleLines = readModuleFile(MODULEPATH)
     ret = set()
-    with open(MODULEPATH, "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            columns = line.split()
-            for column in columns[2:]:
-                ret.add(column)
+    for columns in moduleLines:
+        ret.update(columns[2:])
     return ret
 
-def pairwiseProcessGeneScoreAndModule(GSPATH: str, MODULEPATH: str, OUTPUTPATH: str, pipeline: str, trait: str, geneNameCol: str, pvalCol: str, sep: str = ',') -> None:
+class GeneScoreIndex:
+    """
+    Gene score table parsed once and shared by every module file of a score file.
+
+    Args:
+        df_gs (pd.DataFrame): gene score table
+        geneNameCol (str): Column name for gene name in the gene score file.
+        pvalCol (str): Column name for the p-value in the gene score file.
+    """
+    def __init__(self, df_gs: pd.DataFrame, geneNameCol: str, pvalCol: str):
+        self.genes = df_gs[geneNameCol]
+        self.genesWithScore = set(self.genes)
+        # Content of the processed gene score file, identical for every module file
+        self.gsText = "".join(f"{gene}\t{pval}\n" for gene, pval in zip(self.genes.tolist(), df_gs[pvalCol].tolist()))
+        self._genesDigest = None
+
+    @property
+    def genesDigest(self) -> str:
+        # key of the module index cache, identical for every permutation of the same score file
+        if self._genesDigest is None:
+            self._genesDigest = universeDigest(self.genesWithScore)
+        return self._genesDigest
+
+    def backgroundGenes(self, intersectingGenes: set) -> List[str]:
+        # Genes of the score file (in file order) that also appear in the module file
+        return self.genes[self.genes.isin(intersectingGenes)].tolist()
+
+def processGeneScoreAndModule(gsIndex: GeneScoreIndex, MODULEPATH: str, OUTPUTPATH: str, pipeline: str, trait: str, moduleIndexDir: str = None,
+                              writer: BackgroundWriter = None) -> None:
+    """
+    Write the processed gene score, GO background and module files for one module file.
+    The gene score file must already be parsed into gsIndex; the module file is read once.
+    With moduleIndexDir, the Module_ file is copied from the module index cache (see moduleIndex.py), which is built
+    only once per network and score gene universe, and the GO_ file holds the cached background genes.
+
+    Args:
+        gsIndex (GeneScoreIndex): parsed gene score file.
+        MODULEPATH (str): Path to the pre-defined module file.
+        OUTPUTPATH (str): Path to the output directory.
+        pipeline (str): Name of the pipeline, e.g., twas, gwas, staar, or cma.
+        trait (str): Name of the trait.
+        moduleIndexDir (str): Path to the module index cache. None to always rebuild the Module_ and GO_ files.
+        writer (BackgroundWriter): writes the files in the background; they are complete after writer.flush().
+            None to write them inline.
+
+    Returns:
+        None.
+    """
+    moduleFileName = MODULEPATH.split("/")[-1]
+    ownWriter = writer is None
+    if ownWriter:
+        writer = BackgroundWriter(0)
+    if moduleIndexDir:
+        modulePath, goPath = cachedModuleFiles(MODULEPATH, moduleIndexDir, gsIndex.genes, gsIndex.genesWithScore, gsIndex.genesDigest)
+        writer.writeText(os.path.join(OUTPUTPATH, f"GS_{pipeline}_{trait}_{moduleFileName[:-4]}.tsv"), gsIndex.gsText)
+        # the cache entry may have been built from a permutation with another gene order; GO_ files follow this score file
+        with open(goPath, "r") as f:
+            background = set(f.read().split("\n"))
+        writer.writeText(os.path.join(OUTPUTPATH, f"GO_{pipeline}_{trait}_{moduleFileName[:-4]}.txt"),
+                         "".join(f"{gene}\n" for gene in gsIndex.backgroundGenes(background)))
+        writer.copyFile(modulePath, os.path.join(OUTPUTPATH, f"Module_{pipeline}_{trait}_{moduleFileName[:-4]}.tsv"))
+        if ownWriter:
+            writer.close()
+        return
+
+    moduleLines = readModuleFile(MODULEPATH)
+    genesInModule = extractGeneSetFromModuleFile(MODULEPATH, moduleLines)
+    intersectingGenes = gsIndex.genesWithScore.intersection(genesInModule)
+    
+    # Output processed gene score file to be used for PASCAL
+    writer.writeText(os.path.join(OUTPUTPATH, f"GS_{pipeline}_{trait}_{moduleFileName[:-4]}.tsv"), gsIndex.gsText)
+    
+    # Output GO background set file
+    writer.writeText(os.path.join(OUTPUTPATH, f"GO_{pipeline}_{trait}_{moduleFileName[:-4]}.txt"),
+                     "".join(f"{gene}\n" for gene in gsIndex.backgroundGenes(intersectingGenes)))
+    
+    # Output processed module file after intersecting with the gene score file
+    # Column[1] is always 1.0, so dropped
+    writer.writeText(os.path.join(OUTPUTPATH, f"Module_{pipeline}_{trait}_{moduleFileName[:-4]}.tsv"),
+                     "".join(columns[0] + "".join("\t" + gene for gene in columns[2:] if gene in intersectingGenes) + "\n"
+                             for columns in moduleLines))
+    if ownWriter:
+        writer.close()
+
+def pairwiseProcessGeneScoreAndModule(GSPATH: str, MODULEPATH: str, OUTPUTPATH: str, pipeline: str, trait: str, geneNameCol: str, pvalCol: str, sep: str = ',', df_gs: pd.DataFrame = None) -> None:
     """
     Process a pair of gene score file and module file, dropping genes that do not exist in either file.
     Write a pair of processed files with the same name. These processed files will be used as input for Pascal module enrichment.
@@ -37,72 +143,99 @@ def pairwiseProcessGeneScoreAndModule(GSPATH: str, MODULEPATH: str, OUTPUTPATH:
         geneNameCol (str): Column name for gene name in the gene score file.
         pvalCol (str): Column name for the p-value in the gene score file.
         sep (str): Separator used in the gene score file. If the file is tab-separated, pass '\t'. The default is a comma (',').
+        df_gs (pd.DataFrame): Already loaded gene score table. If given, GSPATH is not read.
 
     Returns:
         None. The processed gene score file, processed module file, and the GO background set file are saved to the corresponding directories.
     """
     
     # Read the gene score file
-    df_gs = pd.read_csv(GSPATH, sep=sep) 
-    genesWithScore = set(df_gs[geneNameCol])
-    genesInModule = extractGeneSetFromModuleFile(MODULEPATH)
-    intersectingGenes = genesWithScore.intersection(genesInModule)
-    
-    moduleFileName = MODULEPATH.split("/")[-1]
-    # Output processed gene score file to be used for PASCAL
-    with open(os.path.join(OUTPUTPATH, f"GS_{pipeline}_{trait}_{moduleFileName[:-4]}.tsv"), "w") as f:
-        for index, row in df_gs.iterrows():
-            f.write(row[geneNameCol] + "\t" + str(row[pvalCol]) + "\n")
-    
-    # Output GO background set file
-    with open(os.path.join(OUTPUTPATH, f"GO_{pipeline}_{trait}_{moduleFileName[:-4]}.txt"), "w") as f:
-        for index, row in df_gs.iterrows():
-            if row[geneNameCol] in intersectingGenes:
-                f.write(f"{row[geneNameCol]}\n")
-    
-    # Output processed module file after intersecting with the gene score file
-    with open(os.path.join(OUTPUTPATH, f"Module_{pipeline}_{trait}_{moduleFileName[:-4]}.tsv"), "w") as f:
-        with open(MODULEPATH, "r") as g:
-            droppedGeneCounter = 0
-            lines = g.readlines()
-            for line in lines:
-                columns = line.split()
-                f.write(columns[0])  # Write the module index
-                for column in columns[2:]:  # Column[1] is always 1.0, so dropped
-                    if column in intersectingGenes:
-                        f.write("\t" + column)
-                    else:
-                        droppedGeneCounter += 1
-                f.write("\n")
+    if df_gs is None:
+        df_gs = readScoreTable(GSPATH, geneNameCol, pvalCol, sep)
+    processGeneScoreAndModule(GeneScoreIndex(df_gs, geneNameCol, pvalCol), MODULEPATH, OUTPUTPATH, pipeline, trait)
 
 
+@profiled("main")
 def main():
     # Create argument parser
     parser = argparse.ArgumentParser(description="Preprocess a pair of GS and module file")
     
     # Add arguments to parser
-    parser.add_argument("scoreFile", help="Path to the scoreFile.")
+    parser.add_argument("scoreFile", help="Path to the scoreFile (CSV or gene score store, see geneScoreStore.py).")
     parser.add_argument("moduleFileDir", help="Path to the moduleFile.")
     parser.add_argument("outputPath", help="Path to the output directory.")
     parser.add_argument("pipelineName", help="Name of the pipeline.")
     parser.add_argument("traitName", help="Name of the trait.")
     parser.add_argument("geneNameCol", help="Name of the column for gene name in the score file.")
     parser.add_argument("pvalCol", help="Name of the column for p-value in the score file.")
+    parser.add_argument("--permutationFile", help="Permutation matrix from randomPermutation.py --batch. If given, scoreFile is the unpermuted score file.")
+    parser.add_argument("--rpIndex", type=int, help="RP index (seed) to read from --permutationFile.")
+    parser.add_argument("--rpIndices", help="Comma-separated RP indices (seeds) to read from --permutationFile, processed in one run.")
+    parser.add_argument("--moduleIndexDir", help="Module index cache shared by all permutations (see moduleIndex.py).")
+    addCacheArguments(parser)
+    addWriterArguments(parser)
 
     
     # Parse the arguments
     args = parser.parse_args()
-    rp_index = os.path.basename(args.scoreFile).split("-")[0]
-    traitWithRPIndex = f"{rp_index}-{args.traitName}"
+    cache = openCache(args.cacheDir, args.cacheMaxSize)
     # Check if the output directory exists, if not create it
     if not os.path.exists(args.outputPath):
         os.makedirs(args.outputPath)
-        
-    for file in os.listdir(args.moduleFileDir):
-        if file.endswith(".txt"):
-            filePath = os.path.join(args.moduleFileDir, file)
-            pairwiseProcessGeneScoreAndModule(args.scoreFile, filePath, args.outputPath, args.pipelineName, traitWithRPIndex, args.geneNameCol, args.pvalCol)
+    moduleFiles = [os.path.join(args.moduleFileDir, file) for file in os.listdir(args.moduleFileDir) if file.endswith(".txt")]
+    # output files are written inline, or in the background while the next module files are processed (--writeWorkers),
+    # and flushed at the end of the task; a cached step needs its files complete before they are stored, so it flushes
+    # them itself
+    writer = BackgroundWriter(args.writeWorkers, fsync=args.fsync)
+
+    def readScoreFile():
+        with phase("read", file=args.scoreFile):
+            return readScoreTable(args.scoreFile, args.geneNameCol, args.pvalCol)
+
+    if args.permutationFile:
+        if args.rpIndex is None and args.rpIndices is None:
+            parser.error("--rpIndex or --rpIndices is required with --permutationFile")
+        rpIndices = [args.rpIndex] if args.rpIndices is None else [int(rp) for rp in args.rpIndices.split(",")]
+        # the unpermuted score file is parsed once for the whole chunk of permutations, and only on a cache miss
+        loaded = {}
+        def loadScores(rpIndex):
+            if "df" not in loaded:
+                loaded["df"] = readScoreFile()
+            with phase("permute", file=args.permutationFile):
+                return load_permuted_scores(args.scoreFile, args.permutationFile, args.geneNameCol, rpIndex, loaded["df"])
+        runs = [(str(rpIndex), functools.partial(loadScores, rpIndex), permutation_digest(args.permutationFile, rpIndex))
+                for rpIndex in rpIndices]
+    else:
+        runs = [(os.path.basename(args.scoreFile).split("-")[0], readScoreFile, None)]
+
+    for rp_index, loadRun, permutationDigest in runs:
+        traitWithRPIndex = f"{rp_index}-{args.traitName}"
+        # The score file is parsed once and reused for every module file
+        gsIndex = {}
+        def compute(filePath):
+            if "index" not in gsIndex:
+                df_gs = loadRun()
+                with phase("parse"):
+                    gsIndex["index"] = GeneScoreIndex(df_gs, args.geneNameCol, args.pvalCol)
+            with phase("process", file=filePath):
+                processGeneScoreAndModule(gsIndex["index"], filePath, args.outputPath, args.pipelineName, traitWithRPIndex, args.moduleIndexDir,
+                                          writer)
+            if cache is not None:
+                writer.flush(fsync=False)
+            network = os.path.basename(filePath)[:-4]
+            return [os.path.join(args.outputPath, f"{prefix}_{args.pipelineName}_{traitWithRPIndex}_{network}{suffix}")
+                    for prefix, suffix in [("GS", ".tsv"), ("GO", ".txt"), ("Module", ".tsv")]]
+        for filePath in moduleFiles:
+            params = {"pipeline": args.pipelineName, "trait": traitWithRPIndex, "geneNameCol": args.geneNameCol,
+                      "pvalCol": args.pvalCol, "permutation": permutationDigest, "moduleIndexDir": bool(args.moduleIndexDir),
+                      "moduleFile": os.path.basename(filePath)}
+            cachedRun(cache, "preProcessForPascal", [args.scoreFile, filePath], params, args.outputPath,
+                      functools.partial(compute, filePath))
+    with phase("flush"):
+        writer.close()
+    if cache is not None:
+        cache.enforceSizeLimit()
     
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,16 +1,22 @@
 import argparse
 import os
 import re
-import shutil
-from typing import List
+from typing import Dict, List
 import csv
-import functools as ft
-import ast
-from cmath import nan
+import numpy as np
 import pandas as pd
-import statsmodels.stats.multitest as smt
 from statsmodels.sandbox.stats.multicomp import multipletests
 
+from backgroundWriter import BackgroundWriter, addWriterArguments, atomicWrite
+from geneScoreStore import processedGeneScoreFile, readProcessedGeneScores
+from pascalResultIO import readPascalResult, legacyOutputName
+from profiling import phase, profiled
+from summaryIO import SummaryWriter, summaryFileName, writeSummary
+from resultCache import addCacheArguments, cachedRun, openCache
+
+# sig, sig1, sig2, sig3 and sig4 genes: pval < sigPvalThreshold * 10**tier
+NUM_SIG_TIERS = 5
+
 def countLinesInTSVfile(FILEPATH:str, sep ="\t"):
     line_count = 0
 
@@ -33,47 +39,58 @@ def extractGenesBasedOnPval(DIRPATH:str, pval:float):
     Returns:
         _type_: list of significant genes
     """
-    df = pd.read_table(DIRPATH, header=None)
-    return list(df[df[1] < pval][0])
+    genes, pvals = readProcessedGeneScores(DIRPATH)
+    return genes[np.flatnonzero(np.asarray(pvals) < pval)].tolist()
 
-def saveSignificantModules(OUTPUTPATH:str, genes:List[str]) -> None:
-    with open(OUTPUTPATH, 'w') as f:
-        for gene in genes:
-            f.write(f'{gene}\n')
+def saveSignificantModules(OUTPUTPATH:str, genes:List[str], writer:BackgroundWriter = None) -> None:
+    # written atomically, in the background with a writer
+    text = "".join(f'{gene}\n' for gene in genes)
+    if writer is None:
+        atomicWrite(OUTPUTPATH, text)
+    else:
+        writer.writeText(OUTPUTPATH, text)
 def saveDummyModule(OUTPUTPATH:str) -> None:
     with open(OUTPUTPATH, 'w') as f:
         f.write(f'-1')
-def recordModulesFromPascalResult(result, OUTPUTPATH, sigGenesList, almostSigGenesList, sig4GenesList,
-                                             sig3GenesList, sig2GenesList, study, trait, network):
+def computeGeneSignificanceTiers(DIRPATH:str, sigPvalThreshold:float) -> Dict[str, int]:
+    """
+    Given a GeneScore file in tsv file format without header, read it once and assign every gene the most
+    significant tier it belongs to. Tier j (0: sig, 1-4: sig1-sig4) holds the genes with pval less than
+    sigPvalThreshold * 10**j, so a gene of tier t is also in every tier j >= t.
+
+    Args:
+        DIRPATH (str): Path to GS file in tsv format. ASSUMPTION: the first col is gene name and the second col is pval
+        sigPvalThreshold (float): pvalue threshold of tier 0
+
+    Returns:
+        Dict[str, int]: gene -> tier of the genes in a tier; look genes up with .get(gene, NUM_SIG_TIERS)
+    """
+    genes, pvals = readProcessedGeneScores(DIRPATH)
+    thresholds = np.array([sigPvalThreshold * 10**j for j in range(NUM_SIG_TIERS)])
+    # number of thresholds <= pval, i.e. the first tier whose threshold is above pval (nan -> NUM_SIG_TIERS)
+    pvalTiers = np.searchsorted(thresholds, np.asarray(pvals), side="right")
+    # only the names of genes in a tier are read; the others default to NUM_SIG_TIERS
+    inTier = np.flatnonzero(pvalTiers < NUM_SIG_TIERS)
+    pvalTiers = pvalTiers[inTier]
+    # intern gene names; a duplicated gene keeps its most significant tier
+    geneIds, genes = pd.factorize(genes[inTier].astype(object))
+    geneTiers = np.full(len(genes), NUM_SIG_TIERS)
+    hasName = geneIds >= 0
+    np.minimum.at(geneTiers, geneIds[hasName], pvalTiers[hasName])
+    return dict(zip(genes.tolist(), geneTiers.tolist()))
+
+def recordModulesFromPascalResult(result, OUTPUTPATH, geneTiers, study, trait, network, writer:BackgroundWriter = None):
     moduleIndexToSize = {}
     moduleIndexToModulePval = {}
     moduleIndexToCorrectedModulePval = {}
     moduleIndexToSigFlag = {}
-    moduleIndexSigGenes = {}
-    moduleIndexAlmostSigGenes = {}
-    moduleIndexToSig4Genes = {}
-    moduleIndexToSig3Genes = {}
-    moduleIndexToSig2Genes = {}
+    # sig, sig1, sig2, sig3, sig4 genes of every module
+    moduleIndexToTierGenes = [{} for _ in range(NUM_SIG_TIERS)]
     # each item represents a module
     for item in result:
-        sigGenes = []
-        almostSigGenes = []
-        sig4Genes = []
-        sig3Genes = []
-        sig2Genes = []
-        moduleSizeCounter = 0
-        for gene in item[1]:
-            moduleSizeCounter += 1
-            if gene in sigGenesList:
-                sigGenes.append(gene)
-            if gene in almostSigGenesList:
-                almostSigGenes.append(gene)
-            if gene in sig4GenesList:
-                sig4Genes.append(gene)
-            if gene in sig3GenesList:
-                sig3Genes.append(gene)
-            if gene in sig2GenesList:
-                sig2Genes.append(gene)        
+        tiers = [geneTiers.get(gene, NUM_SIG_TIERS) for gene in item[1]]
+        for tier, moduleIndexToGenes in enumerate(moduleIndexToTierGenes):
+            moduleIndexToGenes[item[0]] = [gene for gene, geneTier in zip(item[1], tiers) if geneTier <= tier]
                 
         # assumes index of 2 represents bool indicating significance of the module
         if item[2]:
@@ -81,102 +98,90 @@ def recordModulesFromPascalResult(result, OUTPUTPATH, sigGenesList, almostSigGen
             dir_out = os.path.dirname(OUTPUTPATH)
             file_out = f"sig_{os.path.basename(OUTPUTPATH).replace('.txt', f'_{item[0]}.txt')}"
             sigModuleOutName = os.path.join(dir_out, file_out)
-            saveSignificantModules(sigModuleOutName, item[1])
+            saveSignificantModules(sigModuleOutName, item[1], writer)
         else:
             moduleIndexToSigFlag[item[0]] = False
             # saveDummyModule(os.path.join(os.path.dirname(OUTPUTPATH), f"dummy_{study}_{trait}_{network}_{item[0]}.txt"))
-        moduleIndexToSize[item[0]] = moduleSizeCounter
+        moduleIndexToSize[item[0]] = len(item[1])
         moduleIndexToModulePval[item[0]] = item[4]
         moduleIndexToCorrectedModulePval[item[0]] = item[3]
-        moduleIndexSigGenes[item[0]] = sigGenes
-        moduleIndexAlmostSigGenes[item[0]] = almostSigGenes
-        moduleIndexToSig4Genes[item[0]] = sig4Genes
-        moduleIndexToSig3Genes[item[0]] = sig3Genes
-        moduleIndexToSig2Genes[item[0]] = sig2Genes
 
-    return moduleIndexToSize, moduleIndexToModulePval, moduleIndexToCorrectedModulePval, moduleIndexToSigFlag, moduleIndexSigGenes, moduleIndexAlmostSigGenes, moduleIndexToSig4Genes, moduleIndexToSig3Genes, moduleIndexToSig2Genes
+    return (moduleIndexToSize, moduleIndexToModulePval, moduleIndexToCorrectedModulePval, moduleIndexToSigFlag,
+            *moduleIndexToTierGenes)
                     
 
+def writePascalResultCsv(OUTPUTPATH:str, pascalResult, scored:np.ndarray, pvals:np.ndarray, correctedPvals:np.ndarray) -> None:
+    """
+    Write the scored modules one row at a time, in the same format as DataFrame.to_csv of
+    moduleIndex, moduleGenes, modulePval, correctedModulePval with the row number as unnamed index column.
+    """
+    with open(OUTPUTPATH, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["", "moduleIndex", "moduleGenes", "modulePval", "correctedModulePval"])
+        for row, (i, pval, correctedPval) in enumerate(zip(scored.tolist(), pvals.tolist(), correctedPvals.tolist())):
+            writer.writerow([row, int(pascalResult.moduleIndex[i]), str(pascalResult.moduleGenes(i)), repr(pval), repr(correctedPval)])
+
 def processOnePascalOutput(DIRPATH:str, alpha:float, outputPATH:str):
     """
-    Given a path to a pascal output file, extract module index, module genes, and BH-corrected module pvalue
+    Given a path to a pascal output file, extract module index, module genes, and BH-corrected module pvalue.
+    Only the compact arrays of the parsed result (module index, p-value, gene ids) are held; gene lists are built one
+    module at a time, while writing outputPATH and while iterating over the returned modules.
 
     Args:
-        DIRPATH (str): path to a pascal output file
+        DIRPATH (str): path to a pascal output file, structured (.npz) or legacy text (.txt)
         alpha (float): significance threshold for modules pvalue after BH correction
-        outputPATH (str): path to save the whole pascal result
+        outputPATH (str): path to save the whole pascal result, None to skip it
 
     Returns:
-        _type_: list of processed module info, total number of significant pathways
+        _type_: iterator of processed module info sorted by module pvalue, total number of significant pathways
     """
-    with open(DIRPATH, "r") as f:
-        results = f.read()
-        # flatten pval parts
-        results = results.replace(",\n", ",")
-        results = results.replace(" ", "")
-        # 0: module index, 1: module genes, 2: gene uniform pval, 3: module uncorrected pval
-        parsedResults = re.findall("\[(.+?),(.*?),array\((.*)\),(.*?)\]", results)
-        
-        pathwayIndexList = []
-        pathwayGenesList = []
-        pathwayPvalList = []
-        
-        for i in range(len(parsedResults)):
-            # if a module lost all genes due to missing gene score, exclude it from FDR
-            if parsedResults[i][3] != "nan": 
-                # ex) "'5'" -> 5
-                pathwayIndexList.append(int(parsedResults[i][0].replace("'", "")))
-                # string list to list conversion via ast.literal_eval
-                pathwayGenesList.append(ast.literal_eval(parsedResults[i][1]))
-                pathwayPvalList.append(float(parsedResults[i][3]))
-        
-        # FDR correction BH or Bonferroni
-        #correctedPathwayPvalList = smt.fdrcorrection(pathwayPvalList, alpha) # BH
-        correctedPathwayPvalList = multipletests(pathwayPvalList, alpha, method='bonferroni') #Bonferroni
-        
-        # output csv file 
-        df = pd.DataFrame(list(zip(pathwayIndexList, pathwayGenesList,
-                           pathwayPvalList, correctedPathwayPvalList[1])),
-                          columns=['moduleIndex', 'moduleGenes', 'modulePval', 'correctedModulePval'])
-        df.to_csv(outputPATH)
-        
-        result = []
-        
-        numSigPathway = sum(correctedPathwayPvalList[0])
-        for tup in zip(pathwayIndexList, pathwayGenesList,
-                       correctedPathwayPvalList[0], correctedPathwayPvalList[1], pathwayPvalList):
-            result.append(tup)
-        # sort by corrected module pvalue
-        result.sort(key=lambda x: x[-1])
-        return result, numSigPathway
-
-def main():
-    # Create argument parser
-    parser = argparse.ArgumentParser(description="Randomly permute the first column of a CSV file.")
+    with phase("parse", file=DIRPATH):
+        pascalResult = readPascalResult(DIRPATH)
     
-    # Add arguments to parser
-    parser.add_argument("pascalOutputFile", help="Path to the pascalOutputFile.")
-    parser.add_argument("alpha", type=float, help="significance threshold for modules pvalue after Bonferroni correction")
-    parser.add_argument("outputPath", help="Path to the output directory.")
-    parser.add_argument("geneScoreFilePath", help="Used to get total number of tests and extract significant genes at different levels.")
-    parser.add_argument("significantModulesOutDir", help="Path to the output directory for significant modules.")
-    parser.add_argument("numTests", type=int, help="total number of genes before merging categories")
+    # if a module lost all genes due to missing gene score, exclude it from FDR
+    scored = np.flatnonzero(~np.isnan(pascalResult.modulePval))
+    pathwayPvals = pascalResult.modulePval[scored]
     
-    # Parse the arguments
-    args = parser.parse_args()
+    # FDR correction BH or Bonferroni, once every module p-value is known
+    #correctedPathwayPvalList = smt.fdrcorrection(pathwayPvals, alpha) # BH
+    with phase("correct", file=DIRPATH):
+        correctedPathwayPvalList = multipletests(pathwayPvals, alpha, method='bonferroni') #Bonferroni
     
-    study = args.pascalOutputFile.split("_")[0]
-    trait = args.pascalOutputFile.split("_")[1]
-    network = args.pascalOutputFile.split("_")[2].replace(".txt", "")
-    rpIndex = trait.split("-")[0]
+    # output csv file 
+    if outputPATH is not None:
+        with phase("write", file=DIRPATH):
+            writePascalResultCsv(outputPATH, pascalResult, scored, pathwayPvals, correctedPathwayPvalList[1])
     
-    sigPvalThreshold = 0.05 / args.numTests
+    numSigPathway = sum(correctedPathwayPvalList[0])
+    # sort by module pvalue (stable, ties keep file order)
+    order = np.argsort(pathwayPvals, kind="stable").tolist()
+    result = ((int(pascalResult.moduleIndex[scored[j]]), pascalResult.moduleGenes(scored[j]), correctedPathwayPvalList[0][j],
+               correctedPathwayPvalList[1][j], float(pathwayPvals[j])) for j in order)
+    return result, numSigPathway
+
+def summarizePascalOutput(pascalOutputFile:str, alpha:float, pascalResultPath:str, geneScoreFilePath:str,
+                          significantModulesOutDir:str, numTests:int, writer:BackgroundWriter = None) -> pd.DataFrame:
+    """
+    Master summary rows of one pascal output file; significant modules are saved under significantModulesOutDir.
+
+    Args:
+        pascalOutputFile (str): pascal output file named study_trait_network(.npz|.txt)
+        alpha (float): significance threshold for modules pvalue after Bonferroni correction
+        pascalResultPath (str): path to save the whole pascal result
+        geneScoreFilePath (str): processed gene score file the pascal output was computed from
+        significantModulesOutDir (str): directory for the significant modules
+        numTests (int): total number of genes before merging categories
+        writer (BackgroundWriter): writes the significant modules in the background; they are complete after writer.flush()
+
+    Returns:
+        pd.DataFrame: master summary slice of the pascal output file
+    """
+    pascalOutputName = legacyOutputName(os.path.basename(pascalOutputFile))
+    study = pascalOutputName.split("_")[0]
+    trait = pascalOutputName.split("_")[1]
+    network = pascalOutputName.split("_")[2].replace(".txt", "")
     
-    # Check if the output directory exists, if not create it
-    if not os.path.exists(args.outputPath):
-        os.makedirs(args.outputPath)
-    if not os.path.exists(args.significantModulesOutDir):
-        os.makedirs(args.significantModulesOutDir)
+    sigPvalThreshold = 0.05 / numTests
 
     # master summary file columns
     summary_dict = {'study':[],
@@ -196,17 +201,14 @@ def main():
                     }
     
     # create summary file for one pascal output file.
-    result, numSigPathway = processOnePascalOutput(args.pascalOutputFile, args.alpha, os.path.join(args.outputPath, "pascalResult.csv"))
-    sigGenesList = extractGenesBasedOnPval(args.geneScoreFilePath,sigPvalThreshold)
-    sig1GenesList = extractGenesBasedOnPval(args.geneScoreFilePath, sigPvalThreshold*10)
-    sig2GenesList = extractGenesBasedOnPval(args.geneScoreFilePath, sigPvalThreshold*100)
-    sig3GenesList = extractGenesBasedOnPval(args.geneScoreFilePath, sigPvalThreshold*1000)
-    sig4GenesList = extractGenesBasedOnPval(args.geneScoreFilePath, sigPvalThreshold*10000)
-    sigModulesPath = os.path.join(args.significantModulesOutDir, args.pascalOutputFile)
+    result, numSigPathway = processOnePascalOutput(pascalOutputFile, alpha, pascalResultPath)
+    with phase("geneTiers", file=geneScoreFilePath):
+        geneTiers = computeGeneSignificanceTiers(geneScoreFilePath, sigPvalThreshold)
+    sigModulesPath = os.path.join(significantModulesOutDir, pascalOutputName)
     print(sigModulesPath)
-    print(args.outputPath)
-    moduleToSize, moduleToPval, moduleToCorrectedPval, isModuleSig, sigGenesDict, sig1GenesDict, sig2GenesDict, sig3GenesDict, sig4GenesDict = recordModulesFromPascalResult(result, sigModulesPath, 
-                                                                                                          sigGenesList, sig1GenesList, sig2GenesList, sig3GenesList, sig4GenesList, study, trait, network)
+    with phase("recordModules", file=pascalOutputFile):
+        moduleToSize, moduleToPval, moduleToCorrectedPval, isModuleSig, sigGenesDict, sig1GenesDict, sig2GenesDict, sig3GenesDict, sig4GenesDict = recordModulesFromPascalResult(result, sigModulesPath, 
+                                                                                                              geneTiers, study, trait, network, writer)
     for moduleIndex in sigGenesDict.keys():
         summary_dict['study'].append(study)
         summary_dict['trait'].append(trait)
@@ -223,8 +225,102 @@ def main():
         summary_dict['sig3Genes'].append(sig3GenesDict[moduleIndex])
         summary_dict['sig4Genes'].append(sig4GenesDict[moduleIndex])
     
-    df_summary = pd.DataFrame(summary_dict)
-    df_summary.to_csv(os.path.join(args.outputPath, f"master_summary_slice_{rpIndex}.csv"), index=False)
+    return pd.DataFrame(summary_dict)
+
+def significantModuleFiles(significantModulesOutDir:str, pascalOutputName:str) -> List[str]:
+    # sig_<study>_<trait>_<network>_<moduleIndex>.txt files written by recordModulesFromPascalResult
+    pattern = re.compile(re.escape(f"sig_{pascalOutputName.replace('.txt', '')}_") + r"\d+\.txt")
+    return sorted(os.path.join(significantModulesOutDir, file) for file in os.listdir(significantModulesOutDir) if pattern.fullmatch(file))
+
+@profiled("main")
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Randomly permute the first column of a CSV file.")
+    
+    # Add arguments to parser
+    parser.add_argument("pascalOutputFile", help="Path to the pascalOutputFile. With --batch, path to a manifest listing one pascalOutputFile per line.")
+    parser.add_argument("alpha", type=float, help="significance threshold for modules pvalue after Bonferroni correction")
+    parser.add_argument("outputPath", help="Path to the output directory.")
+    parser.add_argument("geneScoreFilePath", help="Used to get total number of tests and extract significant genes at different levels. "
+                                                  "With --batch, directory of the GS_<pascal output name>.tsv files "
+                                                  "or .gss stores.")
+    parser.add_argument("significantModulesOutDir", help="Path to the output directory for significant modules.")
+    parser.add_argument("numTests", type=int, help="total number of genes before merging categories")
+    parser.add_argument("--batch", action="store_true", help="summarize every pascal output of the manifest into one master_summary_chunk_<chunkName>.csv, "
+                                                             "with the significant modules of each in significantModulesOutDir/<pascal output name>/")
+    parser.add_argument("--chunkName", default="0", help="name of the chunk summary in --batch mode")
+    parser.add_argument("--summaryFormat", choices=["csv", "parquet"], default="csv",
+                        help="csv: gene lists as str(list) cells. parquet: typed columns, see summaryIO.py")
+    addCacheArguments(parser)
+    addWriterArguments(parser)
+    
+    # Parse the arguments
+    args = parser.parse_args()
+    cache = openCache(args.cacheDir, args.cacheMaxSize)
+    
+    # Check if the output directory exists, if not create it
+    if not os.path.exists(args.outputPath):
+        os.makedirs(args.outputPath)
+    if not os.path.exists(args.significantModulesOutDir):
+        os.makedirs(args.significantModulesOutDir)
+    print(args.outputPath)
+
+    # outputs are cached relative to the common root of both output directories
+    outputRoot = os.path.commonpath([os.path.abspath(args.outputPath), os.path.abspath(args.significantModulesOutDir)])
+    params = {"alpha": args.alpha, "numTests": args.numTests, "outputPath": os.path.relpath(args.outputPath, outputRoot),
+              "significantModulesOutDir": os.path.relpath(args.significantModulesOutDir, outputRoot),
+              "summaryFormat": args.summaryFormat}
+
+    # significant modules are written inline (or in the background with --writeWorkers) and flushed at the end of the task
+    writer = BackgroundWriter(args.writeWorkers, fsync=args.fsync)
+
+    if args.batch:
+        with open(args.pascalOutputFile, "r") as f:
+            pascalOutputFiles = [line.strip() for line in f if line.strip()]
+        names = [os.path.splitext(os.path.basename(pascalOutputFile))[0] for pascalOutputFile in pascalOutputFiles]
+        geneScoreFiles = [processedGeneScoreFile(args.geneScoreFilePath, name) for name in names]
+        outputFileName = os.path.join(args.outputPath, summaryFileName(f"master_summary_chunk_{args.chunkName}", args.summaryFormat))
+        def computeChunk():
+            # one summary file per chunk, written piece by piece; pascalResult.csv is only kept for single runs
+            out = SummaryWriter(outputFileName)
+            for pascalOutputFile, name, geneScoreFile in zip(pascalOutputFiles, names, geneScoreFiles):
+                # significant modules of every pascal output in their own directory, as in a single run
+                significantModulesOutDir = os.path.join(args.significantModulesOutDir, name)
+                os.makedirs(significantModulesOutDir, exist_ok=True)
+                df_summary = summarizePascalOutput(pascalOutputFile, args.alpha, None, geneScoreFile,
+                                                   significantModulesOutDir, args.numTests, writer)
+                out.write(df_summary)
+            out.close()
+            writer.addWritten(outputFileName)
+            with phase("flush"):
+                writer.flush()
+            return [outputFileName] + [file for pascalOutputFile, name in zip(pascalOutputFiles, names)
+                                       for file in significantModuleFiles(os.path.join(args.significantModulesOutDir, name),
+                                                                          legacyOutputName(os.path.basename(pascalOutputFile)))]
+        cachedRun(cache, "processPascalOutputChunk", pascalOutputFiles + geneScoreFiles,
+                  {**params, "chunkName": args.chunkName, "names": names}, outputRoot, computeChunk)
+        for name in names:
+            # pascal outputs without significant modules still get their (empty) directory
+            os.makedirs(os.path.join(args.significantModulesOutDir, name), exist_ok=True)
+    else:
+        pascalOutputName = legacyOutputName(args.pascalOutputFile)
+        rpIndex = pascalOutputName.split("_")[1].split("-")[0]
+        pascalResultPath = os.path.join(args.outputPath, "pascalResult.csv")
+        slicePath = os.path.join(args.outputPath, summaryFileName(f"master_summary_slice_{rpIndex}", args.summaryFormat))
+        def compute():
+            df_summary = summarizePascalOutput(args.pascalOutputFile, args.alpha, pascalResultPath,
+                                               args.geneScoreFilePath, args.significantModulesOutDir, args.numTests, writer)
+            writeSummary(df_summary, slicePath)
+            writer.addWritten(slicePath)
+            writer.addWritten(pascalResultPath)
+            with phase("flush"):
+                writer.flush()
+            return [slicePath, pascalResultPath] + significantModuleFiles(args.significantModulesOutDir, os.path.basename(pascalOutputName))
+        cachedRun(cache, "processPascalOutput", [args.pascalOutputFile, args.geneScoreFilePath],
+                  {**params, "name": os.path.basename(pascalOutputName)}, outputRoot, compute)
+    writer.close()
+    if cache is not None:
+        cache.enforceSizeLimit()
                     
 
     
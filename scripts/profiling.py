@@ -0,0 +1,160 @@
+import argparse
+import contextlib
+import functools
+import json
+import os
+import socket
+import sys
+import time
+from typing import Callable, Iterator, List
+
+"""
+Opt-in per-phase instrumentation of the pipeline scripts.
+
+With MEA_PROFILE set to a directory (absolute, shared by all tasks of a run), every phase of a script records one JSON
+line in MEA_PROFILE/<script>_<host>_<pid>.jsonl:
+
+    script, phase, file     script name, phase name (read, parse, compute, write, ...), input file of the phase if any
+    wallSeconds, cpuSeconds wall clock and CPU time (user + system) of the phase
+    maxRssMB                peak resident set size of the process at the end of the phase
+    rssGrowthMB             how much the phase raised that peak
+    task, host, pid, start  working directory (the Nextflow task hash), host, process id, epoch start time
+
+Without MEA_PROFILE, phase() returns a shared no-op context manager and profiled() returns the function itself, so the
+instrumentation costs one function call per phase.
+
+    with phase("parse", file=pascalOutputFile):
+        ...
+
+The report command rolls the records of all tasks up into a per-phase hotspot table, slowest phases first.
+
+Usage:
+MEA_PROFILE=/scratch/profile/run1 nextflow run mea_slurm.nf ...
+python3 profiling.py report /scratch/profile/run1 [--by file] [--top 20] [--outputName hotspots.csv]
+"""
+
+PROFILE_DIR = os.environ.get("MEA_PROFILE")
+ENABLED = bool(PROFILE_DIR)
+_NULL = contextlib.nullcontext()
+_output = None
+
+def _maxRssMB() -> float:
+    import resource
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _write(record:dict) -> None:
+    global _output
+    if _output is None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python"
+        # one file per process: worker processes of a pool never interleave their lines
+        _output = open(os.path.join(PROFILE_DIR, f"{script}_{socket.gethostname()}_{os.getpid()}.jsonl"), "a")
+    _output.write(json.dumps(record) + "\n")
+    _output.flush()
+
+class _Phase:
+    def __init__(self, name:str, file:str):
+        self.name = name
+        self.file = file
+
+    def __enter__(self):
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.rss = _maxRssMB()
+        return self
+
+    def __exit__(self, *exc):
+        maxRss = _maxRssMB()
+        _write({"script": os.path.splitext(os.path.basename(sys.argv[0]))[0], "phase": self.name, "file": self.file,
+                "wallSeconds": time.perf_counter() - self.wall, "cpuSeconds": time.process_time() - self.cpu,
+                "maxRssMB": maxRss, "rssGrowthMB": maxRss - self.rss, "task": os.path.basename(os.getcwd()),
+                "host": socket.gethostname(), "pid": os.getpid(), "start": self.start})
+        return False
+
+def phase(name:str, file:str = None):
+    """
+    Context manager timing one phase of a script.
+
+    Args:
+        name (str): phase name, e.g. read, parse, compute, write
+        file (str): input file the phase works on, None for the whole run
+    """
+    if not ENABLED:
+        return _NULL
+    return _Phase(name, None if file is None else str(file))
+
+def profiled(name:str) -> Callable:
+    # decorator form of phase(); the function is returned unchanged when profiling is off
+    def decorate(function):
+        if not ENABLED:
+            return function
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Phase(name, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def readRecords(paths:List[str]) -> Iterator[dict]:
+    for path in paths:
+        files = [path] if os.path.isfile(path) else sorted(os.path.join(root, file) for root, _, files in os.walk(path)
+                                                            for file in files if file.endswith(".jsonl"))
+        for file in files:
+            with open(file, "r") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+def hotspotReport(records, by:str = "phase"):
+    """
+    Roll the phase records of a run up per (script, phase), or per (script, phase, file) with by="file".
+
+    Returns:
+        pd.DataFrame: calls, total/mean/max wall and CPU seconds, share of the total wall time, peak RSS; slowest first
+    """
+    keys = ["script", "phase"] + (["file"] if by == "file" else [])
+    records = records.assign(file=records["file"].fillna(""))
+    report = records.groupby(keys, sort=False).agg(calls=("wallSeconds", "size"),
+                                                  totalWallSeconds=("wallSeconds", "sum"),
+                                                  meanWallSeconds=("wallSeconds", "mean"),
+                                                  maxWallSeconds=("wallSeconds", "max"),
+                                                  totalCpuSeconds=("cpuSeconds", "sum"),
+                                                  maxRssMB=("maxRssMB", "max"),
+                                                  tasks=("task", "nunique")).reset_index()
+    # phases nest (e.g. a per-file phase inside a whole-run phase), so shares are relative to the largest phase total
+    report["wallShare"] = report["totalWallSeconds"] / report["totalWallSeconds"].max()
+    report["cpuUtilization"] = report["totalCpuSeconds"] / report["totalWallSeconds"]
+    return report.sort_values("totalWallSeconds", ascending=False, kind="stable").reset_index(drop=True)
+
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Per-phase hotspot report of the MEA_PROFILE records of a run.")
+
+    # Add arguments to parser
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("paths", nargs="+", help="MEA_PROFILE directories or .jsonl files")
+    parser.add_argument("--by", choices=["phase", "file"], default="phase", help="roll up per phase or per phase and input file")
+    parser.add_argument("--top", type=int, default=30, help="number of rows printed")
+    parser.add_argument("--outputName", help="write the full report to this CSV")
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # pandas is only needed by the report, not by the instrumented scripts
+    import pandas as pd
+    records = pd.DataFrame(list(readRecords(args.paths)))
+    if len(records) == 0:
+        print("no profile records found")
+        return
+    report = hotspotReport(records, args.by)
+    print(f"{len(records)} records from {records['task'].nunique()} tasks, {records['pid'].nunique()} processes")
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.max_colwidth", 60):
+        print(report.head(args.top).to_string(index=False, float_format=lambda x: f"{x:.3g}"))
+    if args.outputName:
+        report.to_csv(args.outputName, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,41 @@
 import pandas as pd
+import numpy as np
 import argparse
+import hashlib
 import os
 
+from geneScoreStore import GeneScoreStore, isGeneScoreStore, readScoreTable
+from profiling import phase, profiled
+from resultCache import addCacheArguments, cachedRun, openCache
+
 """
 Given input_file_path, output_directory, columnToPermute, and seed, this function will:
 generate 1000 RP files in the output_directory. The RP files will have the same name as the input_file_path with the addition of the seed number. (ABI-1.csv, ABI-2.csv, ABI-3.csv, etc.)
 Seeds are integers from 1 to 1000.
 
+With --batch, the input file is read once and only the permuted row indices are saved, as a single
+(numRP x numRows) uint32 matrix in {base_name}_permutations.npy. Row k-1 holds the permutation for seed k,
+identical to the one used by permute_first_column, so RP file k can be rebuilt with load_permuted_scores
+without ever being written to disk.
+
+input_file_path may also be a gene score store (geneScoreStore.py); the RP files then hold its gene and p-value columns.
+
 Usage:
-python3 randomPermutation.py input_file_path output_directory columnToPermute 
+python3 randomPermutation.py input_file_path output_directory columnToPermute numRP [--batch]
 """
 
+def permutation_indices(num_rows, seed):
+    # Same draw as df[col].sample(frac=1, random_state=seed): RandomState(seed).permutation(num_rows)
+    return np.random.RandomState(seed).permutation(num_rows).astype(np.uint32)
+
 def permute_first_column(input_file_path, output_directory, columnToPermute, seed=None):
     # Step 1: Read the CSV file into a DataFrame
-    df = pd.read_csv(input_file_path)
+    with phase("read", file=input_file_path):
+        df = readScoreTable(input_file_path)
     
     # Step 2: Randomly permute the values in the specified column
-    df[columnToPermute] = df[columnToPermute].sample(frac=1, random_state=seed).values
+    with phase("permute"):
+        df[columnToPermute] = df[columnToPermute].sample(frac=1, random_state=seed).values
     
     # Step 3: Drop the 'Unnamed: 0' column if it exists
     if 'Unnamed: 0' in df.columns:
@@ -27,8 +46,68 @@ def permute_first_column(input_file_path, output_directory, columnToPermute, see
     base_name = os.path.splitext(os.path.basename(input_file_path))[0]
     output_file_name = f"{seed}-{base_name}.csv"
     output_file_path = os.path.join(output_directory, output_file_name)
-    df.to_csv(output_file_path, index=False)
+    with phase("write"):
+        df.to_csv(output_file_path, index=False)
+    return output_file_path
+
+def permutation_file_path(input_file_path, output_directory):
+    base_name = os.path.splitext(os.path.basename(input_file_path))[0]
+    return os.path.join(output_directory, f"{base_name}_permutations.npy")
+
+def write_permutation_matrix(input_file_path, output_directory, numRP, chunk_size=256):
+    """
+    Read the input file once and write the permuted row indices of seeds 1..numRP into one .npy file.
+
+    Args:
+        input_file_path (str): Path to the input CSV file.
+        output_directory (str): Directory to save the permutation matrix.
+        numRP (int): number of permutations
+        chunk_size (int): number of permutations generated before flushing to disk
+
+    Returns:
+        str: path to the (numRP x numRows) uint32 permutation matrix
+    """
+    with phase("read", file=input_file_path):
+        num_rows = len(GeneScoreStore(input_file_path)) if isGeneScoreStore(input_file_path) else len(pd.read_csv(input_file_path))
+    output_file_path = permutation_file_path(input_file_path, output_directory)
+    with phase("permute"):
+        matrix = np.lib.format.open_memmap(output_file_path, mode="w+", dtype=np.uint32, shape=(numRP, num_rows))
+        for start in range(0, numRP, chunk_size):
+            stop = min(start + chunk_size, numRP)
+            # row k-1 holds seed k
+            matrix[start:stop] = np.stack([permutation_indices(num_rows, seed) for seed in range(start + 1, stop + 1)])
+            matrix.flush()
+        del matrix
+    return output_file_path
+
+def load_permuted_scores(input_file_path, permutation_file, columnToPermute, seed, df=None):
+    """
+    Rebuild the DataFrame that permute_first_column would have written for the given seed.
+
+    Args:
+        input_file_path (str): Path to the input CSV file or gene score store. Not read when df is given.
+        permutation_file (str): Path to the matrix written by write_permutation_matrix.
+        columnToPermute (str): Name of the column to permute.
+        seed (int): seed (= RP index) of the permutation, starting from 1.
+        df (pd.DataFrame): already loaded input file, to avoid parsing it once per permutation.
+
+    Returns:
+        pd.DataFrame: the permuted score table
+    """
+    if df is None:
+        df = readScoreTable(input_file_path)
+    df = df.copy()
+    indices = np.load(permutation_file, mmap_mode="r")[seed - 1]
+    df[columnToPermute] = df[columnToPermute].values[indices]
+    if 'Unnamed: 0' in df.columns:
+        df = df.drop(columns=['Unnamed: 0'])
+    return df
+
+def permutation_digest(permutation_file, seed):
+    # content of one permutation, a cache key part that does not require hashing the whole matrix
+    return hashlib.sha256(np.ascontiguousarray(np.load(permutation_file, mmap_mode="r")[seed - 1]).tobytes()).hexdigest()
 
+@profiled("main")
 def main():
     # Create argument parser
     parser = argparse.ArgumentParser(description="Randomly permute the first column of a CSV file.")
@@ -38,21 +117,35 @@ def main():
     parser.add_argument("output_directory", help="Directory to save the permuted CSV files.")
     parser.add_argument("column_name_to_permute", help="Name of the column to permute.")
     parser.add_argument("numRP", type=int, help="number of permutations")
+    parser.add_argument("--batch", action="store_true", help="write a single permutation index matrix instead of one CSV per permutation")
+    parser.add_argument("--chunkSize", type=int, default=256, help="permutations generated per write in --batch mode")
+    addCacheArguments(parser)
 
     
     # Parse the arguments
     args = parser.parse_args()
+    cache = openCache(args.cacheDir, args.cacheMaxSize)
     
     # Check if the output directory exists, if not create it
     if not os.path.exists(args.output_directory):
         os.makedirs(args.output_directory)
+    base_name = os.path.splitext(os.path.basename(args.input_file_path))[0]
     
-    # Loop to generate 1000 permuted DataFrames
-    for i in range(1, args.numRP+1):
-        # Set seed for reproducibility
-        seed = i
-        # Call the function
-        permute_first_column(args.input_file_path, args.output_directory, args.column_name_to_permute,seed)
+    if args.batch:
+        cachedRun(cache, "permutationMatrix", [args.input_file_path], {"numRP": args.numRP, "name": base_name},
+                  args.output_directory,
+                  lambda: [write_permutation_matrix(args.input_file_path, args.output_directory, args.numRP, args.chunkSize)])
+    else:
+        # Loop to generate 1000 permuted DataFrames
+        for i in range(1, args.numRP+1):
+            # Set seed for reproducibility
+            seed = i
+            # Call the function
+            cachedRun(cache, "randomPermutation", [args.input_file_path],
+                      {"column": args.column_name_to_permute, "seed": seed, "name": base_name}, args.output_directory,
+                      lambda: [permute_first_column(args.input_file_path, args.output_directory, args.column_name_to_permute, seed)])
+    if cache is not None:
+        cache.enforceSizeLimit()
 
 if __name__ == "__main__":
     main()
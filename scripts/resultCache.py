@@ -0,0 +1,316 @@
+import argparse
+import ast
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from backgroundWriter import atomicCopy
+from profiling import phase
+
+"""
+Content-addressed cache of script outputs, shared between pipeline runs (--cacheDir of randomPermutation.py,
+preProcessForPascal.py, runPascal.py and processPascalOutput.py).
+
+    cacheDir/<key[:2]>/<key>/meta.json     kind of step, parameters, artifact names, size
+    cacheDir/<key[:2]>/<key>/<artifact>    cached output files
+
+The key is the sha256 of the kind of step, the code that produces its outputs (the source of the script of the step and
+of the sibling modules it imports), the sha256 of every input file and the parameters of the step (seed, alpha,
+numTests, output names, ...), so a re-run with the same inputs reuses the outputs even after the Nextflow work directory
+is gone, while any change of content, parameter or code is a miss. Entries are built in a temporary directory and renamed into
+place, so concurrent tasks only ever see complete entries. Cached files are copied into the output directory (never
+hard-linked: a later run writing the same output path in place would otherwise corrupt the entry).
+
+The last use of an entry is the mtime of its meta.json, touched on every hit (atime is unreliable on noatime mounts).
+When a script ends with the cache over --cacheMaxSize, the least recently used entries are removed.
+
+Usage:
+python3 resultCache.py cacheDir list
+python3 resultCache.py cacheDir stats
+python3 resultCache.py cacheDir prune [--maxSize 500G] [--olderThanDays 30]
+"""
+
+META = "meta.json"
+# bump when the layout of the entries changes
+CACHE_VERSION = 1
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# script of every kind of step whose name is not <kind>.py
+PRODUCING_SCRIPTS = {"permutationMatrix": "randomPermutation.py", "processPascalOutputChunk": "processPascalOutput.py"}
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+def parseSize(text:str) -> int:
+    # "500G" -> bytes; None stays None (unbounded)
+    if text is None:
+        return None
+    text = text.strip().upper().rstrip("B")
+    unit = text[-1] if text and text[-1] in SIZE_UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+@functools.lru_cache(maxsize=None)
+def _fileDigest(FILEPATH:str, size:int, mtime:int) -> str:
+    sha = hashlib.sha256()
+    with open(FILEPATH, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def fileDigest(FILEPATH:str) -> str:
+    # hashed once per process and file version; a directory (e.g. a gene score store) hashes its files and their names
+    if os.path.isdir(FILEPATH):
+        sha = hashlib.sha256()
+        for name in sorted(os.listdir(FILEPATH)):
+            sha.update(f"{name}\0{fileDigest(os.path.join(FILEPATH, name))}\0".encode())
+        return sha.hexdigest()
+    stat = os.stat(FILEPATH)
+    return _fileDigest(os.path.abspath(FILEPATH), stat.st_size, stat.st_mtime_ns)
+
+def siblingImports(SCRIPTPATH:str) -> List[str]:
+    # pipeline modules imported by a script (imported as siblings, see scripts/)
+    with open(SCRIPTPATH, "r") as f:
+        tree = ast.parse(f.read(), SCRIPTPATH)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split(".")[0])
+    directory = os.path.dirname(SCRIPTPATH)
+    return sorted(os.path.join(directory, f"{name}.py") for name in names if os.path.isfile(os.path.join(directory, f"{name}.py")))
+
+@functools.lru_cache(maxsize=None)
+def codeDigest(SCRIPTPATH:str) -> str:
+    """
+    sha256 of the source of a script and of every pipeline module it imports, directly or not.
+    """
+    sources = {}
+    pending = [os.path.abspath(SCRIPTPATH)]
+    while pending:
+        path = pending.pop()
+        if path not in sources:
+            sources[path] = fileDigest(path)
+            pending.extend(siblingImports(path))
+    sha = hashlib.sha256()
+    for path in sorted(sources):
+        sha.update(f"{os.path.basename(path)}\0{sources[path]}\0".encode())
+    return sha.hexdigest()
+
+def producingScript(kind:str) -> str:
+    SCRIPTPATH = os.path.join(SCRIPTS_DIR, PRODUCING_SCRIPTS.get(kind, f"{kind}.py"))
+    if not os.path.isfile(SCRIPTPATH):
+        raise ValueError(f"no script producing the cached step {kind}, see PRODUCING_SCRIPTS")
+    return SCRIPTPATH
+
+def cacheKey(kind:str, inputFiles:List[str], params:dict) -> str:
+    """
+    Args:
+        kind (str): name of the step, e.g. "runPascal"
+        inputFiles (List[str]): files whose content the outputs depend on
+        params (dict): every other value the outputs depend on (JSON serializable)
+
+    Returns:
+        str: hex sha256 key
+    """
+    sha = hashlib.sha256(f"{kind}\0{CACHE_VERSION}\0{codeDigest(producingScript(kind))}".encode())
+    for inputFile in inputFiles:
+        sha.update(fileDigest(inputFile).encode())
+    sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+def restoreFile(cachedPath:str, OUTPUTPATH:str) -> None:
+    if os.path.dirname(OUTPUTPATH):
+        os.makedirs(os.path.dirname(OUTPUTPATH), exist_ok=True)
+    # through a temporary file: an interrupted restore never leaves a truncated output under its name. The rename
+    # also replaces a symlink (e.g. a staged input) instead of writing through it
+    atomicCopy(cachedPath, OUTPUTPATH)
+
+def directorySize(DIRPATH:str) -> int:
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(DIRPATH) for file in files)
+
+class ResultCache:
+    """
+    Args:
+        cacheDir (str): root of the cache, shared between runs and users
+        maxBytes (int): size bound enforced by enforceSizeLimit, None for unbounded
+    """
+    def __init__(self, cacheDir:str, maxBytes:int = None):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def entryDir(self, key:str) -> str:
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def fetch(self, key:str) -> Dict[str, str]:
+        """
+        Returns:
+            Dict[str, str]: artifact name -> cached file, None on a miss
+        """
+        entryDir = self.entryDir(key)
+        try:
+            with open(os.path.join(entryDir, META), "r") as f:
+                meta = json.load(f)
+            os.utime(os.path.join(entryDir, META))
+        except (OSError, ValueError):
+            return None
+        return {name: os.path.join(entryDir, name) for name in meta["artifacts"]}
+
+    def store(self, key:str, kind:str, params:dict, artifacts:Dict[str, str]) -> None:
+        """
+        Copy the output files of a step into the cache.
+
+        Args:
+            key (str): from cacheKey
+            kind (str): name of the step
+            params (dict): parameters of the step, kept for inspection
+            artifacts (Dict[str, str]): artifact name (may contain "/") -> output file
+        """
+        entryDir = self.entryDir(key)
+        if os.path.exists(os.path.join(entryDir, META)):
+            return
+        os.makedirs(os.path.dirname(entryDir), exist_ok=True)
+        tmpDir = tempfile.mkdtemp(dir=os.path.dirname(entryDir), prefix=".tmp_")
+        try:
+            for name, path in artifacts.items():
+                os.makedirs(os.path.dirname(os.path.join(tmpDir, name)), exist_ok=True)
+                shutil.copyfile(path, os.path.join(tmpDir, name))
+            meta = {"key": key, "kind": kind, "params": params, "artifacts": sorted(artifacts),
+                    "created": time.time(), "size": directorySize(tmpDir)}
+            with open(os.path.join(tmpDir, META), "w") as f:
+                json.dump(meta, f, default=str)
+            # mkdtemp creates 0700 directories; the cache is shared between users of the lab
+            os.chmod(tmpDir, 0o755)
+            os.rename(tmpDir, entryDir)
+        except OSError:
+            # another task stored the same entry first
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            if not os.path.exists(os.path.join(entryDir, META)):
+                raise
+
+    def entries(self) -> List[dict]:
+        entries = []
+        for prefix in sorted(os.listdir(self.cacheDir)):
+            prefixDir = os.path.join(self.cacheDir, prefix)
+            if prefix.startswith(".") or not os.path.isdir(prefixDir):
+                continue
+            for key in sorted(os.listdir(prefixDir)):
+                metaPath = os.path.join(prefixDir, key, META)
+                try:
+                    with open(metaPath, "r") as f:
+                        meta = json.load(f)
+                    meta["lastUsed"] = os.path.getmtime(metaPath)
+                except (OSError, ValueError):
+                    continue
+                entries.append(meta)
+        return entries
+
+    def prune(self, maxBytes:int = None, olderThan:float = None) -> List[dict]:
+        """
+        Remove entries last used before olderThan (epoch seconds), then least recently used entries until the cache
+        holds at most maxBytes.
+
+        Returns:
+            List[dict]: metadata of the removed entries
+        """
+        entries = sorted(self.entries(), key=lambda meta: meta["lastUsed"])
+        total = sum(meta["size"] for meta in entries)
+        removed = []
+        for meta in entries:
+            expired = olderThan is not None and meta["lastUsed"] < olderThan
+            if not expired and (maxBytes is None or total <= maxBytes):
+                continue
+            shutil.rmtree(self.entryDir(meta["key"]), ignore_errors=True)
+            total -= meta["size"]
+            removed.append(meta)
+        return removed
+
+    def enforceSizeLimit(self) -> None:
+        # called once at the end of a script rather than after every store, which would rescan the cache each time
+        if self.maxBytes is not None:
+            self.prune(self.maxBytes)
+
+def cachedRun(cache:ResultCache, kind:str, inputFiles:List[str], params:dict, outputRoot:str,
+              compute:Callable[[], List[str]]) -> List[str]:
+    """
+    Restore the outputs of a step from the cache, or run the step and cache its outputs.
+
+    Args:
+        cache (ResultCache): None to always run the step
+        kind (str): name of the step
+        inputFiles (List[str]): files whose content the outputs depend on
+        params (dict): every other value the outputs depend on, including output names
+        outputRoot (str): directory all outputs are written under; artifacts are named relative to it
+        compute (Callable[[], List[str]]): runs the step and returns the paths of its outputs
+
+    Returns:
+        List[str]: paths of the outputs
+    """
+    if cache is None:
+        return compute()
+    key = cacheKey(kind, inputFiles, params)
+    cached = cache.fetch(key)
+    if cached is not None:
+        outputs = []
+        with phase("cacheRestore"):
+            for name, cachedPath in cached.items():
+                restoreFile(cachedPath, os.path.join(outputRoot, name))
+                outputs.append(os.path.join(outputRoot, name))
+        return outputs
+    outputs = compute()
+    with phase("cacheStore"):
+        cache.store(key, kind, params, {os.path.relpath(path, outputRoot): path for path in outputs})
+    return outputs
+
+def addCacheArguments(parser:argparse.ArgumentParser) -> None:
+    parser.add_argument("--cacheDir", help="Result cache shared between runs (see resultCache.py). Outputs found in it are not recomputed.")
+    parser.add_argument("--cacheMaxSize", help="Size bound of the result cache, e.g. 500G. Least recently used entries are removed.")
+
+def openCache(cacheDir:str, maxSize:str = None) -> ResultCache:
+    # scripts call this with their --cacheDir/--cacheMaxSize arguments; no cache without --cacheDir
+    return ResultCache(cacheDir, parseSize(maxSize)) if cacheDir else None
+
+def formatSize(size:int) -> str:
+    for unit in ["", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Inspect and prune the result cache.")
+
+    # Add arguments to parser
+    parser.add_argument("cacheDir", help="Path to the result cache.")
+    parser.add_argument("command", choices=["list", "stats", "prune"])
+    parser.add_argument("--maxSize", help="prune: remove least recently used entries until the cache is at most this size, e.g. 500G")
+    parser.add_argument("--olderThanDays", type=float, help="prune: remove entries not used for this many days")
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cacheDir)
+    if args.command == "list":
+        for meta in sorted(cache.entries(), key=lambda meta: meta["lastUsed"], reverse=True):
+            lastUsed = time.strftime("%Y-%m-%d %H:%M", time.localtime(meta["lastUsed"]))
+            print(f"{meta['key'][:16]}\t{meta['kind']}\t{formatSize(meta['size'])}\t{lastUsed}\t{json.dumps(meta['params'], sort_keys=True)}")
+    elif args.command == "stats":
+        byKind = {}
+        for meta in cache.entries():
+            count, size = byKind.get(meta["kind"], (0, 0))
+            byKind[meta["kind"]] = (count + 1, size + meta["size"])
+        for kind, (count, size) in sorted(byKind.items()):
+            print(f"{kind}\t{count} entries\t{formatSize(size)}")
+        print(f"total\t{sum(count for count, _ in byKind.values())} entries\t{formatSize(sum(size for _, size in byKind.values()))}")
+    else:
+        olderThan = time.time() - args.olderThanDays * 86400 if args.olderThanDays is not None else None
+        removed = cache.prune(parseSize(args.maxSize), olderThan)
+        print(f"removed {len(removed)} entries, {formatSize(sum(meta['size'] for meta in removed))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,173 @@
 import argparse
 import os
 import glob
+import tempfile
+from multiprocessing import Pool
 from typing import List
 
 from PascalX import pathway
 from PascalX import genescorer
 
-        
+from geneScoreStore import STORE_SUFFIX, isGeneScoreStore, writeProcessedGeneScores
+from pascalResultIO import writePascalResult, writeLegacyPascalResult, STRUCTURED_SUFFIX
+from profiling import phase, profiled
+from resultCache import ResultCache, addCacheArguments, cacheKey, fileDigest, openCache, restoreFile
+
+# Modules loaded once per task and shared (copy-on-write) with the worker processes in --batch mode
+_MODULES = None
+
+def loadModules(MODULEPATH:str):
+    # load_modules only parses the module file, so the result can be reused with any scorer
+    with phase("loadModules", file=MODULEPATH):
+        return pathway.chi2rank(genescorer.chi2sum(), fuse=False).load_modules(MODULEPATH, ncol=0, fcol=1)
+
+def readManifest(MANIFESTPATH:str) -> List[str]:
+    with open(MANIFESTPATH, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def resultPathOf(scoreFile:str, outputPath:str, outputFormat:str) -> str:
+    fileName = os.path.basename(os.path.normpath(scoreFile))
+    if fileName.endswith(STORE_SUFFIX):
+        fileName = fileName[:-len(STORE_SUFFIX)] + ".tsv"
+    fileName = fileName.replace("tsv", "txt").replace("GS_", "")
+    if outputFormat == "npz":
+        return os.path.join(outputPath, fileName.replace(".txt", STRUCTURED_SUFFIX))
+    return os.path.join(outputPath, fileName)
+
+def scoreOneFile(scoreFile:str, modules, outputPath:str, outputFormat:str) -> str:
+    """
+    Score the pre-loaded modules against one gene score file and write the result.
+
+    Args:
+        scoreFile (str): Path to the processed gene score file (GS_*.tsv) or its gene score store (GS_*.gss).
+        modules: modules returned by loadModules.
+        outputPath (str): Path to the output directory.
+        outputFormat (str): npz or text, see pascalResultIO.py.
+
+    Returns:
+        str: path to the written result
+    """
+    Scorer = genescorer.chi2sum()
+    with phase("read", file=scoreFile):
+        if isGeneScoreStore(scoreFile):
+            # PascalX only loads text files: the GS_ text of the store goes through a node-local temporary file
+            with tempfile.TemporaryDirectory() as tmpDir:
+                textFile = os.path.join(tmpDir, "scores.tsv")
+                writeProcessedGeneScores(scoreFile, textFile)
+                Scorer.load_scores(textFile)
+        else:
+            Scorer.load_scores(scoreFile)
+    with phase("score", file=scoreFile):
+        Pscorer = pathway.chi2rank(Scorer, fuse=False)
+        RESULT = Pscorer.score(modules)
+    resultPath = resultPathOf(scoreFile, outputPath, outputFormat)
+    with phase("write", file=scoreFile):
+        if outputFormat == "npz":
+            writePascalResult(resultPath, RESULT[0])
+        else:
+            writeLegacyPascalResult(resultPath, RESULT[0])
+    return resultPath
+
+def _scoreWithSharedModules(scoreFile:str, outputPath:str, outputFormat:str) -> str:
+    return scoreOneFile(scoreFile, _MODULES, outputPath, outputFormat)
+
+def scoreBatch(scoreFiles:List[str], MODULEPATH:str, outputPath:str, outputFormat:str, workers:int = 1,
+               cache:ResultCache = None) -> List[str]:
+    """
+    Score many gene score files (e.g. all permutations of one network) against the same module file.
+    The module file is loaded once; the score files are scored in a loop or in a process pool.
+    Results found in the cache are restored, and the module file is not loaded when every result is found.
+
+    Args:
+        scoreFiles (List[str]): Paths to the processed gene score files.
+        MODULEPATH (str): Path to the module file shared by all score files.
+        outputPath (str): Path to the output directory.
+        outputFormat (str): npz or text, see pascalResultIO.py.
+        workers (int): number of worker processes. 1 scores in this process.
+        cache (ResultCache): result cache, None to score every file
+
+    Returns:
+        List[str]: paths to the written results, in the order of scoreFiles
+    """
+    global _MODULES
+    resultPaths = [resultPathOf(scoreFile, outputPath, outputFormat) for scoreFile in scoreFiles]
+    keys = [None] * len(scoreFiles)
+    misses = list(range(len(scoreFiles)))
+    if cache is not None:
+        misses = []
+        for i, scoreFile in enumerate(scoreFiles):
+            keys[i] = cacheKey("runPascal", [scoreFile, MODULEPATH], {"outputFormat": outputFormat, "name": os.path.basename(os.path.normpath(scoreFile))})
+            cached = cache.fetch(keys[i])
+            if cached is None:
+                misses.append(i)
+            else:
+                restoreFile(cached["result"], resultPaths[i])
+        if not misses:
+            return resultPaths
+
+    _MODULES = loadModules(MODULEPATH)
+    if workers <= 1:
+        for i in misses:
+            scoreOneFile(scoreFiles[i], _MODULES, outputPath, outputFormat)
+    else:
+        with Pool(workers) as pool:
+            pool.starmap(_scoreWithSharedModules, [(scoreFiles[i], outputPath, outputFormat) for i in misses])
+    if cache is not None:
+        for i in misses:
+            cache.store(keys[i], "runPascal", {"outputFormat": outputFormat, "name": os.path.basename(os.path.normpath(scoreFiles[i]))},
+                        {"result": resultPaths[i]})
+    return resultPaths
+
+def scoreManifest(entries:List[str], MODULEPATH:str, outputPath:str, outputFormat:str, workers:int = 1,
+                  cache:ResultCache = None) -> List[str]:
+    """
+    Score a manifest whose lines are either "scoreFile" (scored against MODULEPATH) or "scoreFile<TAB>moduleFile".
+    Module files with identical content (e.g. the Module_ files of every permutation of one network) are loaded once.
+
+    Returns:
+        List[str]: paths to the written results
+    """
+    groups = {}
+    for entry in entries:
+        scoreFile, _, moduleFile = entry.partition("\t")
+        moduleFile = moduleFile.strip() or MODULEPATH
+        groups.setdefault(fileDigest(moduleFile), (moduleFile, []))[1].append(scoreFile)
+    resultPaths = []
+    for moduleFile, scoreFiles in groups.values():
+        resultPaths.extend(scoreBatch(scoreFiles, moduleFile, outputPath, outputFormat, workers, cache))
+    return resultPaths
+
+@profiled("main")
 def main():
     # Create argument parser
     parser = argparse.ArgumentParser(description="Randomly permute the first column of a CSV file.")
-    
+
     # Add arguments to parser
-    parser.add_argument("scoreFile", help="Path to the scoreFile.")
-    parser.add_argument("moduleFile", help="Path to the moduleFile.")
+    parser.add_argument("scoreFile", help="Path to the scoreFile (GS_ file or gene score store). With --batch, path to a manifest listing one scoreFile "
+                                          "(optionally followed by a tab and its moduleFile) per line.")
+    parser.add_argument("moduleFile", help="Path to the moduleFile. With --batch, used for manifest lines without a moduleFile.")
     parser.add_argument("outputPath", help="Path to the output directory.")
     parser.add_argument("pipelineName", help="Name of the pipeline.")
     parser.add_argument("traitName", help="Name of the trait.")
-    
+    parser.add_argument("--outputFormat", choices=["npz", "text"], default="npz",
+                        help="npz: typed structured result (default). text: legacy str(tuple) dump.")
+    parser.add_argument("--batch", action="store_true", help="score every scoreFile of the manifest against moduleFile, loading it once")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes used in --batch mode")
+    addCacheArguments(parser)
+
     # Parse the arguments
     args = parser.parse_args()
-    
+    cache = openCache(args.cacheDir, args.cacheMaxSize)
+
     # Check if the output directory exists, if not create it
     if not os.path.exists(args.outputPath):
         os.makedirs(args.outputPath)
-    
-    #for moduleFile, scoreFile in zip(moduleFiles, scoreFiles):
-    Scorer = genescorer.chi2sum()
-    Scorer.load_scores(args.scoreFile)
-    Pscorer = pathway.chi2rank(Scorer, fuse=False)
-    M = Pscorer.load_modules(args.moduleFile, ncol=0, fcol=1)
-    RESULT = Pscorer.score(M)
-    fileName = os.path.basename(args.scoreFile).replace("tsv", "txt").replace("GS_", "")
-    f = open(os.path.join(args.outputPath, fileName), "w")
-    for r in RESULT[0]:
-        f.write(str(r)+"\n")
+
+    if args.batch:
+        scoreManifest(readManifest(args.scoreFile), args.moduleFile, args.outputPath, args.outputFormat, args.workers, cache)
+    else:
+        scoreBatch([args.scoreFile], args.moduleFile, args.outputPath, args.outputFormat, cache=cache)
+    if cache is not None:
+        cache.enforceSizeLimit()
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import ast
+import os
+import uuid
+from typing import Iterator, List
+
+import numpy as np
+import pandas as pd
+
+"""
+Typed columnar master summaries (slices, ORA-merged pieces and the master summary dataset).
+
+The CSV summaries hold the gene lists as str(list) cells and missing ORA values as the string "NA". With
+--summaryFormat parquet the same rows are written with pyarrow under a fixed schema:
+
+    study, trait, network                       string (dictionary encoded by Parquet)
+    rpIndex, moduleIndex, size, numSigGenes     int64
+    isModuleSig                                 bool
+    modulePval, moduleBonPval                   float64
+    sigGenes, sig1Genes ... sig4Genes           list<string>
+    geneontology_Biological_Process             int64, null where a module has no ORA result ("NA" in CSV)
+    BPminCorrectedPval, BPminFDREnrichmentRatio,
+    BPmaxEnrichmentRatio                        float64, null where a module has no ORA result ("NA" in CSV)
+
+Files are smaller and a reader only decodes the columns it asks for (empiricalPvalue.py reads 5 of them). Every
+reader of summaries (mergeORAandSummary.py, verticalMerge.py, empiricalPvalue.py) accepts both formats, chosen by the
+.parquet suffix. The export command writes a Parquet summary back to the CSV layout.
+
+pyarrow is only imported when a Parquet summary is read or written.
+
+Usage:
+python3 summaryIO.py export master_summary_slice_1.parquet master_summary_slice_1.csv
+python3 summaryIO.py export master_summary_<trait>/ master_summary_<trait>.csv
+"""
+
+PARQUET_SUFFIX = ".parquet"
+GENE_COLUMNS = ["sigGenes", "sig1Genes", "sig2Genes", "sig3Genes", "sig4Genes"]
+ORA_COLUMNS = ["geneontology_Biological_Process", "BPminCorrectedPval", "BPminFDREnrichmentRatio", "BPmaxEnrichmentRatio"]
+INT_COLUMNS = ["rpIndex", "moduleIndex", "size", "numSigGenes", "geneontology_Biological_Process"]
+FLOAT_COLUMNS = ["modulePval", "moduleBonPval", "BPminCorrectedPval", "BPminFDREnrichmentRatio", "BPmaxEnrichmentRatio"]
+
+def isParquet(FILEPATH:str) -> bool:
+    return FILEPATH.endswith(PARQUET_SUFFIX)
+
+def summaryFileName(stem:str, summaryFormat:str) -> str:
+    return f"{stem}{PARQUET_SUFFIX if summaryFormat == 'parquet' else '.csv'}"
+
+def columnType(column:str):
+    import pyarrow as pa
+    if column in GENE_COLUMNS:
+        return pa.list_(pa.string())
+    if column in INT_COLUMNS:
+        return pa.int64()
+    if column in FLOAT_COLUMNS:
+        return pa.float64()
+    if column == "isModuleSig":
+        return pa.bool_()
+    return pa.string()
+
+def _isMissing(value) -> bool:
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+def _geneList(value) -> List[str]:
+    # python list (processPascalOutput.py), numpy array (read back from Parquet) or str(list) cell (CSV)
+    if isinstance(value, str):
+        value = ast.literal_eval(value)
+    return [str(gene) for gene in value]
+
+def toTable(df:pd.DataFrame):
+    """
+    Summary rows as a pyarrow Table with the typed schema; NaN and "NA" become nulls.
+    """
+    import pyarrow as pa
+    arrays = []
+    for column in df.columns:
+        dataType = columnType(column)
+        values = df[column]
+        if pa.types.is_list(dataType):
+            array = pa.array([None if _isMissing(value) else _geneList(value) for value in values.tolist()], type=dataType)
+        elif pa.types.is_integer(dataType) or pa.types.is_floating(dataType):
+            numbers = pd.to_numeric(values.replace("NA", np.nan), errors="coerce")
+            array = pa.array(numbers.astype("Int64" if pa.types.is_integer(dataType) else "float64"), type=dataType, from_pandas=True)
+        elif pa.types.is_boolean(dataType):
+            if not pd.api.types.is_bool_dtype(values):
+                # CSV cells read as text, e.g. next to "NA"
+                values = values.map({True: True, False: False, "True": True, "False": False})
+            array = pa.array(values.astype("boolean"), type=dataType, from_pandas=True)
+        else:
+            array = pa.array(values.astype("string"), type=dataType, from_pandas=True)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=[str(column) for column in df.columns])
+
+def toLegacyFrame(df:pd.DataFrame) -> pd.DataFrame:
+    # CSV layout: gene lists as str(list), ORA values as floats (as mergeORAandSummary.py writes them) or "NA"
+    df = df.copy()
+    for column in df.columns:
+        # columns already in the CSV layout (a dataset merged from CSV pieces) are kept as they are
+        if column in GENE_COLUMNS:
+            df[column] = [value if isinstance(value, str) else str(_geneList(value)) for value in df[column].tolist()]
+        elif column in ORA_COLUMNS and pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column].astype("float64").astype(object).where(df[column].notna(), "NA")
+    return df
+
+def readSummary(FILEPATH:str, columns:List[str] = None) -> pd.DataFrame:
+    if isParquet(FILEPATH):
+        import pyarrow.parquet as pq
+        return pq.read_table(FILEPATH, columns=columns).to_pandas()
+    return pd.read_csv(FILEPATH, usecols=columns)
+
+def iterSummaryChunks(FILEPATH:str, chunkRows:int, columns:List[str] = None, dtype:dict = None) -> Iterator[pd.DataFrame]:
+    """
+    Yield a summary in chunks of at most chunkRows rows, reading only the given columns. CSV floats are parsed exactly,
+    so p-values written back to Parquet keep every digit.
+    """
+    if isParquet(FILEPATH):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(FILEPATH).iter_batches(batch_size=chunkRows, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(FILEPATH, usecols=columns, chunksize=chunkRows, dtype=dtype, float_precision="round_trip")
+
+class SummaryWriter:
+    """
+    Writes summary rows to one file, piece by piece: CSV (one header) or Parquet (one row group per piece).
+    The rows go to a hidden temporary file that is renamed to OUTPUTPATH by close(), so a partial summary is never
+    seen under its name.
+
+    Args:
+        OUTPUTPATH (str): output file; Parquet if it ends with .parquet
+    """
+    def __init__(self, OUTPUTPATH:str):
+        self.path = OUTPUTPATH
+        directory, name = os.path.split(OUTPUTPATH)
+        self.tmpPath = os.path.join(directory, f".{name}.tmp-{uuid.uuid4().hex}")
+        self.out = None
+        self.columns = None
+
+    def write(self, df:pd.DataFrame) -> None:
+        if self.columns is None:
+            self.columns = list(df.columns)
+        if isParquet(self.path):
+            import pyarrow.parquet as pq
+            table = toTable(df)
+            if self.out is None:
+                self.out = pq.ParquetWriter(self.tmpPath, table.schema)
+            self.out.write_table(table)
+        else:
+            if self.out is None:
+                self.out = open(self.tmpPath, "w")
+                df.to_csv(self.out, index=False)
+            else:
+                df.to_csv(self.out, index=False, header=False)
+
+    def close(self, columns:List[str] = None) -> None:
+        """
+        Args:
+            columns (List[str]): header of the file if no rows were written; without it, the file is left empty
+        """
+        if self.out is None and columns:
+            self.write(pd.DataFrame({column: [] for column in columns}))
+        if self.out is None:
+            open(self.tmpPath, "w").close()
+        else:
+            self.out.close()
+        os.replace(self.tmpPath, self.path)
+
+def writeSummary(df:pd.DataFrame, OUTPUTPATH:str) -> None:
+    writer = SummaryWriter(OUTPUTPATH)
+    writer.write(df)
+    writer.close()
+
+def exportCsv(INPUTPATH:str, OUTPUTPATH:str) -> None:
+    """
+    Write a Parquet summary file, or a partitioned master summary dataset, to a CSV summary.
+    """
+    if os.path.isdir(INPUTPATH):
+        from verticalMerge import exportParquetToCsv
+        exportParquetToCsv(INPUTPATH, OUTPUTPATH)
+        return
+    import pyarrow.parquet as pq
+    parquetFile = pq.ParquetFile(INPUTPATH)
+    with open(OUTPUTPATH, "w") as out:
+        if parquetFile.num_row_groups == 0:
+            out.write(",".join(parquetFile.schema_arrow.names) + "\n")
+        for i in range(parquetFile.num_row_groups):
+            toLegacyFrame(parquetFile.read_row_group(i).to_pandas()).to_csv(out, index=False, header=(i == 0))
+
+def main():
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Export typed Parquet summaries to the CSV summary layout.")
+
+    # Add arguments to parser
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("input", help="Parquet summary file or partitioned master summary directory")
+    parser.add_argument("output", help="CSV file to write")
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    exportCsv(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()
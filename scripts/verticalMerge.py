@@ -1,28 +1,326 @@
 import pandas as pd
 import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+from typing import Iterator, List, Tuple
+
+from profiling import phase
+from summaryIO import isParquet, iterSummaryChunks, toLegacyFrame, toTable
+
+"""
+Merge the per-(permutation, network) summary pieces into the master summary without holding them in memory.
+
+Pieces are read in chunks of at most chunkRows rows, so peak memory does not depend on the number of pieces. Every piece
+must have the same header and format: CSV, or typed Parquet summaries (summaryIO.py). The output is either one CSV (same
+content as the former awk loop; rows of Parquet pieces are converted back to the CSV layout) or a Parquet dataset
+partitioned by study/trait/network, written with the fixed schema of summaryIO.py whatever the format of the pieces,
+so every run appends part files of the same types:
+
+    master_summary_<trait>/study=<study>/trait=<trait>/network=<network>/part-<uuid>.parquet
+
+The partition trait is the trait without the RP index; the RP index is kept in an integer rpIndex column and the
+partition columns are not repeated inside the files. New runs append new part files to the existing partitions.
+With --sort, rows of each partition are ordered by moduleIndex through an external merge sort of sorted spill runs.
+
+Part files are written under hidden names (.part-<uuid>.parquet, skipped by Parquet readers) and published when the merge
+is complete, so a failed merge never leaves partial rows in the dataset. With --replaceNetworks (incremental runs, see
+incrementalRun.py), the existing part files of the listed networks are removed when the new ones are published: their
+partitions then hold only the rows of this merge, or disappear if it has none, while every other partition is untouched.
+With --stage, the part files stay hidden and are listed with the partitions to replace in a stage file; incrementalRun.py
+commit publishes them together with the manifest of the run (publishParts can be applied again after an interruption).
+"""
+
+PARTITION_COLUMNS = ["study", "trait", "network"]
+
+def readHeader(file_path:str) -> str:
+    if isParquet(file_path):
+        import pyarrow.parquet as pq
+        return ",".join(pq.read_schema(file_path).names)
+    with open(file_path, "r") as f:
+        return f.readline().rstrip("\n")
+
+def validateHeaders(file_paths:List[str]) -> str:
+    header = readHeader(file_paths[0])
+    for file_path in file_paths[1:]:
+        if isParquet(file_path) != isParquet(file_paths[0]):
+            raise ValueError(f"{file_path} has a different format than {file_paths[0]}")
+        if readHeader(file_path) != header:
+            raise ValueError(f"{file_path} has a different header than {file_paths[0]}")
+    return header
+
+def splitTrait(trait:str) -> Tuple[int, str]:
+    # "12-fhshdl" -> (12, "fhshdl"); traits without an RP index are kept as is
+    prefix, _, rest = trait.partition("-")
+    if prefix.isdigit() and rest:
+        return int(prefix), rest
+    return None, trait
+
+def joinTrait(rpIndex, trait:str) -> str:
+    return trait if pd.isna(rpIndex) else f"{int(rpIndex)}-{trait}"
 
 def concatenate_csv(file_paths, outputFileName):
-    # Read the CSV files and store them in a list
-    data_frames = [pd.read_csv(file_path) for file_path in file_paths]
-    
-    # Concatenate the data frames vertically
-    concatenated_df = pd.concat(data_frames, ignore_index=True)
-    
-    # Save the concatenated data frame to an output CSV file
-    concatenated_df.to_csv(outputFileName, index=False)
+    # Copy the data lines of every piece after a single header, one piece at a time
+    validateHeaders(file_paths)
+    with open(outputFileName, "w") as out:
+        out.write(readHeader(file_paths[0]) + "\n")
+        for file_path in file_paths:
+            if isParquet(file_path):
+                import pyarrow.parquet as pq
+                parquetFile = pq.ParquetFile(file_path)
+                for i in range(parquetFile.num_row_groups):
+                    toLegacyFrame(parquetFile.read_row_group(i).to_pandas()).to_csv(out, index=False, header=False)
+                continue
+            with open(file_path, "r") as f:
+                f.readline()
+                shutil.copyfileobj(f, out)
+
+def iterChunks(file_paths:List[str], chunkRows:int) -> Iterator[pd.DataFrame]:
+    """
+    Yield every piece in chunks of at most chunkRows rows, with the trait split into rpIndex and trait (without RP
+    index). Column types are set when the rows are written (summaryIO.toTable); only the partition keys are read as text.
+    """
+    for file_path in file_paths:
+        for chunk in iterSummaryChunks(file_path, chunkRows, dtype={column: str for column in PARTITION_COLUMNS}):
+            if len(chunk) == 0:
+                continue
+            rpIndex, trait = zip(*(splitTrait(t) for t in chunk["trait"].astype(str)))
+            chunk["trait"] = pd.array(trait, dtype="string")
+            chunk.insert(0, "rpIndex", pd.array(rpIndex, dtype="Int64"))
+            yield chunk
+
+def partitionDir(outputDir:str, key:Tuple[str, str, str]) -> str:
+    return os.path.join(outputDir, *(f"{column}={value}" for column, value in zip(PARTITION_COLUMNS, key)))
+
+class PartitionedParquetWriter:
+    """
+    One open ParquetWriter per study/trait/network partition; each write appends row groups.
+
+    Args:
+        outputDir (str): root of the partitioned dataset
+    """
+    def __init__(self, outputDir:str):
+        self.outputDir = outputDir
+        self.writers = {}
+        self.paths = []
+
+    def write(self, df:pd.DataFrame) -> None:
+        import pyarrow.parquet as pq
+        for key, part in df.groupby(PARTITION_COLUMNS, sort=False):
+            table = toTable(part.drop(columns=PARTITION_COLUMNS))
+            if key not in self.writers:
+                os.makedirs(partitionDir(self.outputDir, key), exist_ok=True)
+                path = os.path.join(partitionDir(self.outputDir, key), f".part-{uuid.uuid4().hex}.parquet")
+                self.writers[key] = pq.ParquetWriter(path, table.schema)
+                self.paths.append(path)
+            self.writers[key].write_table(table)
+
+    def close(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def publish(self, replacePartitions:List[Tuple[str, str, str]] = None) -> None:
+        """
+        Make the written part files visible, after removing the existing part files of replacePartitions.
+
+        Args:
+            replacePartitions (List[Tuple[str, str, str]]): (study, trait, network) partitions to replace
+        """
+        self.close()
+        publishParts(self.outputDir, self.paths, replacePartitions)
+        self.paths = []
+
+    def stage(self, STAGEPATH:str, replacePartitions:List[Tuple[str, str, str]] = None) -> None:
+        # keep the written part files hidden and list them for publishParts
+        self.close()
+        writeStage(STAGEPATH, self.outputDir, self.paths, replacePartitions)
+        self.paths = []
+
+def publishedPath(hiddenPath:str) -> str:
+    return os.path.join(os.path.dirname(hiddenPath), os.path.basename(hiddenPath)[1:])
+
+def publishParts(outputDir:str, hiddenPaths:List[str], replacePartitions:List[Tuple[str, str, str]] = None) -> None:
+    """
+    Remove the existing part files of replacePartitions and make the hidden part files visible. Applying it again
+    after an interruption finishes the publication: part files it published are kept, renamed ones are skipped.
+
+    Args:
+        outputDir (str): root of the dataset
+        hiddenPaths (List[str]): hidden part files (.part-<uuid>.parquet) to publish
+        replacePartitions (List[Tuple[str, str, str]]): (study, trait, network) partitions to replace
+    """
+    published = {publishedPath(path) for path in hiddenPaths}
+    for key in replacePartitions or []:
+        directory = partitionDir(outputDir, tuple(key))
+        if not os.path.isdir(directory):
+            continue
+        for file in os.listdir(directory):
+            path = os.path.join(directory, file)
+            if file.startswith("part-") and file.endswith(".parquet") and path not in published:
+                os.remove(path)
+        if not os.listdir(directory):
+            os.removedirs(directory)
+    for path in hiddenPaths:
+        if os.path.exists(path):
+            os.rename(path, publishedPath(path))
+
+def writeStage(STAGEPATH:str, outputDir:str, hiddenPaths:List[str], replacePartitions:List[Tuple[str, str, str]] = None) -> None:
+    with open(STAGEPATH, "w") as f:
+        json.dump({"outputDir": os.path.abspath(outputDir), "parts": [os.path.abspath(path) for path in hiddenPaths],
+                   "replacePartitions": [list(key) for key in replacePartitions or []]}, f, indent=1)
+
+def mergeSortedRuns(run_paths:List[str], batchRows:int) -> Iterator[pd.DataFrame]:
+    """
+    k-way merge of Parquet runs sorted by moduleIndex, holding at most batchRows rows per run.
+    Emits every buffered row whose moduleIndex is not larger than the smallest last key among the buffers.
+    """
+    import pyarrow.parquet as pq
+    readers = [pq.ParquetFile(path).iter_batches(batch_size=batchRows) for path in run_paths]
+    buffers = [None] * len(readers)
+
+    def refill(i):
+        while buffers[i] is None or len(buffers[i]) == 0:
+            batch = next(readers[i], None)
+            if batch is None:
+                buffers[i] = None
+                return
+            buffers[i] = batch.to_pandas()
+
+    for i in range(len(readers)):
+        refill(i)
+    while any(buffer is not None for buffer in buffers):
+        live = [i for i, buffer in enumerate(buffers) if buffer is not None]
+        threshold = min(buffers[i]["moduleIndex"].iloc[-1] for i in live)
+        taken = []
+        for i in live:
+            n = int(buffers[i]["moduleIndex"].searchsorted(threshold, side="right"))
+            taken.append(buffers[i].iloc[:n])
+            buffers[i] = buffers[i].iloc[n:]
+            refill(i)
+        yield pd.concat(taken, ignore_index=True).sort_values("moduleIndex", kind="stable")
+
+def streamMergeToParquet(file_paths:List[str], outputDir:str, chunkRows:int = 100000, sort:bool = False,
+                         replacePartitions:List[Tuple[str, str, str]] = None, STAGEPATH:str = None) -> None:
+    """
+    Merge summary pieces into a Parquet dataset partitioned by study/trait/network.
+
+    Args:
+        file_paths (List[str]): summary pieces (CSV or Parquet) with identical headers, may be empty
+        outputDir (str): root of the dataset, created or appended to
+        chunkRows (int): maximum number of rows read or buffered at once
+        sort (bool): order the rows of every partition by moduleIndex
+        replacePartitions (List[Tuple[str, str, str]]): (study, trait, network) partitions whose existing rows are
+            replaced by the rows of this merge
+        STAGEPATH (str): stage file listing the hidden part files and replacePartitions; the merge is then published by
+            publishParts instead of here
+
+    Returns:
+        None
+    """
+    if file_paths:
+        validateHeaders(file_paths)
+    writer = PartitionedParquetWriter(outputDir)
+    if not sort:
+        for chunk in iterChunks(file_paths, chunkRows):
+            writer.write(chunk)
+    else:
+        sortedMerge(file_paths, writer, chunkRows)
+    if STAGEPATH:
+        writer.stage(STAGEPATH, replacePartitions)
+    else:
+        writer.publish(replacePartitions)
+
+def sortedMerge(file_paths:List[str], writer:PartitionedParquetWriter, chunkRows:int) -> None:
+    # rows of every partition ordered by moduleIndex; the part files are left hidden for the caller to publish
+    import pyarrow.parquet as pq
+    outputDir = writer.outputDir
+    with tempfile.TemporaryDirectory(dir=outputDir if os.path.isdir(outputDir) else None) as spillDir:
+        # pass 1: sorted runs of at most chunkRows rows per partition
+        runs = {}
+        for chunk in iterChunks(file_paths, chunkRows):
+            for key, part in chunk.groupby(PARTITION_COLUMNS, sort=False):
+                path = os.path.join(spillDir, f"run-{uuid.uuid4().hex}.parquet")
+                part = part.sort_values("moduleIndex", kind="stable")
+                pq.write_table(toTable(part), path)
+                runs.setdefault(key, []).append(path)
+        # pass 2: k-way merge of the runs of each partition
+        for key, run_paths in runs.items():
+            batchRows = max(1000, chunkRows // len(run_paths))
+            for merged in mergeSortedRuns(run_paths, batchRows):
+                writer.write(merged)
+            writer.close()
+
+def exportParquetToCsv(datasetDir:str, outputFileName:str) -> None:
+    """
+    Write a partitioned master summary back to a single CSV with the original columns, one row group at a time.
+    """
+    import pyarrow.parquet as pq
+    header = True
+    with open(outputFileName, "w") as out:
+        for root, _, files in sorted(os.walk(datasetDir)):
+            key = dict(part.split("=", 1) for part in os.path.relpath(root, datasetDir).split(os.sep) if "=" in part)
+            for file in sorted(files):
+                if not file.endswith(".parquet"):
+                    continue
+                parquetFile = pq.ParquetFile(os.path.join(root, file))
+                for i in range(parquetFile.num_row_groups):
+                    df = toLegacyFrame(parquetFile.read_row_group(i).to_pandas())
+                    trait = [joinTrait(rpIndex, key["trait"]) for rpIndex in df.pop("rpIndex")]
+                    df.insert(0, "network", key["network"])
+                    df.insert(0, "trait", trait)
+                    df.insert(0, "study", key["study"])
+                    df.to_csv(out, index=False, header=header)
+                    header = False
 
 if __name__ == "__main__":
     # Argument parsing
-    parser = argparse.ArgumentParser(description='Concatenate CSV files vertically.')
-    parser.add_argument('paths_file', type=str, help='File containing paths to the CSV files to concatenate')
+    parser = argparse.ArgumentParser(description='Concatenate summary pieces vertically.')
+    parser.add_argument('paths_file', type=str, help='File containing paths to the summary pieces (CSV or Parquet) to concatenate')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='csv: one CSV file (default). parquet: dataset partitioned by study/trait/network.')
+    parser.add_argument('--outputName', help='Output file (csv) or dataset directory (parquet). Default: master_summary_<trait>_RP')
+    parser.add_argument('--chunkRows', type=int, default=100000, help='maximum number of rows held in memory')
+    parser.add_argument('--sort', action='store_true', help='order rows of every partition by moduleIndex (parquet only)')
+    parser.add_argument('--replaceNetworks', help='file listing networks whose partitions are replaced by this merge (parquet only, '
+                                                  'requires --study and --trait)')
+    parser.add_argument('--study', help='study (pipeline) of the replaced partitions')
+    parser.add_argument('--trait', help='trait (without RP index) of the replaced partitions')
+    parser.add_argument('--stage', help='leave the new part files hidden and list them in this file, to be published by '
+                                        'incrementalRun.py commit (parquet only)')
     args = parser.parse_args()
-    
+    if args.stage and args.format != 'parquet':
+        parser.error("--stage requires --format parquet")
+
     with open(args.paths_file, 'r') as f:
-        file_paths = f.read().strip().split("\n")
+        file_paths = [line for line in f.read().strip().split("\n") if line]
+
+    replacePartitions = None
+    if args.replaceNetworks:
+        if args.format != 'parquet' or not (args.study and args.trait):
+            parser.error("--replaceNetworks requires --format parquet, --study and --trait")
+        with open(args.replaceNetworks, 'r') as f:
+            replacePartitions = [(args.study, args.trait, line.strip()) for line in f if line.strip()]
+    if not file_paths and not replacePartitions:
+        # e.g. an incremental run without new or changed networks: nothing to merge
+        print(f"{args.paths_file} lists no pieces, master summary left unchanged")
+        if args.stage:
+            writeStage(args.stage, args.outputName or ".", [])
+        sys.exit(0)
+    if not file_paths and args.outputName is None:
+        parser.error("--outputName is required to replace partitions without pieces")
 
-    print(file_paths)
-    suffix = file_paths[0].split("_")[1].split("-")[1] #1-fhshdl, 2-fhshdl -> fhshdl
-    outputFileName = f"master_summary_{suffix}_RP.csv"
+    print(f"merging {len(file_paths)} pieces")
+    outputName = args.outputName
+    if outputName is None:
+        suffix = file_paths[0].split("_")[1].split("-")[1] #1-fhshdl, 2-fhshdl -> fhshdl
+        outputName = f"master_summary_{suffix}_RP"
 
-    # Call the concatenate_csv function with the read file paths
-    concatenate_csv(file_paths, outputFileName)
+    with phase("merge"):
+        if args.format == 'csv':
+            concatenate_csv(file_paths, outputName if outputName.endswith(".csv") else f"{outputName}.csv")
+        else:
+            streamMergeToParquet(file_paths, outputName, args.chunkRows, args.sort, replacePartitions, args.stage)
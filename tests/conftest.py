@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the pipeline scripts import each other as siblings (see scripts/)
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+sys.path.insert(0, SCRIPTS)
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import backgroundWriter
+from backgroundWriter import BackgroundWriter, atomicWrite
+
+"""
+backgroundWriter.py: a file is either complete under its name or absent (never partial, no temporary file left behind),
+write errors surface at flush after every other file is written, and files are only fsynced when asked for.
+"""
+
+def listFiles(DIRPATH):
+    return sorted(os.path.relpath(os.path.join(root, file), DIRPATH) for root, _, files in os.walk(DIRPATH) for file in files)
+
+def test_failedAtomicWriteKeepsThePreviousFile(tmp_path):
+    path = os.path.join(tmp_path, "GS_pipe_1-trait_net.tsv")
+    atomicWrite(path, "A1BG\t0.5\n")
+    with pytest.raises(TypeError):
+        # fails after the temporary file is opened
+        atomicWrite(path, 12)
+    with open(path) as f:
+        assert f.read() == "A1BG\t0.5\n"
+    assert listFiles(tmp_path) == ["GS_pipe_1-trait_net.tsv"]
+
+@pytest.mark.parametrize("workers", [0, 3])
+def test_flushWritesCompleteFilesAndRaisesTheFirstError(tmp_path, workers):
+    writer = BackgroundWriter(workers, batchFiles=4)
+    expected = {}
+    for i in range(50):
+        expected[f"sig_{i}.txt"] = "".join(f"G{j}\n" for j in range(i))
+        writer.writeText(os.path.join(tmp_path, f"sig_{i}.txt"), expected[f"sig_{i}.txt"])
+    with open(os.path.join(tmp_path, "source.txt"), "w") as f:
+        f.write("A1BG\n")
+    writer.copyFile(os.path.join(tmp_path, "source.txt"), os.path.join(tmp_path, "copy.txt"))
+    if workers == 0:
+        with pytest.raises(FileNotFoundError):
+            writer.writeText(os.path.join(tmp_path, "missing", "sig.txt"), "A1BG\n")
+            writer.flush()
+    else:
+        writer.writeText(os.path.join(tmp_path, "missing", "sig.txt"), "A1BG\n")
+        with pytest.raises(FileNotFoundError):
+            writer.flush()
+    writer.close()
+
+    assert listFiles(tmp_path) == sorted(list(expected) + ["copy.txt", "source.txt"])
+    for name, text in expected.items():
+        with open(os.path.join(tmp_path, name)) as f:
+            assert f.read() == text
+
+@pytest.mark.parametrize("fsync", [False, True])
+def test_fsyncIsOptIn(tmp_path, monkeypatch, fsync):
+    synced = []
+    monkeypatch.setattr(backgroundWriter, "fsyncPath", synced.append)
+    writer = BackgroundWriter(fsync=fsync)
+    writer.writeText(os.path.join(tmp_path, "a.txt"), "a\n")
+    writer.flush(fsync=False)
+    assert synced == []
+    writer.writeText(os.path.join(tmp_path, "b.txt"), "b\n")
+    writer.close()
+    expected = [os.path.join(tmp_path, "a.txt"), os.path.join(tmp_path, "b.txt"), str(tmp_path)] if fsync else []
+    assert synced == expected
@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import SCRIPTS
+
+"""
+Regression test of the batched permutation path (randomPermutation.py --batch + preProcessForPascal.py --rpIndices)
+against the per-file path (one RP CSV per seed, each preprocessed on its own).
+
+GO_ and Module_ files must be identical. GS_ genes must be identical and in the same order; the p-values of the
+per-file path went through a CSV written by to_csv and parsed again by read_csv, whose default float parser may be
+off by one unit in the last place, so they are compared with a relative tolerance of 1e-12.
+"""
+
+NUM_RP = 4
+RTOL = 1e-12
+
+def run(script, *args):
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, script), *map(str, args)], check=True, capture_output=True)
+
+def writeInputs(tmp_path):
+    rng = np.random.RandomState(0)
+    genes = [f"G{i}" for i in range(300)]
+    # p-values over many orders of magnitude, with full-length decimal representations
+    pd.DataFrame({"markname": genes, "meta_p": rng.uniform(size=300) * 10.0 ** -rng.randint(0, 20, size=300)}) \
+        .to_csv(tmp_path / "scores.csv", index=False)
+    moduleDir = tmp_path / "modules"
+    moduleDir.mkdir()
+    for network in ["netA", "netB"]:
+        with open(moduleDir / f"{network}.txt", "w") as f:
+            for module in range(1, 6):
+                # some module genes have no score
+                members = list(rng.choice(genes, size=20, replace=False)) + [f"X{network}{module}"]
+                f.write("\t".join([str(module), "1.0"] + members) + "\n")
+    return tmp_path / "scores.csv", moduleDir
+
+def readOutputs(outputDir):
+    return {name: (outputDir / name).read_text() for name in sorted(os.listdir(outputDir))}
+
+@pytest.mark.parametrize("moduleIndex", [False, True])
+def test_batchedOutputsMatchPerFileOutputs(tmp_path, moduleIndex):
+    scoreFile, moduleDir = writeInputs(tmp_path)
+
+    rpDir, perFileDir = tmp_path / "rp", tmp_path / "perFile"
+    run("randomPermutation.py", scoreFile, rpDir, "markname", NUM_RP)
+    for rp in range(1, NUM_RP + 1):
+        run("preProcessForPascal.py", rpDir / f"{rp}-scores.csv", moduleDir, perFileDir, "cma", "trait", "markname", "meta_p")
+
+    batchDir, batchedDir = tmp_path / "batch", tmp_path / "batched"
+    run("randomPermutation.py", scoreFile, batchDir, "markname", NUM_RP, "--batch")
+    extra = ["--moduleIndexDir", tmp_path / "moduleIndex"] if moduleIndex else []
+    run("preProcessForPascal.py", scoreFile, moduleDir, batchedDir, "cma", "trait", "markname", "meta_p",
+        "--permutationFile", batchDir / "scores_permutations.npy", "--rpIndices", ",".join(map(str, range(1, NUM_RP + 1))), *extra)
+
+    perFile, batched = readOutputs(perFileDir), readOutputs(batchedDir)
+    assert sorted(perFile) == sorted(batched)
+    assert len(perFile) == NUM_RP * 2 * 3
+    for name in perFile:
+        if not name.startswith("GS_"):
+            assert batched[name] == perFile[name], name
+            continue
+        expected = pd.read_table(perFileDir / name, header=None, float_precision="round_trip")
+        actual = pd.read_table(batchedDir / name, header=None, float_precision="round_trip")
+        assert actual[0].tolist() == expected[0].tolist(), name
+        np.testing.assert_allclose(actual[1].to_numpy(), expected[1].to_numpy(), rtol=RTOL, atol=0, err_msg=name)
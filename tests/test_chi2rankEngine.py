@@ -0,0 +1,103 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import chi2, rankdata
+
+from chi2rankEngine import moduleMembership, rankChi2, scoreModules, scorePermutations
+from moduleIndex import ModuleIndex
+from randomPermutation import permutation_indices
+
+"""
+chi2rankEngine.py against a reference computed independently for every permutation: the permuted score table is built
+as randomPermutation.py writes an RP file (pandas sample of the gene column), and every module is scored one by one as
+chi2rank does (average ranks of tied p-values, u = rank / (N + 1), sum of chi2.isf(u, 1) over the module genes with a
+score).
+The comparison with PascalX itself runs only where PascalX is installed.
+"""
+
+NUM_RP = 7
+
+def syntheticCase(ties:bool):
+    rng = np.random.RandomState(1)
+    genes = [f"G{i}" for i in range(40)]
+    pvals = rng.uniform(size=40)
+    if ties:
+        pvals[[3, 17, 25]] = pvals[8]
+    moduleLines = [["1", "1.0"] + genes[:5],
+                   ["2", "1.0"] + genes[10:30],
+                   # a gene listed twice counts once, a gene without a score is ignored
+                   ["3", "1.0", "G3", "G8", "G8", "NOSCORE", "G25"],
+                   ["4", "1.0", "G39"],
+                   # no scored gene at all
+                   ["5", "1.0", "NOSCORE", "OTHER"]]
+    return genes, pvals, moduleLines
+
+def referencePvals(genes, pvals, moduleLines, seed=None):
+    # seed None: the unpermuted score table
+    df = pd.DataFrame({"markname": genes, "meta_p": pvals})
+    if seed is not None:
+        df["markname"] = df["markname"].sample(frac=1, random_state=seed).values
+    x = chi2.isf(rankdata(df["meta_p"], method="average") / (len(df) + 1), 1)
+    geneScore = dict(zip(df["markname"], x))
+    result = []
+    for columns in moduleLines:
+        scored = [gene for gene in dict.fromkeys(columns[2:]) if gene in geneScore]
+        result.append(chi2.sf(sum(geneScore[gene] for gene in scored), len(scored)) if scored else np.nan)
+    return np.array(result)
+
+@pytest.mark.parametrize("ties", [False, True])
+@pytest.mark.parametrize("blockSize", [1, 3, 32])
+def test_scorePermutationsMatchesReference(ties, blockSize):
+    genes, pvals, moduleLines = syntheticCase(ties)
+    membership = moduleMembership(ModuleIndex.fromModuleLines(moduleLines), genes)
+    permutations = np.stack([permutation_indices(len(genes), seed) for seed in range(1, NUM_RP + 1)])
+
+    modulePvals = scorePermutations(pvals, permutations, membership, blockSize)
+
+    expected = np.stack([referencePvals(genes, pvals, moduleLines, seed) for seed in range(1, NUM_RP + 1)])
+    assert modulePvals.shape == (NUM_RP, len(moduleLines))
+    np.testing.assert_allclose(modulePvals, expected, rtol=1e-10, equal_nan=True)
+    assert np.isnan(modulePvals[:, 4]).all()
+
+def test_scoreModulesOfUnpermutedScores():
+    genes, pvals, moduleLines = syntheticCase(ties=False)
+    membership = moduleMembership(ModuleIndex.fromModuleLines(moduleLines), genes)
+    _, x = rankChi2(pvals)
+
+    np.testing.assert_allclose(scoreModules(x[None, :], membership)[0], referencePvals(genes, pvals, moduleLines),
+                               rtol=1e-10, equal_nan=True)
+
+def test_scorePermutationsMatchesPascalX():
+    pytest.importorskip("PascalX")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+    from benchChi2rank import checkPascalX
+
+    # no gene listed twice in a module, a case the engine defines and PascalX may not
+    genes, pvals, moduleLines = syntheticCase(ties=True)
+    moduleLines = [columns[:2] + list(dict.fromkeys(columns[2:])) for columns in moduleLines]
+    membership = moduleMembership(ModuleIndex.fromModuleLines(moduleLines), genes)
+    permutations = np.stack([permutation_indices(len(genes), seed) for seed in range(1, NUM_RP + 1)])
+    modulePvals = scorePermutations(pvals, permutations, membership)
+
+    assert checkPascalX(np.array(genes), pvals, moduleLines, permutations, modulePvals) < 1e-6
+
+def test_tiedPvalsShareTheirAverageRank():
+    genes = ["A", "B", "C", "D", "E", "F"]
+    pvals = np.array([0.2, 0.01, 0.2, 0.5, 0.2, 0.9])
+    moduleLines = [["1", "1.0", "A", "B"], ["2", "1.0", "C", "D"], ["3", "1.0", "E"], ["4", "1.0", "A", "C", "E"]]
+    # ranks: B 1, A/C/E (2 + 3 + 4) / 3 = 3, D 5, F 6; u = rank / 7
+    x = {gene: chi2.isf(rank / 7, 1) for gene, rank in zip(genes, [3, 1, 3, 5, 3, 6])}
+    expected = [chi2.sf(x["A"] + x["B"], 2), chi2.sf(x["C"] + x["D"], 2), chi2.sf(x["E"], 1), chi2.sf(3 * x["A"], 3)]
+
+    uniform, _ = rankChi2(pvals)
+    np.testing.assert_allclose(uniform, [3 / 7, 1 / 7, 3 / 7, 5 / 7, 3 / 7, 6 / 7])
+    membership = moduleMembership(ModuleIndex.fromModuleLines(moduleLines), genes)
+    np.testing.assert_allclose(scorePermutations(pvals, np.arange(6)[None, :], membership)[0], expected, rtol=1e-12)
+
+    # the same scores in another file order give the same module p-values
+    order = np.array([4, 2, 0, 5, 1, 3])
+    membership = moduleMembership(ModuleIndex.fromModuleLines(moduleLines), [genes[i] for i in order])
+    np.testing.assert_allclose(scorePermutations(pvals[order], np.arange(6)[None, :], membership)[0], expected, rtol=1e-12)
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from empiricalPvalue import empiricalPvalues
+
+"""
+empiricalPvalue.py against the definitions of its module docstring, computed on the whole table: the family-wise
+p-values and thresholds are the same whether the RP runs span chunks or not, and with the minima bounded by --numRP.
+"""
+
+NETWORKS = ["netA", "netB", "netC"]
+
+def writeSlices(DIRPATH, numRP, rng):
+    # one slice per (network, RP run); netC has no observed p-values
+    numModules = {"netA": 12, "netB": 7, "netC": 5}
+    rows = [(network, rpIndex, moduleIndex, float(10 ** -rng.uniform(0, 6)))
+            for rpIndex in range(1, numRP + 1) for network in NETWORKS for moduleIndex in range(1, numModules[network] + 1)]
+    df = pd.DataFrame(rows, columns=["network", "rpIndex", "moduleIndex", "modulePval"])
+    paths = []
+    for (network, rpIndex), slice_ in df.groupby(["network", "rpIndex"], sort=False):
+        paths.append(os.path.join(DIRPATH, f"master_summary_slice_{rpIndex}_{network}.csv"))
+        pd.DataFrame({"study": "pipe", "trait": f"{rpIndex}-trait", "network": network,
+                      "moduleIndex": slice_["moduleIndex"], "modulePval": slice_["modulePval"]}).to_csv(paths[-1], index=False)
+    observed = pd.DataFrame([("pipe", "trait", network, moduleIndex, float(10 ** -rng.uniform(0, 6)))
+                             for network in NETWORKS[:2] for moduleIndex in range(1, numModules[network] + 1)],
+                            columns=["study", "trait", "network", "moduleIndex", "modulePval"])
+    observed.loc[3, "modulePval"] = np.nan
+    observedPath = os.path.join(DIRPATH, "master_summary_0.csv")
+    observed.to_csv(observedPath, index=False)
+    return paths, observed, df
+
+def reference(observed, null, alpha):
+    familyMinima = null.groupby(["network", "rpIndex"])["modulePval"].min()
+    fwer, empirical = [], []
+    for network, moduleIndex, pval in zip(observed["network"], observed["moduleIndex"], observed["modulePval"]):
+        moduleNull = null[(null["network"] == network) & (null["moduleIndex"] == moduleIndex)]["modulePval"]
+        minima = familyMinima[network]
+        empirical.append((1 + (moduleNull <= pval).sum()) / (1 + len(moduleNull)) if pval == pval else np.nan)
+        fwer.append((1 + (minima <= pval).sum()) / (1 + len(minima)) if pval == pval else np.nan)
+    thresholds = {network: np.quantile(familyMinima[network], alpha, method="lower") for network in NETWORKS}
+    return np.array(empirical), np.array(fwer), thresholds
+
+@pytest.mark.parametrize("chunkRows,numRP", [(100000, None), (5, None), (5, 40), (3, 60)])
+def test_matchesDefinitions(tmp_path, chunkRows, numRP):
+    paths, observed, null = writeSlices(tmp_path, 40, np.random.default_rng(4))
+    modules, thresholds = empiricalPvalues(paths, [os.path.join(tmp_path, "master_summary_0.csv")], 0.1, chunkRows, numRP)
+
+    empirical, fwer, expectedThresholds = reference(observed, null, 0.1)
+    modules = modules.set_index(["network", "moduleIndex"])
+    keys = list(zip(observed["network"], observed["moduleIndex"]))
+    assert np.allclose(modules.loc[keys, "empiricalPval"].to_numpy(dtype=float), empirical, equal_nan=True)
+    assert np.allclose(modules.loc[keys, "fwerPval"].to_numpy(dtype=float), fwer, equal_nan=True)
+    assert modules.loc["netC", "fwerPval"].isna().all()
+    assert thresholds["numPermutations"].tolist() == [40, 40, 40]
+    assert dict(zip(thresholds["network"], thresholds["fwerPvalThreshold"])) == expectedThresholds
+
+def test_numRPBelowTheNumberOfRuns(tmp_path):
+    paths, _, _ = writeSlices(tmp_path, 40, np.random.default_rng(5))
+    with pytest.raises(ValueError, match="more than --numRP"):
+        empiricalPvalues(paths, [os.path.join(tmp_path, "master_summary_0.csv")], 0.5, 100000, 10)
+
+def test_interleavedRunsAreRejected(tmp_path):
+    paths, _, _ = writeSlices(tmp_path, 4, np.random.default_rng(6))
+    # the rows of one RP run of netA split by a run of netB, in chunks smaller than the runs
+    first = pd.read_csv(paths[0])
+    interleaved = os.path.join(tmp_path, "interleaved.csv")
+    pd.concat([first.iloc[:3], pd.read_csv(paths[1]), first.iloc[3:]]).to_csv(interleaved, index=False)
+    with pytest.raises(ValueError, match="not contiguous"):
+        empiricalPvalues([interleaved], [os.path.join(tmp_path, "master_summary_0.csv")], 0.1, 2)
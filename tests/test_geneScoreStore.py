@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from conftest import SCRIPTS
+from geneScoreStore import convertScoreFile, readProcessedGeneScores
+from pascalResultIO import writePascalResult
+
+"""
+Processed GS_ files and their gene score stores give the same outputs: processPascalOutput.py --batch finds the GS_
+stores of its pascal outputs, and readProcessedGeneScores returns the same genes and p-values for both.
+"""
+
+def writeNetwork(DIRPATH, name, rng, numGenes=400, numModules=30):
+    genes = [f"G{i}" for i in range(numGenes)]
+    pvals = 10 ** -rng.uniform(0, 9, numGenes)
+    with open(os.path.join(DIRPATH, "gs", f"GS_{name}.tsv"), "w") as f:
+        f.write("".join(f"{gene}\t{pval!r}\n" for gene, pval in zip(genes, pvals.tolist())))
+    rows = []
+    for moduleIndex in range(1, numModules + 1):
+        moduleGenes = rng.choice(numGenes, rng.integers(3, 20), replace=False)
+        rows.append([moduleIndex, [genes[g] for g in moduleGenes], pvals[moduleGenes], 10 ** -rng.uniform(0, 8)])
+    writePascalResult(os.path.join(DIRPATH, "pascal", f"{name}.npz"), rows)
+
+def runBatch(DIRPATH, geneScoreDir, outName):
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, "processPascalOutput.py"), os.path.join(DIRPATH, "manifest.txt"),
+                    "0.05", os.path.join(DIRPATH, outName), geneScoreDir, os.path.join(DIRPATH, outName, "sig"), "1000",
+                    "--batch"], check=True, capture_output=True)
+    outputs = {}
+    for root, _, files in os.walk(os.path.join(DIRPATH, outName)):
+        for file in files:
+            with open(os.path.join(root, file)) as f:
+                outputs[os.path.relpath(os.path.join(root, file), os.path.join(DIRPATH, outName))] = f.read()
+    return outputs
+
+def test_batchSummaryFromStoresMatchesTextFiles(tmp_path):
+    rng = np.random.default_rng(17)
+    for directory in ["gs", "gss", "pascal"]:
+        os.makedirs(os.path.join(tmp_path, directory))
+    names = ["pipe_1-trait_netA", "pipe_1-trait_netB"]
+    for name in names:
+        writeNetwork(tmp_path, name, rng)
+        convertScoreFile(os.path.join(tmp_path, "gs", f"GS_{name}.tsv"), os.path.join(tmp_path, "gss", f"GS_{name}.gss"),
+                         "gene", "pval", processed=True)
+    with open(os.path.join(tmp_path, "manifest.txt"), "w") as f:
+        f.write("".join(os.path.join(tmp_path, "pascal", f"{name}.npz") + "\n" for name in names))
+
+    fromText = runBatch(tmp_path, os.path.join(tmp_path, "gs"), "fromText")
+    fromStores = runBatch(tmp_path, os.path.join(tmp_path, "gss"), "fromStores")
+    assert any(path.startswith("sig/") for path in fromText)
+    assert fromStores == fromText
+
+def test_readProcessedGeneScoresOfStoreMatchesText(tmp_path):
+    for directory in ["gs", "pascal"]:
+        os.makedirs(os.path.join(tmp_path, directory))
+    writeNetwork(tmp_path, "pipe_1-trait_net", np.random.default_rng(2))
+    textPath = os.path.join(tmp_path, "gs", "GS_pipe_1-trait_net.tsv")
+    convertScoreFile(textPath, os.path.join(tmp_path, "GS.gss"), "gene", "pval", processed=True)
+
+    textGenes, _ = readProcessedGeneScores(textPath)
+    storeGenes, storePvals = readProcessedGeneScores(os.path.join(tmp_path, "GS.gss"))
+    assert isinstance(storePvals, np.memmap)
+    assert storeGenes.tolist() == textGenes.tolist()
+    # the store holds the exact values of the text (the default pd.read_table parser may round them)
+    with open(textPath) as f:
+        exactPvals = [float(line.split("\t")[1]) for line in f]
+    assert storePvals.tolist() == exactPvals
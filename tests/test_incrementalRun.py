@@ -0,0 +1,132 @@
+import json
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from conftest import SCRIPTS
+from incrementalRun import planRun
+from verticalMerge import publishParts
+
+"""
+Incremental merges of the master summary dataset (MergeMasterSummaryIncremental): --replaceNetworks replaces the
+partitions of changed networks and appends the new permutations of the others, the staged part files only become
+visible with the manifest at commit, and an interrupted commit is finished exactly once.
+"""
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+MANIFEST = {"pipeline": "pipe", "scoreDigest": "0" * 64, "numRP": 2, "networks": {"netA": "1" * 64, "netB": "2" * 64}}
+
+def writePiece(OUTPUTPATH, network, rpIndex, numModules=3, modulePval=0.5):
+    pd.DataFrame({'study':"pipe", 'trait':f"{rpIndex}-trait", 'network':network, 'moduleIndex':range(1, numModules + 1),
+                  'isModuleSig':False, 'modulePval':modulePval, 'moduleBonPval':1.0, 'size':5, 'numSigGenes':0,
+                  'sigGenes':"[]", 'sig1Genes':"[]", 'sig2Genes':"[]", 'sig3Genes':"[]", 'sig4Genes':"[]",
+                  'geneontology_Biological_Process':"NA", 'BPminCorrectedPval':"NA", 'BPminFDREnrichmentRatio':"NA",
+                  'BPmaxEnrichmentRatio':"NA"}).to_csv(OUTPUTPATH, index=False)
+    return OUTPUTPATH
+
+def merge(DIRPATH, pieces, replaceNetworks=None, stage=None):
+    with open(os.path.join(DIRPATH, "pieces.txt"), "w") as f:
+        f.write("".join(f"{piece}\n" for piece in pieces))
+    command = [sys.executable, os.path.join(SCRIPTS, "verticalMerge.py"), os.path.join(DIRPATH, "pieces.txt"),
+               "--format", "parquet", "--outputName", os.path.join(DIRPATH, "master_summary_trait")]
+    if replaceNetworks is not None:
+        with open(os.path.join(DIRPATH, "replaceNetworks.txt"), "w") as f:
+            f.write("".join(f"{network}\n" for network in replaceNetworks))
+        command += ["--replaceNetworks", os.path.join(DIRPATH, "replaceNetworks.txt"), "--study", "pipe", "--trait", "trait"]
+    if stage is not None:
+        command += ["--stage", stage]
+    subprocess.run(command, check=True, capture_output=True)
+
+def commit(DIRPATH, stage):
+    planDir = os.path.join(DIRPATH, "plan")
+    os.makedirs(planDir, exist_ok=True)
+    with open(os.path.join(planDir, "manifest.json"), "w") as f:
+        json.dump(MANIFEST, f)
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, "incrementalRun.py"), "commit", planDir,
+                    os.path.join(DIRPATH, "manifest_trait.json"), "--staged", stage], check=True, capture_output=True)
+
+def datasetRows(DIRPATH):
+    df = pq.read_table(os.path.join(DIRPATH, "master_summary_trait")).to_pandas()
+    return sorted(zip(df["network"].astype(str), df["rpIndex"], df["moduleIndex"], df["modulePval"]))
+
+def hiddenParts(DIRPATH):
+    return [file for _, _, files in os.walk(os.path.join(DIRPATH, "master_summary_trait")) for file in files if file.startswith(".part-")]
+
+@pytest.fixture
+def initialDataset(tmp_path):
+    # permutation 1 of netA, netB and netC
+    merge(tmp_path, [writePiece(os.path.join(tmp_path, f"{network}_1.csv"), network, 1) for network in ["netA", "netB", "netC"]])
+    return tmp_path
+
+def test_replaceNetworksReplacesChangedAndAppendsExtended(initialDataset):
+    tmp_path = initialDataset
+    # netA changed (permutations 1-2 rerun), netB extended with permutation 2, netC removed
+    pieces = [writePiece(os.path.join(tmp_path, "netA_new_1.csv"), "netA", 1, 2, 0.25),
+              writePiece(os.path.join(tmp_path, "netA_new_2.csv"), "netA", 2, 2, 0.25),
+              writePiece(os.path.join(tmp_path, "netB_2.csv"), "netB", 2)]
+    before = datasetRows(tmp_path)
+    stage = os.path.join(tmp_path, "stage.json")
+    merge(tmp_path, pieces, ["netA", "netC"], stage)
+    assert datasetRows(tmp_path) == before
+
+    commit(tmp_path, stage)
+    assert datasetRows(tmp_path) == sorted([("netA", rp, m, 0.25) for rp in [1, 2] for m in [1, 2]] +
+                                           [("netB", rp, m, 0.5) for rp in [1, 2] for m in [1, 2, 3]])
+    assert not os.path.isdir(os.path.join(tmp_path, "master_summary_trait", "study=pipe", "trait=trait", "network=netC"))
+    with open(os.path.join(tmp_path, "manifest_trait.json")) as f:
+        assert json.load(f) == MANIFEST
+    assert hiddenParts(tmp_path) == []
+
+def test_interruptedCommitIsFinishedOnce(initialDataset):
+    tmp_path = initialDataset
+    stage = os.path.join(tmp_path, "stage.json")
+    merge(tmp_path, [writePiece(os.path.join(tmp_path, "netA_new_1.csv"), "netA", 1, 2, 0.25),
+                     writePiece(os.path.join(tmp_path, "netB_2.csv"), "netB", 2)], ["netA"], stage)
+    expected = sorted([("netA", 1, m, 0.25) for m in [1, 2]] + [("netB", rp, m, 0.5) for rp in [1, 2] for m in [1, 2, 3]] +
+                      [("netC", 1, m, 0.5) for m in [1, 2, 3]])
+
+    # interrupted after the pending file was written and one part file was published
+    manifestPath = os.path.join(tmp_path, "manifest_trait.json")
+    with open(stage) as f:
+        staged = json.load(f)
+    with open(f"{manifestPath}.pending", "w") as f:
+        json.dump({"stage": staged, "manifest": MANIFEST}, f)
+    publishParts(staged["outputDir"], staged["parts"][:1], staged["replacePartitions"])
+
+    # the next plan finishes the commit before comparing the inputs with the manifest
+    moduleDir = os.path.join(tmp_path, "modules")
+    os.makedirs(moduleDir)
+    scoreFile = os.path.join(tmp_path, "scores.csv")
+    with open(scoreFile, "w") as f:
+        f.write("markname,meta_p\nA1BG,0.5\n")
+    planRun(scoreFile, moduleDir, manifestPath, 2, "pipe", os.path.join(tmp_path, "nextPlan"),
+                           os.path.join(tmp_path, "master_summary_trait"))
+    assert datasetRows(tmp_path) == expected
+    assert not os.path.exists(f"{manifestPath}.pending")
+    with open(manifestPath) as f:
+        assert json.load(f) == MANIFEST
+
+    # applying the same publication again changes nothing
+    publishParts(staged["outputDir"], staged["parts"], staged["replacePartitions"])
+    assert datasetRows(tmp_path) == expected
+
+def test_planRemovesPartsOfUncommittedMerges(initialDataset):
+    tmp_path = initialDataset
+    before = datasetRows(tmp_path)
+    # merged but interrupted before the commit
+    merge(tmp_path, [writePiece(os.path.join(tmp_path, "netB_2.csv"), "netB", 2)], [], os.path.join(tmp_path, "stage.json"))
+    assert len(hiddenParts(tmp_path)) == 1
+
+    moduleDir = os.path.join(tmp_path, "modules")
+    os.makedirs(moduleDir)
+    scoreFile = os.path.join(tmp_path, "scores.csv")
+    with open(scoreFile, "w") as f:
+        f.write("markname,meta_p\nA1BG,0.5\n")
+    planRun(scoreFile, moduleDir, os.path.join(tmp_path, "manifest_trait.json"), 2, "pipe",
+                           os.path.join(tmp_path, "nextPlan"), os.path.join(tmp_path, "master_summary_trait"))
+    assert hiddenParts(tmp_path) == []
+    assert datasetRows(tmp_path) == before
@@ -0,0 +1,126 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from conftest import SCRIPTS
+
+"""
+mergeORAandSummary.py against the legacy per-file merge it replaced (countGOterms and outputMergableORA_df, copied
+below): the merged summary files are identical, for tied FDRs, files without GO terms, quoted descriptions and networks
+without any ORA result.
+"""
+
+ORA_HEADER = "geneSet,description,link,size,overlap,expect,enrichmentRatio,pValue,FDR,overlapId,database,userId"
+
+def countGOterms(DIRPATH:str)-> int:
+    df = pd.read_csv(DIRPATH)
+    moduleIndex = DIRPATH.split("/")[-1].split("_")[-1].replace(".csv","")
+    if len(df) > 0:
+        minTermPval = df["FDR"].min()
+        maxEnrichmentRatio = df["enrichmentRatio"].max()
+        enrichMentRatio = df[df["FDR"] == df["FDR"].min()]["enrichmentRatio"].max()
+    else:
+        minTermPval = -1
+        maxEnrichmentRatio = -1
+        enrichMentRatio = -1
+    return int(moduleIndex), len(df), minTermPval, enrichMentRatio, maxEnrichmentRatio
+
+def outputMergableORA_df(module_ora_file:str, study:str, trait:str, network:str):
+    moduleIndex, GOcount, minPval, enrichmentRatio_minFDR, enrichmentRatio_max = countGOterms(module_ora_file)
+    return pd.DataFrame({'study':[study], 'trait':[trait], 'network':[network], 'moduleIndex':[moduleIndex],
+                         'geneontology_Biological_Process':[GOcount], 'BPminCorrectedPval':[minPval],
+                         'BPminFDREnrichmentRatio':[enrichmentRatio_minFDR], 'BPmaxEnrichmentRatio':[enrichmentRatio_max]})
+
+def legacyMerge(masterSummaryPiece:str, oraResultsDir:str, study:str, trait:str, network:str) -> str:
+    df_summary_piece = pd.read_csv(masterSummaryPiece)
+    df_summary_piece[['study', 'trait', 'network', 'moduleIndex']] = df_summary_piece[['study', 'trait', 'network', 'moduleIndex']].astype(str)
+    ora_dfs = []
+    if len(os.listdir(oraResultsDir)) == 0:
+        ora_dfs.append(pd.DataFrame({'study':[study], 'trait':[trait], 'network':[network], 'moduleIndex':[0],
+                                     'geneontology_Biological_Process':["NA"], 'BPminCorrectedPval':["NA"],
+                                     "BPminFDREnrichmentRatio":["NA"], 'BPmaxEnrichmentRatio':["NA"]}))
+    else:
+        for file in os.listdir(oraResultsDir):
+            ora_dfs.append(outputMergableORA_df(os.path.join(oraResultsDir, file), study, trait, network))
+    df_ora_merged = pd.concat(ora_dfs, ignore_index=True)
+    df_ora_merged[['study', 'trait', 'network', 'moduleIndex']] = df_ora_merged[['study', 'trait', 'network', 'moduleIndex']].astype(str)
+    df_merge = pd.merge(df_summary_piece, df_ora_merged, how='left', on=['study','trait','network', 'moduleIndex'])
+    return df_merge.astype(object).fillna("NA").to_csv(index=False)
+
+def writeSummaryPiece(OUTPUTPATH, study, trait, network, numModules, rng):
+    modulePval = 10 ** -rng.uniform(0, 12, numModules)
+    pd.DataFrame({'study':study, 'trait':trait, 'network':network, 'moduleIndex':np.arange(1, numModules + 1),
+                  'isModuleSig':modulePval < 1e-4, 'modulePval':modulePval, 'moduleBonPval':np.minimum(modulePval * numModules, 1),
+                  'size':rng.integers(3, 50, numModules), 'numSigGenes':1, 'sigGenes':"['A1BG']", 'sig1Genes':"[]",
+                  'sig2Genes':"['A1BG']", 'sig3Genes':"['A1BG']", 'sig4Genes':"['A1BG']"}).to_csv(OUTPUTPATH, index=False)
+
+def writeOraResults(DIRPATH, study, trait, network, moduleIndices, rng):
+    os.makedirs(DIRPATH)
+    for i, moduleIndex in enumerate(moduleIndices):
+        path = os.path.join(DIRPATH, f"sig_{study}_{trait}_{network}_{moduleIndex}.csv")
+        if i % 4 == 3: # write.csv(NULL) of a module without enriched terms
+            with open(path, "w") as f:
+                f.write('""\n')
+            continue
+        numTerms = 1 + i % 5
+        fdr = [float(f"{value:.15g}") for value in 10 ** -rng.uniform(0, 8, numTerms)]
+        if numTerms > 2: # a tie at the min FDR
+            fdr[1] = min(fdr)
+        ratio = [float(f"{value:.15g}") for value in rng.uniform(1, 40, numTerms)]
+        with open(path, "w") as f:
+            f.write(ORA_HEADER + "\n")
+            for term, (termFDR, termRatio) in enumerate(zip(fdr, ratio)):
+                f.write(f'"GO:{term:07d}","term, ""{term}""",http://go/{term},{term + 5},3,0.5,{termRatio:.15g},'
+                        f'{termFDR / 10:.15g},{termFDR:.15g},"A1BG;A2M","geneontology_Biological_Process","A1BG;A2M"\n')
+
+def test_mergedSummaryMatchesLegacyMerge(tmp_path):
+    rng = np.random.default_rng(9)
+    piece = os.path.join(tmp_path, "piece.csv")
+    writeSummaryPiece(piece, "study", "trait", "net", 30, rng)
+    oraDir = os.path.join(tmp_path, "ora")
+    writeOraResults(oraDir, "study", "trait", "net", rng.choice(np.arange(1, 31), 17, replace=False), rng)
+
+    outDir = os.path.join(tmp_path, "out")
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, "mergeORAandSummary.py"), piece, oraDir, outDir,
+                    "GO_study_trait_net.txt"], check=True, capture_output=True)
+    with open(os.path.join(outDir, "study_trait_net.csv")) as f:
+        assert f.read() == legacyMerge(piece, oraDir, "study", "trait", "net")
+
+def test_networkWithoutOraResultMatchesLegacyMerge(tmp_path):
+    piece = os.path.join(tmp_path, "piece.csv")
+    writeSummaryPiece(piece, "study", "trait", "net", 5, np.random.default_rng(1))
+    oraDir = os.path.join(tmp_path, "ora")
+    os.makedirs(oraDir)
+
+    outDir = os.path.join(tmp_path, "out")
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, "mergeORAandSummary.py"), piece, oraDir, outDir,
+                    "GO_study_trait_net.txt"], check=True, capture_output=True)
+    with open(os.path.join(outDir, "study_trait_net.csv")) as f:
+        assert f.read() == legacyMerge(piece, oraDir, "study", "trait", "net")
+
+def test_batchMergeMatchesLegacyMergePerNetwork(tmp_path):
+    rng = np.random.default_rng(3)
+    networks = ["netA", "netB", "netC"]
+    pieces = []
+    for network in networks:
+        pieces.append(os.path.join(tmp_path, f"piece_{network}.csv"))
+        writeSummaryPiece(pieces[-1], "study", "trait", network, 12, rng)
+        writeOraResults(os.path.join(tmp_path, "ora", f"GO_summaries_trait_{network}"), "study", "trait", network,
+                        rng.choice(np.arange(1, 13), 6, replace=False), rng)
+    chunk = os.path.join(tmp_path, "chunk.csv")
+    with open(chunk, "w") as out:
+        for i, piece in enumerate(pieces):
+            with open(piece) as f:
+                out.writelines(f.readlines()[i > 0:])
+
+    outDir = os.path.join(tmp_path, "out")
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, "mergeORAandSummary.py"), chunk, os.path.join(tmp_path, "ora"),
+                    outDir, "unused", "--batch", "--chunkName", "0"], check=True, capture_output=True)
+    expected = [legacyMerge(piece, os.path.join(tmp_path, "ora", f"GO_summaries_trait_{network}"), "study", "trait", network)
+                for piece, network in zip(pieces, networks)]
+    header = expected[0].split("\n", 1)[0]
+    with open(os.path.join(outDir, "master_summary_chunk_0.csv")) as f:
+        assert f.read() == header + "\n" + "".join(text.split("\n", 1)[1] for text in expected)
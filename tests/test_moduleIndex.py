@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from conftest import SCRIPTS
+
+"""
+moduleIndex.py: the index of a run (BuildModuleIndex of mea_batch.nf) and its optional persistent cache.
+"""
+
+def run(script, *args):
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, script), *map(str, args)], check=True, capture_output=True)
+
+def writeInputs(tmp_path):
+    rng = np.random.RandomState(0)
+    genes = [f"G{i}" for i in range(200)]
+    # two traits with different gene universes
+    pd.DataFrame({"markname": genes, "meta_p": rng.uniform(size=200)}).to_csv(tmp_path / "a.csv", index=False)
+    pd.DataFrame({"markname": genes[50:], "meta_p": rng.uniform(size=150)}).to_csv(tmp_path / "b.csv", index=False)
+    moduleDir = tmp_path / "modules"
+    moduleDir.mkdir()
+    for network in ["netA", "netB"]:
+        with open(moduleDir / f"{network}.txt", "w") as f:
+            for module in range(1, 6):
+                f.write("\t".join([str(module), "1.0"] + list(rng.choice(genes + ["NOSCORE"], 15, replace=False))) + "\n")
+    return moduleDir
+
+def entries(DIRPATH):
+    return sorted(os.path.relpath(os.path.join(root, file), DIRPATH) for root, _, files in os.walk(DIRPATH) for file in files)
+
+def test_persistentDirSharesEntriesBetweenRuns(tmp_path):
+    moduleDir = writeInputs(tmp_path)
+    persistent = tmp_path / "persistent"
+
+    run("moduleIndex.py", tmp_path / "a.csv", tmp_path / "b.csv", moduleDir, tmp_path / "run1", "markname", "--persistentDir", persistent)
+    assert entries(tmp_path / "run1") == entries(persistent)
+    # 2 networks: index.npz, and Module.tsv, GO.txt, background.npy of both universes
+    assert len(entries(persistent)) == 2 * (1 + 2 * 3)
+
+    # a later run of one trait reuses the persistent entries and copies only its own
+    mtimes = {path: os.path.getmtime(persistent / path) for path in entries(persistent)}
+    run("moduleIndex.py", tmp_path / "a.csv", moduleDir, tmp_path / "run2", "markname", "--persistentDir", persistent)
+    assert {path: os.path.getmtime(persistent / path) for path in entries(persistent)} == mtimes
+    assert len(entries(tmp_path / "run2")) == 2 * (1 + 3)
+    assert set(entries(tmp_path / "run2")) < set(entries(persistent))
+
+def test_indexOfRunGivesUnindexedOutputs(tmp_path):
+    moduleDir = writeInputs(tmp_path)
+    run("moduleIndex.py", tmp_path / "a.csv", tmp_path / "b.csv", moduleDir, tmp_path / "index", "markname", "--persistentDir", tmp_path / "persistent")
+    for trait in ["a", "b"]:
+        run("preProcessForPascal.py", tmp_path / f"{trait}.csv", moduleDir, tmp_path / "indexed", "cma", trait, "markname", "meta_p",
+            "--moduleIndexDir", tmp_path / "index")
+        run("preProcessForPascal.py", tmp_path / f"{trait}.csv", moduleDir, tmp_path / "plain", "cma", trait, "markname", "meta_p")
+    # the entries of the run were complete: nothing was added while preprocessing
+    assert entries(tmp_path / "index") == entries(tmp_path / "persistent")
+    assert entries(tmp_path / "indexed") == entries(tmp_path / "plain")
+    for name in entries(tmp_path / "plain"):
+        assert (tmp_path / "indexed" / name).read_text() == (tmp_path / "plain" / name).read_text(), name
@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import SCRIPTS
+
+"""
+parallelORA.py as GoAnalysis and GoAnalysisChunk run it, with a stand-in for ORA_cmd.R (R and WebGestaltR are not
+needed): every module file gets its summary in the summaryRoot of its directory, and the ORA_cmd.R options are passed on.
+"""
+
+FAKE_ORA = """
+import argparse, json, os, sys
+parser = argparse.ArgumentParser()
+for option in ["--sigModuleDir", "--backGroundGenesFile", "--summaryRoot", "--reportRoot", "--workers", "--moduleList", "--enrichDatabaseFile"]:
+    parser.add_argument(option)
+args = parser.parse_args()
+os.makedirs(args.summaryRoot, exist_ok=True)
+with open(args.moduleList) as f:
+    files = f.read().split()
+for file in files:
+    with open(os.path.join(args.summaryRoot, file.replace(".txt", ".csv")), "w") as f:
+        f.write("geneSet,FDR\\n")
+with open(os.path.join(os.environ["CALLS"], f"{os.getpid()}.json"), "w") as f:
+    json.dump(vars(args), f)
+"""
+
+def writeModules(DIRPATH, names):
+    os.makedirs(DIRPATH)
+    for name in names:
+        with open(os.path.join(DIRPATH, name), "w") as f:
+            f.write("G1\nG2\n")
+
+def runDriver(tmp_path, *args):
+    fakeOra = tmp_path / "fakeORA.py"
+    fakeOra.write_text(FAKE_ORA)
+    calls = tmp_path / "calls"
+    calls.mkdir()
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, "parallelORA.py"), *map(str, args),
+                    "--rscript", sys.executable, "--oraScript", fakeOra], check=True, capture_output=True, cwd=tmp_path,
+                   env={**os.environ, "CALLS": str(calls)})
+    return [json.loads((calls / name).read_text()) for name in sorted(os.listdir(calls))]
+
+def test_singleDirectory(tmp_path):
+    writeModules(tmp_path / "sig", ["sig_a_1.txt", "sig_a_2.txt", "dummy_a_3.txt", "other.tsv"])
+    calls = runDriver(tmp_path, "--sigModuleDir", tmp_path / "sig", "--backGroundGenesFile", "GO_a.txt",
+                      "--summaryRoot", tmp_path / "out", "--workers", 4, "--goGmtFile", "go.gmt")
+    assert sorted(os.listdir(tmp_path / "out")) == ["dummy_a_3.csv", "sig_a_1.csv", "sig_a_2.csv"]
+    # one process per directory, analysing its modules with all workers, offline with the local GMT
+    assert len(calls) == 1
+    assert calls[0]["workers"] == "4"
+    assert calls[0]["enrichDatabaseFile"] == "go.gmt"
+
+def test_manifestBatches(tmp_path):
+    manifest = []
+    for network in ["netA", "netB"]:
+        writeModules(tmp_path / network, [f"sig_{network}_{module}.txt" for module in range(5)])
+        manifest.append(f"{tmp_path / network}\tGO_{network}.txt\t{tmp_path / 'out' / network}\n")
+    (tmp_path / "ora.tsv").write_text("".join(manifest))
+    calls = runDriver(tmp_path, "--manifest", tmp_path / "ora.tsv", "--workers", 2, "--batchSize", 2)
+    for network in ["netA", "netB"]:
+        assert sorted(os.listdir(tmp_path / "out" / network)) == [f"sig_{network}_{module}.csv" for module in range(5)]
+    # batches of 2, 2 and 1 module per network; no temporary summary directories left behind
+    assert len(calls) == 6
+    assert all(call["enrichDatabaseFile"] is None for call in calls)
@@ -0,0 +1,137 @@
+import ast
+import os
+import re
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+from statsmodels.sandbox.stats.multicomp import multipletests
+
+from conftest import SCRIPTS
+from pascalResultIO import readPascalResult, writeLegacyPascalResult, writePascalResult
+from processPascalOutput import NUM_SIG_TIERS, computeGeneSignificanceTiers
+
+"""
+processPascalOutput.py against its baseline (parsing of the str(tuple) Pascal outputs, processOnePascalOutput and gene
+significance tiers, copied below): the .npz and legacy .txt outputs of the same PascalX result hold the same modules and
+give identical outputs, pascalResult.csv and the module order are unchanged by the streamed processing, and the sig-sig4
+genes are the ones of the five per-threshold reads.
+"""
+
+NAME = "pipe_1-trait_net"
+
+def baselineParse(DIRPATH):
+    # (module index, genes, module pval) as parsed by processOnePascalOutput before the structured format
+    with open(DIRPATH, "r") as f:
+        results = f.read()
+        results = results.replace(",\n", ",")
+        results = results.replace(" ", "")
+        parsedResults = re.findall(r"\[(.+?),(.*?),array\((.*)\),(.*?)\]", results)
+    return [(int(parsed[0].replace("'", "")), ast.literal_eval(parsed[1]), float(parsed[3])) for parsed in parsedResults]
+
+def baselineProcessOnePascalOutput(DIRPATH, alpha, outputPATH):
+    # modules sorted by module pval, pascalResult.csv written with DataFrame.to_csv
+    parsed = [record for record in baselineParse(DIRPATH) if record[2] == record[2]]
+    pathwayPvalList = [pval for _, _, pval in parsed]
+    correctedPathwayPvalList = multipletests(pathwayPvalList, alpha, method='bonferroni')
+    df = pd.DataFrame(list(zip([index for index, _, _ in parsed], [genes for _, genes, _ in parsed],
+                               pathwayPvalList, correctedPathwayPvalList[1])),
+                      columns=['moduleIndex', 'moduleGenes', 'modulePval', 'correctedModulePval'])
+    df.to_csv(outputPATH)
+    result = list(zip([index for index, _, _ in parsed], [genes for _, genes, _ in parsed],
+                      correctedPathwayPvalList[0], correctedPathwayPvalList[1], pathwayPvalList))
+    result.sort(key=lambda x: x[-1])
+    return result
+
+def extractGenesBasedOnPval(DIRPATH, pval):
+    # one baseline read per tier
+    df = pd.read_table(DIRPATH, header=None)
+    return list(df[df[1] < pval][0])
+
+def pascalRows(rng, genes, numModules=40):
+    # chi2rank result rows: [module, genes, gene pvals, module pval]
+    rows = []
+    for moduleIndex in range(1, numModules + 1):
+        moduleGenes = rng.choice(len(genes), rng.integers(1, 25), replace=False)
+        rows.append([str(moduleIndex), [genes[g] for g in moduleGenes], 10 ** -rng.uniform(0, 9, len(moduleGenes)),
+                     float(10 ** -rng.uniform(0, 8))])
+    rows[3][3] = float("nan") # a module that lost all of its genes
+    rows[7][3] = rows[5][3] # tied module p-values keep the file order
+    return rows
+
+def writeFixture(DIRPATH, seed=7, numGenes=300):
+    rng = np.random.default_rng(seed)
+    genes = [f"G{i}" for i in range(numGenes)] + ["O'NEIL"]
+    pvals = 10 ** -rng.uniform(0, 9, len(genes))
+    with open(os.path.join(DIRPATH, f"GS_{NAME}.tsv"), "w") as f:
+        f.write("".join(f"{gene}\t{pval!r}\n" for gene, pval in zip(genes, pvals.tolist())))
+        # a gene scored twice keeps its most significant tier
+        f.write(f"G1\t{float(pvals.min()) / 10!r}\n")
+    rows = pascalRows(rng, genes)
+    writeLegacyPascalResult(os.path.join(DIRPATH, f"{NAME}.txt"), rows)
+    writePascalResult(os.path.join(DIRPATH, f"{NAME}.npz"), rows)
+    return rows
+
+def runSingle(DIRPATH, pascalOutputFile, outName, numTests=1000):
+    # run as in the pipeline, from the directory of the pascal output
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, "processPascalOutput.py"), pascalOutputFile, "0.05", outName,
+                    f"GS_{NAME}.tsv", os.path.join(outName, "sig"), str(numTests)], cwd=DIRPATH, check=True, capture_output=True)
+    outputs = {}
+    for root, _, files in os.walk(os.path.join(DIRPATH, outName)):
+        for file in files:
+            with open(os.path.join(root, file)) as f:
+                outputs[os.path.relpath(os.path.join(root, file), os.path.join(DIRPATH, outName))] = f.read()
+    return outputs
+
+def test_structuredAndLegacyOutputsMatch(tmp_path):
+    rows = writeFixture(tmp_path)
+    structured = readPascalResult(os.path.join(tmp_path, f"{NAME}.npz"))
+    legacy = readPascalResult(os.path.join(tmp_path, f"{NAME}.txt"))
+    expected = baselineParse(os.path.join(tmp_path, f"{NAME}.txt"))
+    for result in [structured, legacy]:
+        assert result.moduleIndex.tolist() == [index for index, _, _ in expected]
+        assert np.array_equal(result.modulePval, [pval for _, _, pval in expected], equal_nan=True)
+        assert [result.moduleGenes(i) for i in range(len(result))] == [genes for _, genes, _ in expected]
+    assert legacy.genePvals is None
+    assert structured.genePvals.tolist() == np.concatenate([row[2] for row in rows]).tolist()
+
+    fromStructured = runSingle(tmp_path, f"{NAME}.npz", "fromStructured")
+    fromLegacy = runSingle(tmp_path, f"{NAME}.txt", "fromLegacy")
+    assert "master_summary_slice_1.csv" in fromLegacy and any(path.startswith("sig/") for path in fromLegacy)
+    assert fromStructured == fromLegacy
+
+def test_significanceTiersMatchPerThresholdReads(tmp_path):
+    rows = writeFixture(tmp_path)
+    sigPvalThreshold = 0.05 / 1000
+    tierGenes = [extractGenesBasedOnPval(os.path.join(tmp_path, f"GS_{NAME}.tsv"), sigPvalThreshold * 10**j)
+                 for j in range(NUM_SIG_TIERS)]
+    assert all(tierGenes)
+    geneTiers = computeGeneSignificanceTiers(os.path.join(tmp_path, f"GS_{NAME}.tsv"), sigPvalThreshold)
+    for j in range(NUM_SIG_TIERS):
+        assert sorted(gene for gene, tier in geneTiers.items() if tier <= j) == sorted(set(tierGenes[j]))
+
+    runSingle(tmp_path, f"{NAME}.npz", "out")
+    summary = pd.read_csv(os.path.join(tmp_path, "out", "master_summary_slice_1.csv"))
+    moduleGenes = {int(row[0]): row[1] for row in rows if row[3] == row[3]}
+    assert sorted(summary["moduleIndex"]) == sorted(moduleGenes)
+    for column, genes in zip(["sigGenes", "sig1Genes", "sig2Genes", "sig3Genes", "sig4Genes"], tierGenes):
+        expected = [[gene for gene in moduleGenes[moduleIndex] if gene in genes] for moduleIndex in summary["moduleIndex"]]
+        assert summary[column].map(ast.literal_eval).tolist() == expected
+    assert summary["numSigGenes"].tolist() == summary["sigGenes"].map(lambda genes: len(ast.literal_eval(genes))).tolist()
+
+def test_pascalResultAndModuleOrderMatchBaseline(tmp_path):
+    writeFixture(tmp_path)
+    result = baselineProcessOnePascalOutput(os.path.join(tmp_path, f"{NAME}.txt"), 0.05, os.path.join(tmp_path, "baseline.csv"))
+    assert any(item[2] for item in result)
+
+    for pascalOutputFile, outName in [(f"{NAME}.txt", "fromLegacy"), (f"{NAME}.npz", "fromStructured")]:
+        outputs = runSingle(tmp_path, pascalOutputFile, outName)
+        with open(os.path.join(tmp_path, "baseline.csv")) as f:
+            assert outputs["pascalResult.csv"] == f.read()
+        summary = pd.read_csv(os.path.join(tmp_path, outName, "master_summary_slice_1.csv"), float_precision="round_trip")
+        assert list(zip(summary["moduleIndex"], summary["isModuleSig"], summary["moduleBonPval"], summary["modulePval"],
+                        summary["size"])) == [(index, bool(isSig), corrected, pval, len(genes))
+                                              for index, genes, isSig, corrected, pval in result]
+        assert {path: text for path, text in outputs.items() if path.startswith("sig/")} == \
+            {f"sig/sig_{NAME}_{index}.txt": "".join(f"{gene}\n" for gene in genes) for index, genes, isSig, _, _ in result if isSig}
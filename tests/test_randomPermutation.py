@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from conftest import SCRIPTS
+from randomPermutation import load_permuted_scores, permutation_file_path
+
+"""
+randomPermutation.py --batch: row k-1 of the permutation matrix is the permutation of seed k drawn by
+df[column].sample(frac=1, random_state=k), so the RP files rebuilt from it are the ones written one CSV per seed.
+"""
+
+def writeScores(INPUTPATH, numGenes, rng):
+    pd.DataFrame({"Unnamed: 0": range(numGenes), "markname": [f"G{i}" for i in range(numGenes)],
+                  "meta_p": 10 ** -rng.uniform(0, 9, numGenes)}).to_csv(INPUTPATH, index=False)
+
+def test_permutationMatrixMatchesPerSeedDraws(tmp_path):
+    inputPath = os.path.join(tmp_path, "ABI.csv")
+    writeScores(inputPath, 257, np.random.default_rng(1))
+    numRP = 7
+    for outName, extra in [("batch", ["--batch", "--chunkSize", "3"]), ("files", [])]:
+        subprocess.run([sys.executable, os.path.join(SCRIPTS, "randomPermutation.py"), inputPath,
+                        os.path.join(tmp_path, outName), "meta_p", str(numRP)] + extra, check=True, capture_output=True)
+
+    matrix = np.load(permutation_file_path(inputPath, os.path.join(tmp_path, "batch")))
+    assert matrix.shape == (numRP, 257) and matrix.dtype == np.uint32
+    df = pd.read_csv(inputPath)
+    for seed in range(1, numRP + 1):
+        assert matrix[seed - 1].tolist() == np.random.RandomState(seed).permutation(257).tolist()
+        assert df["meta_p"].values[matrix[seed - 1]].tolist() == df["meta_p"].sample(frac=1, random_state=seed).tolist()
+        rebuilt = load_permuted_scores(inputPath, permutation_file_path(inputPath, os.path.join(tmp_path, "batch")),
+                                       "meta_p", seed, df)
+        with open(os.path.join(tmp_path, "files", f"{seed}-ABI.csv")) as f:
+            assert rebuilt.to_csv(index=False) == f.read()
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+import resultCache
+from resultCache import ResultCache, cacheKey, cachedRun, codeDigest
+
+"""
+resultCache.py: a step runs on a miss and is restored from the cache on a hit, and the key changes with the inputs, the
+parameters and the code producing the outputs.
+"""
+
+def writeText(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+class Step:
+    # a cached step writing one output per input line under outputRoot/sig
+    def __init__(self, inputPath, outputRoot):
+        self.inputPath, self.outputRoot, self.runs = inputPath, outputRoot, 0
+
+    def __call__(self):
+        self.runs += 1
+        os.makedirs(os.path.join(self.outputRoot, "sig"), exist_ok=True)
+        with open(self.inputPath) as f:
+            lines = f.read().splitlines()
+        return [writeText(os.path.join(self.outputRoot, "sig", f"sig_{i}.txt"), f"{line}\n") for i, line in enumerate(lines)]
+
+def outputs(outputRoot):
+    texts = {}
+    for root, _, files in os.walk(outputRoot):
+        for file in files:
+            with open(os.path.join(root, file)) as f:
+                texts[os.path.relpath(os.path.join(root, file), outputRoot)] = f.read()
+    return texts
+
+def test_missStoresAndHitRestores(tmp_path):
+    cache = ResultCache(os.path.join(tmp_path, "cache"))
+    inputPath = writeText(os.path.join(tmp_path, "genes.txt"), "A1BG\nA2M\n")
+    firstRoot, secondRoot = os.path.join(tmp_path, "first"), os.path.join(tmp_path, "second")
+    first, second = Step(inputPath, firstRoot), Step(inputPath, secondRoot)
+
+    cachedRun(cache, "processPascalOutput", [inputPath], {"alpha": 0.05}, firstRoot, first)
+    restored = cachedRun(cache, "processPascalOutput", [inputPath], {"alpha": 0.05}, secondRoot, second)
+    assert (first.runs, second.runs) == (1, 0)
+    assert sorted(restored) == sorted(os.path.join(secondRoot, "sig", f"sig_{i}.txt") for i in range(2))
+    assert outputs(secondRoot) == outputs(firstRoot) == {"sig/sig_0.txt": "A1BG\n", "sig/sig_1.txt": "A2M\n"}
+
+    # another parameter or another input content is a miss
+    cachedRun(cache, "processPascalOutput", [inputPath], {"alpha": 0.01}, secondRoot, second)
+    writeText(inputPath, "A1BG\n")
+    cachedRun(cache, "processPascalOutput", [inputPath], {"alpha": 0.05}, secondRoot, second)
+    assert second.runs == 2
+
+def test_keyChangesWithTheCodeOfTheStep(tmp_path, monkeypatch):
+    inputPath = writeText(os.path.join(tmp_path, "genes.txt"), "A1BG\n")
+    key = cacheKey("runPascal", [inputPath], {"seed": 1})
+    assert cacheKey("randomPermutation", [inputPath], {"seed": 1}) != key
+    monkeypatch.setattr(resultCache, "codeDigest", lambda SCRIPTPATH: "0" * 64)
+    assert cacheKey("runPascal", [inputPath], {"seed": 1}) != key
+    with pytest.raises(ValueError, match="no script producing"):
+        cacheKey("unknownStep", [inputPath], {})
+
+def test_codeDigestCoversImportedPipelineModules(tmp_path):
+    writeText(os.path.join(tmp_path, "step.py"), "import os\nfrom helper import run\n")
+    writeText(os.path.join(tmp_path, "helper.py"), "import common\n")
+    writeText(os.path.join(tmp_path, "common.py"), "VERSION = 1\n")
+    unrelated = writeText(os.path.join(tmp_path, "unrelated.py"), "VERSION = 1\n")
+    before = codeDigest(os.path.join(tmp_path, "step.py"))
+
+    writeText(unrelated, "VERSION = 2\n")
+    codeDigest.cache_clear()
+    assert codeDigest(os.path.join(tmp_path, "step.py")) == before
+    writeText(os.path.join(tmp_path, "common.py"), "VERSION = 22\n")
+    codeDigest.cache_clear()
+    assert codeDigest(os.path.join(tmp_path, "step.py")) != before
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from summaryIO import exportCsv, readSummary, writeSummary
+
+"""
+summaryIO.py: a summary written as typed Parquet and exported back is the CSV summary of the same rows, for the slices
+of processPascalOutput.py (gene lists as python lists) and the pieces merged with ORA results ("NA" cells).
+"""
+
+pytest.importorskip("pyarrow")
+
+def sliceRows(rng, numModules=20):
+    modulePval = 10 ** -rng.uniform(0, 12, numModules)
+    genes = [[f"G{g}" for g in rng.choice(100, rng.integers(0, 4), replace=False)] for _ in range(numModules)]
+    return pd.DataFrame({'study':"pipe", 'trait':"1-trait", 'network':"net", 'moduleIndex':np.arange(1, numModules + 1),
+                         'isModuleSig':modulePval < 1e-6, 'modulePval':modulePval,
+                         'moduleBonPval':np.minimum(modulePval * numModules, 1), 'size':rng.integers(3, 50, numModules),
+                         'numSigGenes':[len(g) for g in genes], 'sigGenes':genes, 'sig1Genes':genes, 'sig2Genes':genes,
+                         'sig3Genes':genes, 'sig4Genes':genes})
+
+def test_sliceRoundTrip(tmp_path):
+    df = sliceRows(np.random.default_rng(0))
+    writeSummary(df, os.path.join(tmp_path, "slice.csv"))
+    writeSummary(df, os.path.join(tmp_path, "slice.parquet"))
+    exportCsv(os.path.join(tmp_path, "slice.parquet"), os.path.join(tmp_path, "export.csv"))
+    with open(os.path.join(tmp_path, "slice.csv")) as csv, open(os.path.join(tmp_path, "export.csv")) as export:
+        assert export.read() == csv.read()
+    assert readSummary(os.path.join(tmp_path, "slice.parquet"), ["modulePval"])["modulePval"].tolist() == df["modulePval"].tolist()
+
+def test_mergedPieceRoundTrip(tmp_path):
+    rng = np.random.default_rng(1)
+    df = sliceRows(rng)
+    hasORA = rng.uniform(size=len(df)) < 0.5
+    df["geneontology_Biological_Process"] = np.where(hasORA, rng.integers(1, 5, len(df)), np.nan)
+    for column in ["BPminCorrectedPval", "BPminFDREnrichmentRatio", "BPmaxEnrichmentRatio"]:
+        df[column] = np.where(hasORA, rng.uniform(size=len(df)), np.nan)
+    df.astype(object).fillna("NA").to_csv(os.path.join(tmp_path, "piece.csv"), index=False)
+
+    # the CSV piece written as a typed Parquet piece
+    writeSummary(pd.read_csv(os.path.join(tmp_path, "piece.csv"), float_precision="round_trip"),
+                 os.path.join(tmp_path, "piece.parquet"))
+    typed = readSummary(os.path.join(tmp_path, "piece.parquet"))
+    assert typed["geneontology_Biological_Process"].isna().tolist() == (~hasORA).tolist()
+    assert typed["sigGenes"].map(list).tolist() == df["sigGenes"].tolist()
+    exportCsv(os.path.join(tmp_path, "piece.parquet"), os.path.join(tmp_path, "export.csv"))
+    with open(os.path.join(tmp_path, "piece.csv")) as csv, open(os.path.join(tmp_path, "export.csv")) as export:
+        assert export.read() == csv.read()
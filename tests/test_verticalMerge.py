@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import SCRIPTS
+
+"""
+verticalMerge.py: the CSV master summary is the file the awk loop of VerticalMergeMasterSummaryPieces wrote, and the
+Parquet dataset, merged in chunks smaller than the pieces, holds the same rows, ordered by moduleIndex with --sort.
+"""
+
+def writePiece(OUTPUTPATH, network, rpIndex, rng, numModules=25):
+    # merged piece as mergeORAandSummary.py writes it: ORA values of modules without ORA result are "NA", GO term counts
+    # are floats next to them, -1 for a module without enriched terms
+    modulePval = 10 ** -rng.uniform(0, 12, numModules)
+    numTerms = rng.integers(-1, 4, numModules).astype(float)
+    hasORA = rng.uniform(size=numModules) < 0.6
+    numTerms[numTerms == 0] = -1
+    pd.DataFrame({'study':"pipe", 'trait':f"{rpIndex}-trait", 'network':network,
+                  'moduleIndex':rng.permutation(np.arange(1, numModules + 1)), 'isModuleSig':modulePval < 1e-6,
+                  'modulePval':modulePval, 'moduleBonPval':np.minimum(modulePval * numModules, 1),
+                  'size':rng.integers(3, 50, numModules), 'numSigGenes':1, 'sigGenes':"['A1BG']", 'sig1Genes':"['A1BG']",
+                  'sig2Genes':"['A1BG', 'A2M']", 'sig3Genes':"['A1BG', 'A2M']", 'sig4Genes':"['A1BG', 'A2M']",
+                  'geneontology_Biological_Process':np.where(hasORA, numTerms, np.nan),
+                  'BPminCorrectedPval':np.where(hasORA, np.where(numTerms > 0, 10 ** -rng.uniform(0, 5, numModules), -1), np.nan),
+                  'BPminFDREnrichmentRatio':np.where(hasORA, np.where(numTerms > 0, rng.uniform(1, 30, numModules), -1), np.nan),
+                  'BPmaxEnrichmentRatio':np.where(hasORA, np.where(numTerms > 0, rng.uniform(30, 60, numModules), -1), np.nan)}
+                 ).astype(object).fillna("NA").to_csv(OUTPUTPATH, index=False)
+    return OUTPUTPATH
+
+def writePieces(DIRPATH, rng):
+    pieces = [writePiece(os.path.join(DIRPATH, f"{network}_{rpIndex}.csv"), network, rpIndex, rng)
+              for rpIndex in range(1, 4) for network in ["netA", "netB"]]
+    with open(os.path.join(DIRPATH, "pieces.txt"), "w") as f:
+        f.write("".join(f"{piece}\n" for piece in pieces))
+    return pieces
+
+def merge(DIRPATH, *options):
+    return subprocess.run([sys.executable, os.path.join(SCRIPTS, "verticalMerge.py"), os.path.join(DIRPATH, "pieces.txt"),
+                           *options], capture_output=True)
+
+def awkMerge(pieces):
+    # head -n 1 of the first piece, then awk 'NR > 1' of every piece
+    with open(pieces[0]) as f:
+        text = f.readline()
+    for piece in pieces:
+        with open(piece) as f:
+            text += "".join(f.readlines()[1:])
+    return text
+
+def test_csvMergeMatchesAwkLoop(tmp_path):
+    pieces = writePieces(tmp_path, np.random.default_rng(8))
+    merge(tmp_path, "--outputName", os.path.join(tmp_path, "master_summary_trait.csv")).check_returncode()
+    with open(os.path.join(tmp_path, "master_summary_trait.csv")) as f:
+        assert f.read() == awkMerge(pieces)
+
+def test_piecesWithAnotherHeaderAreRejected(tmp_path):
+    pieces = writePieces(tmp_path, np.random.default_rng(8))
+    pd.read_csv(pieces[2]).drop(columns=["sig4Genes"]).to_csv(pieces[2], index=False)
+    completed = merge(tmp_path, "--outputName", os.path.join(tmp_path, "master_summary_trait.csv"))
+    assert completed.returncode != 0 and b"different header" in completed.stderr
+
+@pytest.mark.parametrize("sort", [False, True])
+def test_parquetDatasetHoldsThePieces(tmp_path, sort):
+    pq = pytest.importorskip("pyarrow.parquet")
+    from verticalMerge import exportParquetToCsv
+    pieces = writePieces(tmp_path, np.random.default_rng(8))
+    datasetDir = os.path.join(tmp_path, "master_summary_trait")
+    merge(tmp_path, "--format", "parquet", "--outputName", datasetDir, "--chunkRows", "10", *(["--sort"] if sort else [])).check_returncode()
+
+    assert sorted(os.listdir(os.path.join(datasetDir, "study=pipe", "trait=trait"))) == ["network=netA", "network=netB"]
+    df = pq.read_table(datasetDir).to_pandas()
+    assert len(df) == 6 * 25 and sorted(df["rpIndex"].unique()) == [1, 2, 3]
+    if sort:
+        for network in ["netA", "netB"]:
+            partition = pq.read_table(os.path.join(datasetDir, "study=pipe", "trait=trait", f"network={network}")).to_pandas()
+            assert partition["moduleIndex"].is_monotonic_increasing
+
+    # the CSV export has the rows of the pieces
+    exportParquetToCsv(datasetDir, os.path.join(tmp_path, "export.csv"))
+    with open(os.path.join(tmp_path, "export.csv")) as f:
+        exported = f.read().splitlines()
+    expected = awkMerge(pieces).splitlines()
+    assert exported[0] == expected[0]
+    assert sorted(exported[1:]) == sorted(expected[1:])